@@ -0,0 +1,270 @@
+# sbncng - an object-oriented framework for IRC
+# Copyright (C) 2011 Gunnar Beutner
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+A minimal in-process IRC server and IRC client for benchmarks. Both know just
+enough of the protocol to get through registration and channel joins; the
+interesting traffic is pushed by the benchmark itself.
+"""
+
+from time import time
+import gevent
+from gevent import socket, event
+from sbnc import utils
+
+SERVER_NAME = 'fake.ircd'
+
+class FakeIRCSession(object):
+    """A client connection to the fake IRC server."""
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.socket = sock
+        self.nick = None
+        self.user = None
+        self.registered = False
+        self.channels = set()
+
+    def get_hostmask(self):
+        return '%s!%s@bench.host' % (self.nick, self.user)
+
+    def send_lines(self, lines):
+        """Sends several lines with a single write."""
+
+        if len(lines) == 0:
+            return
+
+        try:
+            self.socket.sendall('\r\n'.join(lines) + '\r\n')
+        except socket.error:
+            pass
+
+    def send_reply(self, numeric, *params):
+        self.send_lines([utils.format_irc_message(numeric, self.nick, prefix=SERVER_NAME, *params)])
+
+    def run(self):
+        connection = self.socket.makefile('rb')
+
+        try:
+            while True:
+                line = connection.readline()
+
+                if not line:
+                    break
+
+                prefix, command, params = utils.parse_irc_message(line.rstrip('\r\n'))
+
+                if command == None:
+                    continue
+
+                handler = getattr(self, 'irc_' + command.upper(), None)
+
+                if handler != None:
+                    handler(params)
+        finally:
+            self.server.sessions.remove(self)
+            self.socket.close()
+
+    def irc_NICK(self, params):
+        if len(params) < 1:
+            return
+
+        if self.registered:
+            self.send_lines([utils.format_irc_message('NICK', params[0], prefix=self.get_hostmask())])
+
+        self.nick = params[0]
+        self._try_register()
+
+    def irc_USER(self, params):
+        if len(params) < 1:
+            return
+
+        self.user = params[0]
+        self._try_register()
+
+    def _try_register(self):
+        if self.registered or self.nick == None or self.user == None:
+            return
+
+        self.registered = True
+
+        self.send_reply('001', 'Welcome to the fake IRC network, %s' % (self.nick))
+        self.send_reply('005', 'NETWORK=bench', 'PREFIX=(ov)@+', 'CHANTYPES=#',
+                        'CHANMODES=b,k,l,imnpst', 'TARGMAX=JOIN:,PRIVMSG:4', 'MODES=6',
+                        'are supported by this server')
+        self.send_reply('375', '- %s Message of the Day -' % (SERVER_NAME))
+        self.send_reply('372', '- This server is used for benchmarks.')
+        self.send_reply('376', 'End of MOTD command')
+
+        self.server.registered_event.set()
+
+    def irc_PING(self, params):
+        if len(params) < 1:
+            return
+
+        self.send_lines([utils.format_irc_message('PONG', SERVER_NAME, params[0], prefix=SERVER_NAME)])
+
+    def irc_JOIN(self, params):
+        if len(params) < 1 or not self.registered:
+            return
+
+        lines = []
+
+        for channel in params[0].split(','):
+            self.channels.add(channel)
+
+            members = self.server.get_members(channel)
+
+            lines.append(utils.format_irc_message('JOIN', channel, prefix=self.get_hostmask()))
+            lines.extend(self.server.format_names(self.nick, channel, [self.nick] + members))
+            lines.append(utils.format_irc_message('366', self.nick, channel, 'End of /NAMES list.',
+                                                  prefix=SERVER_NAME))
+
+        self.send_lines(lines)
+
+    def irc_PART(self, params):
+        if len(params) < 1:
+            return
+
+        for channel in params[0].split(','):
+            self.channels.discard(channel)
+
+            self.send_lines([utils.format_irc_message('PART', channel, prefix=self.get_hostmask())])
+
+    def irc_QUIT(self, params):
+        self.send_lines(['ERROR :Closing Link'])
+        self.socket.close()
+
+class FakeIRCServer(object):
+    """
+    An IRC server which accepts any connection. Channel members other than the
+    connected sessions are simulated; benchmarks set them with set_members().
+    """
+
+    def __init__(self, bind_address=('127.0.0.1', 0)):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(bind_address)
+        self.socket.listen(128)
+
+        self.address = self.socket.getsockname()
+        self.sessions = []
+        self.registered_event = event.Event()
+
+        self._members = {}
+
+    def start(self):
+        return gevent.spawn(self.run)
+
+    def run(self):
+        while True:
+            sock, _ = self.socket.accept()
+
+            session = FakeIRCSession(self, sock)
+            self.sessions.append(session)
+
+            gevent.spawn(session.run)
+
+    def set_members(self, channel, nicks):
+        self._members[channel] = list(nicks)
+
+    def get_members(self, channel):
+        return self._members.get(channel, [])
+
+    def format_names(self, nick, channel, members):
+        lines = []
+
+        for index in range(0, len(members), 40):
+            lines.append(utils.format_irc_message('353', nick, '=', channel,
+                                                  ' '.join(members[index:index + 40]),
+                                                  prefix=SERVER_NAME))
+
+        return lines
+
+    def wait_for_registrations(self, count, timeout=30):
+        """Waits until the specified number of sessions have registered."""
+
+        deadline = time() + timeout
+
+        while len([session for session in self.sessions if session.registered]) < count:
+            if time() > deadline:
+                raise RuntimeError('Timed out waiting for registrations.')
+
+            self.registered_event.clear()
+            self.registered_event.wait(timeout=1)
+
+class FakeIRCClient(object):
+    """
+    An IRC client which logs into the bouncer and keeps track of how many lines
+    it received. PRIVMSGs whose text starts with 'ts=<timestamp>' are used to
+    measure the relay latency.
+    """
+
+    def __init__(self, address, user, password):
+        self.address = address
+        self.user = user
+        self.password = password
+
+        self.registered = False
+        self.registered_event = event.Event()
+
+        self.lines_received = 0
+        self.latencies = []
+
+    def start(self):
+        return gevent.spawn(self.run)
+
+    def run(self):
+        sock = socket.create_connection(self.address)
+        sock.sendall('PASS %s\r\nNICK %s\r\nUSER %s 0 * :bench client\r\n' %
+                     (self.password, self.user, self.user))
+
+        connection = sock.makefile('rb')
+
+        try:
+            while True:
+                line = connection.readline()
+
+                if not line:
+                    break
+
+                self.lines_received += 1
+
+                marker = line.find(':ts=')
+
+                if marker != -1:
+                    end = line.find(' ', marker)
+
+                    if end == -1:
+                        end = len(line.rstrip('\r\n'))
+
+                    self.latencies.append(time() - float(line[marker + 4:end]))
+                    continue
+
+                if line.startswith('PING '):
+                    sock.sendall('PONG ' + line[5:])
+                    continue
+
+                if not self.registered and ' 001 ' in line:
+                    self.registered = True
+                    self.registered_event.set()
+        finally:
+            sock.close()
+
+    def reset(self):
+        self.lines_received = 0
+        self.latencies = []
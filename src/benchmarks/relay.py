@@ -0,0 +1,274 @@
+# sbncng - an object-oriented framework for IRC
+# Copyright (C) 2011 Gunnar Beutner
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+Relay benchmark. Starts the real Proxy/ClientListener stack against a fake IRC
+server, attaches scripted clients and pushes traffic profiles through it.
+Reports relayed lines per second, the server-to-client latency percentiles,
+RSS and CPU time for each profile.
+
+Usage (from the src directory):
+    python -m benchmarks.relay [-u users] [-c clients per user] [-p profile,...]
+"""
+
+import os
+import sys
+import resource
+from time import time
+from optparse import OptionParser
+import gevent
+from sbnc.plugin import ServiceRegistry
+from sbnc.directory import DirectoryService
+from sbnc.proxy import Proxy
+from sbnc.irc import ClientListener
+from benchmarks.fakeircd import FakeIRCServer, FakeIRCClient, SERVER_NAME
+
+CHANNEL = '#bench'
+PASSWORD = 'bench'
+
+def _marker():
+    return 'ts=%.6f' % (time())
+
+def _privmsg(source, target, text):
+    return ':%s!user@bench.host PRIVMSG %s :%s' % (source, target, text)
+
+def profile_idle(server, duration):
+    """Nothing but the occasional PING."""
+
+    deadline = time() + duration
+    sent = 0
+
+    while time() < deadline:
+        for session in list(server.sessions):
+            session.send_lines(['PING :%s' % (SERVER_NAME),
+                                _privmsg('idler', CHANNEL, _marker())])
+
+        sent += 1
+        gevent.sleep(1)
+
+    return sent
+
+def profile_busy_channel(server, duration, rate=50):
+    """A channel with a steady stream of messages from many different nicks."""
+
+    deadline = time() + duration
+    sent = 0
+
+    while time() < deadline:
+        for session in list(server.sessions):
+            session.send_lines([_privmsg('talker%d' % (sent % 200), CHANNEL,
+                                         _marker() + ' some chatter in a busy channel')])
+
+        sent += 1
+        gevent.sleep(1.0 / rate)
+
+    return sent
+
+def profile_netsplit(server, duration, nicks=500):
+    """Mass QUITs followed by mass JOINs, like a netsplit and the rejoin burst."""
+
+    deadline = time() + duration
+    sent = 0
+
+    while time() < deadline:
+        for session in list(server.sessions):
+            quits = [':splitter%d!user@bench.host QUIT :hub.example.org leaf.example.org' % (index)
+                     for index in range(nicks)]
+            joins = [':splitter%d!user@bench.host JOIN %s' % (index, CHANNEL)
+                     for index in range(nicks)]
+
+            session.send_lines(quits + joins + [_privmsg('splitter0', CHANNEL, _marker())])
+
+        sent += 1
+        gevent.sleep(1)
+
+    return sent
+
+def profile_names_burst(server, duration, nicks=2000):
+    """Large NAMES replies, as seen when joining big channels."""
+
+    members = ['@op%d' % (index) for index in range(nicks / 10)] + \
+              ['member%d' % (index) for index in range(nicks - nicks / 10)]
+
+    deadline = time() + duration
+    sent = 0
+
+    while time() < deadline:
+        for session in list(server.sessions):
+            lines = server.format_names(session.nick, CHANNEL, members)
+            lines.append(':%s 366 %s %s :End of /NAMES list.' % (SERVER_NAME, session.nick, CHANNEL))
+            lines.append(_privmsg('namer', CHANNEL, _marker()))
+
+            session.send_lines(lines)
+
+        sent += 1
+        gevent.sleep(1)
+
+    return sent
+
+def profile_mass_privmsg(server, duration, batch=100):
+    """PRIVMSGs as fast as the bouncer will take them."""
+
+    deadline = time() + duration
+    sent = 0
+
+    while time() < deadline:
+        for session in list(server.sessions):
+            session.send_lines([_privmsg('flooder', CHANNEL, _marker() + ' flood')
+                                for _ in range(batch)])
+
+        sent += batch
+        gevent.sleep(0)
+
+    return sent
+
+profiles = [
+    ('idle', profile_idle),
+    ('busy-channel', profile_busy_channel),
+    ('netsplit', profile_netsplit),
+    ('names-burst', profile_names_burst),
+    ('mass-privmsg', profile_mass_privmsg)
+]
+
+def _percentile(values, fraction):
+    if len(values) == 0:
+        return 0.0
+
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def _cpu_time():
+    times = os.times()
+    return times[0] + times[1]
+
+def _rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def setup(user_count, clients_per_user):
+    """Starts the bouncer, the fake server and the clients. Returns (server, clients)."""
+
+    dir_svc = ServiceRegistry.get(DirectoryService.package)
+    dir_svc.start('sqlite://')
+
+    server = FakeIRCServer()
+    server.start()
+    server.set_members(CHANNEL, ['member%d' % (index) for index in range(100)])
+
+    proxy_svc = ServiceRegistry.get(Proxy.package)
+    proxy_svc.start(dir_svc.get_root_node())
+
+    for index in range(user_count):
+        userobj = proxy_svc.create_user('bench%d' % (index))
+
+        user_config = userobj.get_plugin_config(Proxy)
+        user_config.set('password', PASSWORD)
+        user_config.set('server_address', list(server.address))
+        user_config.set('flood_profile', 'unlimited')
+
+        userobj.reconnect_to_irc()
+
+    server.wait_for_registrations(user_count)
+
+    for userobj in proxy_svc.users.values():
+        while not userobj.irc_connection.registered:
+            gevent.sleep(0.01)
+
+        userobj.irc_connection.send_message('JOIN', CHANNEL)
+
+    listener = ClientListener(('127.0.0.1', 0), proxy_svc.client_factory)
+    listener.start()
+
+    clients = []
+
+    for index in range(user_count):
+        for _ in range(clients_per_user):
+            clientobj = FakeIRCClient(listener.socket.getsockname(), 'bench%d' % (index), PASSWORD)
+            clientobj.start()
+            clients.append(clientobj)
+
+    for clientobj in clients:
+        clientobj.registered_event.wait(timeout=30)
+
+    # Let the attach burst (JOIN, TOPIC, NAMES) settle.
+    gevent.sleep(1)
+
+    return server, clients
+
+def run_profile(name, func, server, clients, duration):
+    for clientobj in clients:
+        clientobj.reset()
+
+    start_cpu = _cpu_time()
+    start = time()
+
+    func(server, duration)
+
+    # Wait until the bouncer has drained its queues, i.e. until the
+    # clients haven't received anything for a second.
+    idle_rounds = 0
+
+    while idle_rounds < 5:
+        lines = sum([clientobj.lines_received for clientobj in clients])
+        gevent.sleep(0.2)
+
+        if sum([clientobj.lines_received for clientobj in clients]) == lines:
+            idle_rounds += 1
+        else:
+            idle_rounds = 0
+
+    elapsed = time() - start - idle_rounds * 0.2
+    cpu = _cpu_time() - start_cpu
+
+    lines = sum([clientobj.lines_received for clientobj in clients])
+    latencies = []
+
+    for clientobj in clients:
+        latencies.extend(clientobj.latencies)
+
+    latencies.sort()
+
+    print('%-14s %10.0f lines/s  p50 %7.2fms  p99 %7.2fms  rss %7dkB  cpu %6.2fs' %
+          (name, lines / elapsed, _percentile(latencies, 0.5) * 1000,
+           _percentile(latencies, 0.99) * 1000, _rss_kb(), cpu))
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-u', '--users', dest='users', type='int', default=10,
+                      help='number of bouncer users')
+    parser.add_option('-c', '--clients', dest='clients', type='int', default=1,
+                      help='number of clients per user')
+    parser.add_option('-d', '--duration', dest='duration', type='float', default=5,
+                      help='duration of each profile in seconds')
+    parser.add_option('-p', '--profiles', dest='profiles', default=None,
+                      help='comma-separated list of profiles (default: all)')
+
+    options, _ = parser.parse_args()
+
+    if options.profiles != None:
+        selected = options.profiles.split(',')
+    else:
+        selected = [name for name, _ in profiles]
+
+    server, clients = setup(options.users, options.clients)
+
+    for name, func in profiles:
+        if name in selected:
+            run_profile(name, func, server, clients, options.duration)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+# sbncng - an object-oriented framework for IRC
+# Copyright (C) 2011 Gunnar Beutner
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+Replays capture files through the parser, the event dispatcher and the
+state tracking code, without any sockets.
+
+Usage (from the src directory):
+    python -m benchmarks.replay [-s speed] [-p profile.out] capture.cap ...
+"""
+
+import sys
+from optparse import OptionParser
+from sbnc.irc import IRCConnection, ClientConnection
+from sbnc.capture import Replayer, read_capture, TYPE_IRC
+
+def replay(path, speed=None):
+    type, _ = read_capture(path)
+
+    if type == TYPE_IRC:
+        connobj = IRCConnection(address=('replay', 0))
+    else:
+        connobj = ClientConnection(address=('127.0.0.1', 0), socket=None)
+
+    replayer = Replayer(connobj, path, speed)
+    elapsed = replayer.run()
+
+    if elapsed > 0:
+        rate = replayer.lines_replayed / elapsed
+    else:
+        rate = 0
+
+    print('%s: %d lines in %.3fs (%.0f lines/s), %d lines sent, %d channels' %
+          (path, replayer.lines_replayed, elapsed, rate,
+           replayer.line_writer.lines_sent, len(connobj.channels)))
+
+def main():
+    parser = OptionParser(usage='%prog [options] capture.cap ...')
+    parser.add_option('-s', '--speed', dest='speed', type='float', default=None,
+                      help='replay speed, 1.0 is the original speed (default: as fast as possible)')
+    parser.add_option('-p', '--profile', dest='profile', default=None,
+                      help='write cProfile statistics to this file')
+
+    options, args = parser.parse_args()
+
+    if len(args) == 0:
+        parser.error('no capture files specified')
+
+    if options.profile != None:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    for path in args:
+        replay(path, options.speed)
+
+    if options.profile != None:
+        profiler.disable()
+        profiler.dump_stats(options.profile)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
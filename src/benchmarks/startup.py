@@ -0,0 +1,121 @@
+# sbncng - an object-oriented framework for IRC
+# Copyright (C) 2011 Gunnar Beutner
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+Startup benchmark. Fills a database with lots of users and measures how long
+it takes to load the directory, create the ProxyUser objects and load the
+plugins.
+
+Usage (from the src directory):
+    python -m benchmarks.startup [-u users] [--no-preload] [database]
+"""
+
+import os
+import sys
+import resource
+import tempfile
+from time import time
+from optparse import OptionParser
+from sbnc.plugin import ServiceRegistry, PluginManager
+from sbnc.directory import DirectoryService
+from sbnc.proxy import Proxy
+
+def populate(dsn, user_count):
+    """Creates the specified number of users with a typical set of attributes."""
+
+    dir_svc = ServiceRegistry.get(DirectoryService.package)
+    dir_svc.start(dsn)
+
+    users_node = dir_svc.get_root_node()[Proxy.package]['users']
+
+    # Going through the Node objects would take longer than the actual
+    # benchmark, so the rows are inserted in bulk.
+    entries = []
+
+    for index in range(user_count):
+        attributes = {'password': 'bench', 'nick': 'bench%d' % (index),
+                      'server_address': None, 'admin': False}
+
+        entries.append(('bench%d' % (index), {}, [(Proxy.package, attributes, [])]))
+
+    dir_svc.bulk_create(users_node, entries)
+
+def _rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def main():
+    parser = OptionParser(usage='%prog [options] [database]')
+    parser.add_option('-u', '--users', dest='users', type='int', default=10000,
+                      help='number of users to create when the database is new')
+    parser.add_option('--no-preload', dest='preload', action='store_false', default=True,
+                      help='load users one at a time instead of preloading the directory')
+
+    options, args = parser.parse_args()
+
+    if len(args) > 0:
+        path = args[0]
+    else:
+        path = os.path.join(tempfile.gettempdir(), 'sbncng-startup-%d.db' % (options.users))
+
+    dsn = 'sqlite:///' + path
+
+    if not os.path.exists(path):
+        start = time()
+        populate(dsn, options.users)
+        print('created %d users in %.3fs' % (options.users, time() - start))
+
+    dir_svc = ServiceRegistry.get(DirectoryService.package)
+
+    # Starting the service again gives us a fresh session
+    # without any cached objects.
+    start = time()
+    dir_svc.start(dsn)
+
+    if options.preload:
+        dir_svc.preload()
+
+    preloaded = time()
+
+    proxy_svc = ServiceRegistry.get(Proxy.package)
+
+    with dir_svc.batch():
+        proxy_svc.start(dir_svc.get_root_node())
+
+    users_loaded = time()
+
+    with dir_svc.batch():
+        ServiceRegistry.get(PluginManager.package).load_all()
+
+    plugins_loaded = time()
+
+    # Steady state: the caches have to survive the commits above.
+    for userobj in proxy_svc.users.values():
+        userobj._config.lookup('nick')
+        userobj._config.children
+
+    looked_up = time()
+
+    print('%d users: directory %.3fs, users %.3fs, plugins %.3fs, total %.3fs, ' \
+          'lookups %.3fs, rss %dkB' %
+          (len(proxy_svc.users), preloaded - start, users_loaded - preloaded,
+           plugins_loaded - users_loaded, plugins_loaded - start,
+           looked_up - plugins_loaded, _rss_kb()))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+# sbncng - an object-oriented framework for IRC
+# Copyright (C) 2011 Gunnar Beutner
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+Measures TLS handshakes per second against a local listener, with and
+without session resumption.
+
+Usage (from the src directory):
+    python -m benchmarks.tls_handshake -c cert.pem [-k key.pem] [-n 500]
+"""
+
+import sys
+from time import time
+from optparse import OptionParser
+import gevent
+from gevent import socket
+from sbnc.tls import TLSContext
+
+def _serve(listen_sock, server_context):
+    while True:
+        sock, _ = listen_sock.accept()
+        gevent.spawn(_handshake_and_close, sock, server_context)
+
+def _handshake_and_close(sock, server_context):
+    try:
+        sslsock = server_context.wrap(sock)
+        sslsock.sendall('\n')
+        sslsock.close()
+    except Exception:
+        sock.close()
+
+def run(address, count, client_context, resume):
+    start = time()
+
+    for _ in range(count):
+        if not resume:
+            client_context.clear_sessions()
+
+        sock = socket.create_connection(address)
+        sslsock = client_context.wrap(sock, address)
+
+        # Wait for the server's line so that TLS 1.3 session tickets
+        # have arrived before we store the session.
+        sslsock.recv(1)
+        client_context.remember_session(sslsock, address)
+        sslsock.close()
+
+    return count / (time() - start)
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-c', '--certfile', dest='certfile', help='server certificate (PEM)')
+    parser.add_option('-k', '--keyfile', dest='keyfile', default=None, help='server key (PEM)')
+    parser.add_option('-n', '--count', dest='count', type='int', default=500,
+                      help='number of handshakes per run')
+
+    options, _ = parser.parse_args()
+
+    if options.certfile == None:
+        parser.error('a certificate is required')
+
+    server_context = TLSContext(server_side=True, certfile=options.certfile,
+                                keyfile=options.keyfile)
+
+    listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_sock.bind(('127.0.0.1', 0))
+    listen_sock.listen(128)
+    address = listen_sock.getsockname()
+
+    gevent.spawn(_serve, listen_sock, server_context)
+
+    for resume in [False, True]:
+        client_context = TLSContext()
+        rate = run(address, options.count, client_context, resume)
+
+        print('resumption %-3s: %8.1f handshakes/s (%d of %d resumed)' %
+              (resume and 'on' or 'off', rate, client_context.resumed_handshakes,
+               client_context.handshakes))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,12 +17,17 @@
 
 import string
 import random
+import gevent
+from time import time
 from sbnc.proxy import Proxy
-from sbnc.plugin import Plugin, ServiceRegistry
+from sbnc import provision
+from sbnc.plugin import Plugin, ServiceRegistry, PluginManager
+from sbnc.event import Event, EventProfiler
 from plugins.ui import UIPlugin, UIAccessCheck
 
 proxy_svc = ServiceRegistry.get(Proxy.package)
 ui_svc = ServiceRegistry.get(UIPlugin.package)
+plugin_svc = ServiceRegistry.get(PluginManager.package)
 
 class AdminCommandPlugin(Plugin):
     """Implements basic admin commands."""
@@ -30,6 +35,7 @@ class AdminCommandPlugin(Plugin):
     package = 'info.shroudbnc.plugins.admincmd'
     name = "AdminCmd"
     description = __doc__
+    unloadable = True
 
     def __init__(self):
         ui_svc.register_command('adduser', self._cmd_adduser_handler, 'Admin', 'creates a new user',
@@ -37,11 +43,26 @@ class AdminCommandPlugin(Plugin):
         ui_svc.register_command('admin', self._cmd_admin_handler, 'Admin', 'gives someone admin privileges',
                                 'Syntax: admin <username>\nGives admin privileges to a user.', UIAccessCheck.admin)
         ui_svc.register_command('broadcast', self._cmd_broadcast_handler, 'Admin', 'sends a global notice to all bouncer users',
-                                'Syntax: broadcast <text>\nSends a notice to all currently connected users.', UIAccessCheck.admin)
+                                'Syntax: broadcast [-admin] [-connected] [-network:<name>] <text>\n' +
+                                'Sends a message to all clients. The options restrict the message to admins, ' +
+                                'users who are connected to IRC or users on a specific network.', UIAccessCheck.admin)
         ui_svc.register_command('deluser', self._cmd_deluser_handler, 'Admin', 'removes a user',
                                 'Syntax: deluser <username>\nDeletes a user.', UIAccessCheck.admin)
         ui_svc.register_command('die', self._cmd_die_handler, 'Admin', 'terminates the bouncer',
                                 'Syntax: die\nTerminates the bouncer.', UIAccessCheck.admin)
+        ui_svc.register_command('importusers', self._cmd_importusers_handler, 'Admin', 'creates users from a file',
+                                'Syntax: importusers <csv|json> <filename>\n' +
+                                'Creates users from a CSV or JSON file on the bouncer\'s host. Each record needs ' +
+                                'a name and a password and may contain the nick, username, realname, ' +
+                                'server_address, server_ssl, server_verify, server_ca_certs, flood_profile ' +
+                                'and admin attributes.', UIAccessCheck.admin)
+        ui_svc.register_command('plugin', self._cmd_plugin_handler, 'Admin', 'loads, unloads and reloads plugins',
+                                'Syntax: plugin <list|load|unload|reload> [name]\n' +
+                                'Manages plugins. Reloading a plugin doesn\'t affect any connections.', UIAccessCheck.admin)
+        ui_svc.register_command('profile', self._cmd_profile_handler, 'Admin', 'profiles event handlers',
+                                'Syntax: profile <on [threshold ms]|off|reset|report [count]>\n' +
+                                'Records how much time each event handler takes. Handlers which take ' +
+                                'longer than the threshold (default: 50ms) are logged.', UIAccessCheck.admin)
         ui_svc.register_command('resetpass', self._cmd_resetpass_handler, 'Admin', 'sets a user\'s password',
                                 'Syntax: resetpass <user> <password>\nResets another user\'s password.', UIAccessCheck.admin)
         ui_svc.register_command('simul', self._cmd_simul_handler, 'Admin', 'simulates a command on another user\'s connection',
@@ -53,8 +74,11 @@ class AdminCommandPlugin(Plugin):
         ui_svc.register_command('unsuspend', self._cmd_unsuspend_handler, 'Admin', 'unsuspends a user',
                                 'Syntax: unsuspend <username>\nRemoves a suspension from the specified account.', UIAccessCheck.admin)
         ui_svc.register_command('who', self._cmd_who_handler, 'Admin', 'shows users',
-                                'Syntax: who\nShows a list of all users.', UIAccessCheck.admin)
-    
+                                'Syntax: who [filter ...] [sort:<name|idle|network>] [page:<n>]\n' +
+                                'Shows a list of users. Filters: connected, disconnected, admin, suspended, ' +
+                                'network:<name>, idle:<minutes>. Users are marked with * (connected), ' +
+                                '@ (admin) and ! (suspended).', UIAccessCheck.admin)
+
     @staticmethod
     def _random_password(length = 12):
         letters = string.ascii_letters + string.digits
@@ -102,21 +126,86 @@ class AdminCommandPlugin(Plugin):
         
         ui_svc.send_sbnc_reply(clientobj, 'Done.', notice)
 
-    def broadcast(self, message):
+    _broadcast_batch_size = 200
+
+    def broadcast(self, message, predicate=None):
+        """
+        Sends a global message to the clients of all users, or of the users
+        for which predicate returns True. The line is only formatted once for
+        each distinct nick, and the bouncer's other greenlets get a turn after
+        every batch of clients. Returns a dictionary with the number of users
+        and clients the message was sent to, the number of distinct lines,
+        the number of clients which still had lines queued and the time the
+        broadcast took.
+        """
+
+        start = time()
+        text = 'Global message: %s' % (message)
+        lines = {}
+
+        stats = {'users': 0, 'clients': 0, 'backlogged': 0}
+
         for userobj in proxy_svc.users.values():
-            for subclientobj in userobj.client_connections:
-                ui_svc.send_sbnc_reply(subclientobj, 'Global message: %s' % (message), notice=False)
+            if len(userobj.client_connections) == 0 or \
+                    (predicate != None and not predicate(userobj)):
+                continue
+
+            stats['users'] += 1
+
+            for clientobj in list(userobj.client_connections):
+                if not clientobj.registered:
+                    continue
+
+                nick = clientobj.me.nick
+
+                try:
+                    line = lines[nick]
+                except KeyError:
+                    line = ui_svc.format_sbnc_reply(nick, text)
+                    lines[nick] = line
+
+                if clientobj.get_queue_length() > 0:
+                    stats['backlogged'] += 1
+
+                clientobj.send_line(line)
+                stats['clients'] += 1
+
+                if stats['clients'] % AdminCommandPlugin._broadcast_batch_size == 0:
+                    gevent.sleep(0)
+
+        stats['lines'] = len(lines)
+        stats['time'] = time() - start
+
+        return stats
 
     def _cmd_broadcast_handler(self, clientobj, params, notice):
+        predicates = []
+
+        while len(params) > 0 and params[0][:1] == '-':
+            option, _, value = params[0][1:].partition(':')
+            option = option.lower()
+
+            if option in ['admin', 'connected'] and value == '':
+                predicates.append(AdminCommandPlugin._who_filters[option])
+            elif option == 'network' and value != '':
+                predicates.append(lambda userobj, network=value.lower(): \
+                                  (userobj.get_network() or '').lower() == network)
+            else:
+                break
+
+            params = params[1:]
+
         if len(params) < 1:
-            ui_svc.send_sbnc_reply(clientobj, 'Syntax: broadcast <text>', notice)
+            ui_svc.send_sbnc_reply(clientobj, 'Syntax: broadcast [-admin] [-connected] [-network:<name>] <text>', notice)
             return
-        
-        self.broadcast(' '.join(params))       
-        
-        ui_svc.send_sbnc_reply(clientobj, 'Done.', notice)
-        
-        pass
+
+        stats = self.broadcast(' '.join(params),
+                               lambda userobj: all([predicate(userobj) for predicate in predicates]))
+
+        ui_svc.send_sbnc_reply(clientobj, 'Done. Sent to %d clients of %d users in %.3fs ' %
+                               (stats['clients'], stats['users'], stats['time']) +
+                               '(%d distinct lines, %d clients had a backlog).' %
+                               (stats['lines'], stats['backlogged']), notice)
         
     def _cmd_deluser_handler(self, clientobj, params, notice):
         if len(params) < 1:
@@ -136,6 +225,144 @@ class AdminCommandPlugin(Plugin):
     def _cmd_die_handler(self, clientobj, params, notice):
         # TODO: implement
         pass
+
+    def _cmd_importusers_handler(self, clientobj, params, notice):
+        if len(params) < 2 or not params[0].lower() in ['csv', 'json']:
+            ui_svc.send_sbnc_reply(clientobj, 'Syntax: importusers <csv|json> <filename>', notice)
+            return
+
+        try:
+            stream = open(' '.join(params[1:]), 'rb')
+        except IOError as exc:
+            ui_svc.send_sbnc_reply(clientobj, 'Could not open the file: %s' % (exc), notice)
+            return
+
+        def progress(count, errors):
+            # Don't flood the client if the whole file is broken.
+            for error in errors[:5]:
+                ui_svc.send_sbnc_reply(clientobj, 'Skipped: %s' % (error), notice)
+
+            if len(errors) > 5:
+                ui_svc.send_sbnc_reply(clientobj, 'Skipped %d more records.' % (len(errors) - 5), notice)
+
+            ui_svc.send_sbnc_reply(clientobj, '%d users imported so far.' % (count), notice)
+
+        try:
+            # Small batches, so the other connections don't have to wait long
+            # for each batch to be written.
+            count = proxy_svc.import_users(provision.read_users(stream, params[0].lower()),
+                                           batch_size=100, progress=progress)
+        except ValueError as exc:
+            ui_svc.send_sbnc_reply(clientobj, 'Import failed: %s' % (exc), notice)
+            return
+        finally:
+            stream.close()
+
+        ui_svc.send_sbnc_reply(clientobj, 'Done. %d users were imported.' % (count), notice)
+
+    def _cmd_plugin_handler(self, clientobj, params, notice):
+        if len(params) < 1 or (params[0].lower() != 'list' and len(params) < 2):
+            ui_svc.send_sbnc_reply(clientobj, 'Syntax: plugin <list|load|unload|reload> [name]', notice)
+            return
+
+        subcommand = params[0].lower()
+
+        if subcommand == 'list':
+            for name in sorted(plugin_svc.available):
+                if name in plugin_svc.loaded:
+                    status = 'loaded'
+                else:
+                    status = 'not loaded'
+
+                ui_svc.send_sbnc_reply(clientobj, '%s (%s): %s' % (name, plugin_svc.available[name], status), notice)
+
+            ui_svc.send_sbnc_reply(clientobj, 'End of PLUGINS.', notice)
+            return
+
+        name = params[1]
+
+        if not name in plugin_svc.available:
+            ui_svc.send_sbnc_reply(clientobj, 'There is no such plugin.', notice)
+            return
+
+        try:
+            if subcommand == 'load':
+                plugin_svc.load(name)
+                result = True
+            elif subcommand == 'unload':
+                if not name in plugin_svc.loaded:
+                    ui_svc.send_sbnc_reply(clientobj, 'The plugin is not loaded.', notice)
+                    return
+
+                result = plugin_svc.unload(name)
+            elif subcommand == 'reload':
+                result = plugin_svc.reload(name)
+            else:
+                ui_svc.send_sbnc_reply(clientobj, 'Syntax: plugin <list|load|unload|reload> [name]', notice)
+                return
+        except Exception as exc:
+            ui_svc.send_sbnc_reply(clientobj, 'Failed to %s the plugin: %s' % (subcommand, exc), notice)
+            return
+
+        if result:
+            ui_svc.send_sbnc_reply(clientobj, 'Done.', notice)
+        else:
+            ui_svc.send_sbnc_reply(clientobj, 'The plugin can\'t be unloaded.', notice)
+
+    def _cmd_profile_handler(self, clientobj, params, notice):
+        if len(params) < 1:
+            ui_svc.send_sbnc_reply(clientobj, 'Syntax: profile <on [threshold ms]|off|reset|report [count]>', notice)
+            return
+
+        subcommand = params[0].lower()
+
+        if subcommand == 'on':
+            threshold = 50
+
+            if len(params) >= 2:
+                try:
+                    threshold = float(params[1])
+                except ValueError:
+                    ui_svc.send_sbnc_reply(clientobj, 'The threshold must be a number.', notice)
+                    return
+
+            if Event.profiler == None:
+                Event.profiler = EventProfiler()
+
+            Event.profiler.threshold = threshold / 1000.0
+
+            ui_svc.send_sbnc_reply(clientobj, 'Done.', notice)
+        elif subcommand == 'off':
+            Event.profiler = None
+
+            ui_svc.send_sbnc_reply(clientobj, 'Done.', notice)
+        elif subcommand == 'reset':
+            if Event.profiler != None:
+                Event.profiler.reset()
+
+            ui_svc.send_sbnc_reply(clientobj, 'Done.', notice)
+        elif subcommand == 'report':
+            if Event.profiler == None:
+                ui_svc.send_sbnc_reply(clientobj, 'Profiling is not enabled. Use \'profile on\' first.', notice)
+                return
+
+            count = 20
+
+            if len(params) >= 2:
+                try:
+                    count = int(params[1])
+                except ValueError:
+                    pass
+
+            for event_name, handler_name, phase, calls, total, maximum, slow_calls in \
+                    Event.profiler.get_report()[:count]:
+                ui_svc.send_sbnc_reply(clientobj, '%s (%s, %s): %d calls, %.3fs total, %.3fms avg, %.3fms max, %d slow' %
+                                       (handler_name, event_name, phase, calls, total,
+                                        total / calls * 1000, maximum * 1000, slow_calls), notice)
+
+            ui_svc.send_sbnc_reply(clientobj, 'End of PROFILE.', notice)
+        else:
+            ui_svc.send_sbnc_reply(clientobj, 'Syntax: profile <on [threshold ms]|off|reset|report [count]>', notice)
         
     def _cmd_resetpass_handler(self, clientobj, params, notice):
         if len(params) < 1:
@@ -206,9 +433,101 @@ class AdminCommandPlugin(Plugin):
         
         pass
         
+    _who_filters = {
+        'connected': lambda userobj: userobj.irc_connection != None and userobj.irc_connection.registered,
+        'disconnected': lambda userobj: userobj.irc_connection == None or not userobj.irc_connection.registered,
+        'admin': lambda userobj: userobj.admin,
+        'suspended': lambda userobj: userobj.suspended
+    }
+
+    _who_sort_keys = {
+        'name': lambda userobj: userobj.name.lower(),
+        'idle': lambda userobj: userobj.get_idle_time(),
+        'network': lambda userobj: ((userobj.get_network() or '').lower(), userobj.name.lower())
+    }
+
+    _who_page_size = 50
+
+    _who_chunk_size = 10
+
+    @staticmethod
+    def _format_idle_time(seconds):
+        minutes = int(seconds) / 60
+
+        if minutes >= 24 * 60:
+            return '%dd %dh' % (minutes / (24 * 60), minutes / 60 % 24)
+        elif minutes >= 60:
+            return '%dh %dm' % (minutes / 60, minutes % 60)
+        else:
+            return '%dm' % (minutes)
+
+    @staticmethod
+    def _format_who_line(userobj):
+        flags = ''
+
+        if AdminCommandPlugin._who_filters['connected'](userobj):
+            flags += '*'
+            nick = userobj.irc_connection.me.nick
+        else:
+            nick = '-'
+
+        if userobj.admin:
+            flags += '@'
+
+        if userobj.suspended:
+            flags += '!'
+
+        return '%s%s (%s) %s idle %s' % (flags, userobj.name, nick, userobj.get_network() or '-',
+                                         AdminCommandPlugin._format_idle_time(userobj.get_idle_time()))
+
     def _cmd_who_handler(self, clientobj, params, notice):
-        # TODO: implement
-        
-        pass
+        filters = []
+        sort_key = AdminCommandPlugin._who_sort_keys['name']
+        page = 1
+
+        for param in params:
+            option, _, value = param.partition(':')
+            option = option.lower()
+
+            if option in AdminCommandPlugin._who_filters and value == '':
+                filters.append(AdminCommandPlugin._who_filters[option])
+            elif option == 'network' and value != '':
+                filters.append(lambda userobj, network=value.lower(): \
+                               (userobj.get_network() or '').lower() == network)
+            elif option == 'idle' and value.isdigit():
+                filters.append(lambda userobj, seconds=int(value) * 60: \
+                               userobj.get_idle_time() >= seconds)
+            elif option == 'sort' and value.lower() in AdminCommandPlugin._who_sort_keys:
+                sort_key = AdminCommandPlugin._who_sort_keys[value.lower()]
+            elif option == 'page' and value.isdigit() and int(value) > 0:
+                page = int(value)
+            else:
+                ui_svc.send_sbnc_reply(clientobj, 'Syntax: who [filter ...] [sort:<name|idle|network>] [page:<n>]', notice)
+                return
+
+        users = [userobj for userobj in proxy_svc.users.values()
+                 if all([predicate(userobj) for predicate in filters])]
+        users.sort(key=sort_key)
+
+        page_size = AdminCommandPlugin._who_page_size
+        pages = max(1, (len(users) + page_size - 1) / page_size)
+        page = min(page, pages)
+
+        lines = [AdminCommandPlugin._format_who_line(userobj)
+                 for userobj in users[(page - 1) * page_size:page * page_size]]
+        lines.append('End of USERS. Page %d of %d, %d matching users.' % (page, pages, len(users)))
+
+        chunk_size = AdminCommandPlugin._who_chunk_size
+
+        for index in range(0, len(lines), chunk_size):
+            # Don't queue more than the client is able to take.
+            while clientobj.get_queue_length() > 1:
+                if not clientobj in clientobj.owner.client_connections:
+                    return
+
+                gevent.sleep(0.1)
+
+            ui_svc.send_sbnc_replies(clientobj, lines[index:index + chunk_size], notice)
+            gevent.sleep(0)
 
 ServiceRegistry.register(AdminCommandPlugin)
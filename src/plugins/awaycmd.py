@@ -27,6 +27,7 @@ class AwayCommandPlugin(Plugin):
     package = 'info.shroudbnc.plugins.awaycmd'
     name = 'awaycmd'
     description = __doc__
+    unloadable = True
 
     def __init__(self):
         proxy_svc.client_registration_event.add_listener(self._client_registration_handler,
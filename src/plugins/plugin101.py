@@ -28,6 +28,7 @@ class TestPlugin(Plugin):
     package = 'info.shroudbnc.plugins.plugin101'
     name = 'Test Plugin 101'
     description = __doc__
+    unloadable = True
     
     def __init__(self):
         try:
@@ -20,6 +20,7 @@ from datetime import datetime
 from sbnc.plugin import Plugin, ServiceRegistry
 from sbnc.event import Event
 from sbnc.irc import match_command
+from sbnc.utils import parse_server_time, format_server_time
 from sbnc.proxy import Proxy
 from plugins.ui import UIPlugin
 
@@ -32,6 +33,7 @@ class QueryLogPlugin(Plugin):
     package = 'info.shroudbnc.plugins.querylog'
     name = 'querylog'
     description = __doc__
+    unloadable = True
 
     def __init__(self):
         proxy_svc.irc_command_received_event.add_listener(self._irc_privmsg_handler,
@@ -74,8 +76,17 @@ class QueryLogPlugin(Plugin):
         if ircobj.me.nick != target:
             return
                 
+        # Use the server's timestamp if it supports server-time.
+        timestamp = None
+
+        if 'time' in ircobj.message_tags:
+            timestamp = parse_server_time(ircobj.message_tags['time'])
+
+        if timestamp == None:
+            timestamp = time()
+
         item = {
-            'timestamp': time(),
+            'timestamp': timestamp,
             'source': str(nickobj),
             'text': text
         }
@@ -96,11 +107,20 @@ class QueryLogPlugin(Plugin):
             ui_svc.send_sbnc_reply(clientobj, 'Your personal log is empty.', notice)
             return
         
+        server_time = 'server-time' in clientobj.caps
+
         for message_node in messages:
             message = message_node.value
+
+            # Clients which support server-time show the original timestamp.
+            if server_time:
+                tags = {'time': format_server_time(message['timestamp'])}
+            else:
+                tags = None
+
             ui_svc.send_sbnc_reply(clientobj, '[%s] %s: %s' %
                                    (datetime.utcfromtimestamp(message['timestamp']),
-                                   message['source'], message['text']), notice)
+                                   message['source'], message['text']), notice, tags)
             
         if notice:
             erasecmd = '/sbnc erase'
@@ -0,0 +1,91 @@
+# sbncng - an object-oriented framework for IRC
+# Copyright (C) 2011 Gunnar Beutner
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+from sbnc.plugin import Plugin, ServiceRegistry
+from sbnc.proxy import Proxy
+from sbnc.metrics import MetricsService
+from plugins.ui import UIPlugin
+
+proxy_svc = ServiceRegistry.get(Proxy.package)
+ui_svc = ServiceRegistry.get(UIPlugin.package)
+metrics_svc = ServiceRegistry.get(MetricsService.package)
+
+class StatsCommandPlugin(Plugin):
+    """Provides the 'stats' command which shows traffic and latency statistics."""
+
+    package = 'info.shroudbnc.plugins.statscmd'
+    name = 'statscmd'
+    description = __doc__
+    unloadable = True
+
+    def __init__(self):
+        ui_svc.register_command('stats', self._cmd_stats_handler, 'User', 'shows traffic statistics',
+                                'Syntax: stats\nShows traffic statistics for your connections. ' +
+                                'Admins also get global statistics.')
+
+    @staticmethod
+    def _format_connection(name, connobj):
+        return '%s: %d lines/%d bytes in, %d lines/%d bytes out, %d queued' % \
+            (name, connobj.lines_received, connobj.bytes_received,
+             connobj.lines_sent, connobj.bytes_sent, connobj.get_queue_length())
+
+    def _cmd_stats_handler(self, clientobj, params, notice):
+        userobj = clientobj.owner
+
+        if userobj.irc_connection != None:
+            ui_svc.send_sbnc_reply(clientobj, self._format_connection('IRC', userobj.irc_connection), notice)
+        else:
+            ui_svc.send_sbnc_reply(clientobj, 'IRC: not connected', notice)
+
+        for index, subclientobj in enumerate(userobj.client_connections):
+            ui_svc.send_sbnc_reply(clientobj, self._format_connection('Client %d' % (index + 1),
+                                                                      subclientobj), notice)
+
+        ui_svc.send_sbnc_reply(clientobj, 'Reconnects: %d' % (userobj.reconnect_count), notice)
+
+        if userobj.admin:
+            self._send_global_stats(clientobj, notice)
+
+        ui_svc.send_sbnc_reply(clientobj, 'End of STATS.', notice)
+
+    def _send_global_stats(self, clientobj, notice):
+        ui_svc.send_sbnc_reply(clientobj, '--', notice)
+
+        for name, labels, value in metrics_svc.get_samples():
+            if len(labels) > 0:
+                continue
+
+            ui_svc.send_sbnc_reply(clientobj, '%s: %s' % (name, value), notice)
+
+        dispatch_time = metrics_svc.get('sbnc_dispatch_seconds')
+        commands = []
+
+        for command, histogram in dispatch_time.get_children().items():
+            if histogram.count > 0:
+                commands.append((histogram.sum, command, histogram.count))
+
+        commands.sort(reverse=True)
+
+        if len(commands) > 0:
+            ui_svc.send_sbnc_reply(clientobj, '--', notice)
+            ui_svc.send_sbnc_reply(clientobj, 'Dispatch time by command (top 10):', notice)
+
+        for total, command, count in commands[:10]:
+            ui_svc.send_sbnc_reply(clientobj, '%s: %d calls, %.3fms avg, %.3fs total' %
+                                   (command, count, total / count * 1000, total), notice)
+
+ServiceRegistry.register(StatsCommandPlugin)
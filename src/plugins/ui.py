@@ -15,11 +15,12 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
-from sbnc.plugin import Plugin, ServiceRegistry
+from sbnc.plugin import Plugin, ServiceRegistry, PluginManager
 from sbnc.proxy import Proxy
 from sbnc.utils import parse_irc_message
 from sbnc.event import Event
 from sbnc.irc import match_command
+from sbnc.utils import format_irc_message
 
 class UIAccessCheck(object):
     """Helper functions for checking users' access."""
@@ -37,6 +38,115 @@ class UIAccessCheck(object):
         return clientobj.owner.admin
 
 proxy_svc = ServiceRegistry.get(Proxy.package)
+plugin_svc = ServiceRegistry.get(PluginManager.package)
+
+class CommandRegistry(object):
+    """
+    Keeps track of the commands for the UI plugin. The sorted category index
+    and the rendered help text are cached and rebuilt only when commands are
+    registered or unregistered.
+    """
+
+    def __init__(self):
+        self._commands = {}
+        self._index = None
+        self._access_checks = None
+        self._help_cache = {}
+
+    def register(self, name, cmdobj):
+        self._commands[name] = cmdobj
+        self._invalidate()
+
+    def unregister(self, name):
+        del self._commands[name]
+        self._invalidate()
+
+    def unregister_module(self, module_name):
+        """Removes all commands whose callbacks were defined in the specified module."""
+
+        names = [name for name, cmdobj in self._commands.items()
+                 if getattr(cmdobj['callback'], '__module__', None) == module_name]
+
+        for name in names:
+            del self._commands[name]
+
+        if len(names) > 0:
+            self._invalidate()
+
+    def _invalidate(self):
+        self._index = None
+        self._access_checks = None
+        self._help_cache = {}
+
+    def __contains__(self, name):
+        return name in self._commands
+
+    def __getitem__(self, name):
+        return self._commands[name]
+
+    def items(self):
+        return self._commands.items()
+
+    def _get_index(self):
+        """Returns a list of (category, [(command, cmdobj), ...]) tuples, sorted by name."""
+
+        if self._index == None:
+            categories = {}
+
+            for command, cmdobj in self._commands.items():
+                if not cmdobj['category'] in categories:
+                    categories[cmdobj['category']] = []
+
+                categories[cmdobj['category']].append((command, cmdobj))
+
+            self._index = [(category, sorted(categories[category]))
+                           for category in sorted(categories)]
+
+        return self._index
+
+    def get_access_key(self, clientobj):
+        """
+        Returns a key which identifies the set of access checks the client
+        passes. Each distinct check is only evaluated once.
+        """
+
+        if self._access_checks == None:
+            checks = set([cmdobj['access_check'] for cmdobj in self._commands.values()])
+            self._access_checks = list(checks)
+
+        return frozenset([check for check in self._access_checks if check(clientobj)])
+
+    def get_help_lines(self, clientobj):
+        """Returns the lines of the command overview for the specified client."""
+
+        key = self.get_access_key(clientobj)
+
+        try:
+            return self._help_cache[key]
+        except KeyError:
+            pass
+
+        lines = ['--The following commands are available to you--',
+                 '--Used as \'/sbnc <command>\', or \'/msg -sbnc <command>\'']
+
+        for category, commands in self._get_index():
+            commands = [(command, cmdobj) for command, cmdobj in commands
+                        if cmdobj['access_check'] in key]
+
+            if len(commands) == 0:
+                continue
+
+            lines.append('--')
+            lines.append(category + ' commands')
+
+            for command, cmdobj in commands:
+                lines.append(command + ' - ' + cmdobj['description'])
+
+        lines.append('End of HELP.')
+
+        self._help_cache[key] = lines
+
+        return lines
 
 class UIPlugin(Plugin):
     """User interface plugin. Provides support for /msg -sBNC <command> and /sbnc <command>"""
@@ -48,9 +158,14 @@ class UIPlugin(Plugin):
     _identity = '-sBNC!bouncer@shroudbnc.info'
 
     def __init__(self):
-        self.commands = {}
+        self.commands = CommandRegistry()
         self.settings = {}
         self.usersettings = {}
+
+        # upper-case nick -> callback, checked for every PRIVMSG a client sends
+        self._service_nicks = {}
+
+        self.register_service_nick('-sBNC', self._sbnc_privmsg_handler)
         
         proxy_svc.client_command_received_event.add_listener(self._client_privmsg_handler,
                                                              Event.Handler,
@@ -63,37 +178,52 @@ class UIPlugin(Plugin):
         self.register_command('help', self._cmd_help_handler, 'User',
                               'displays a list of commands or information about individual commands',
                               'Syntax: help [command]\nDisplays a list of commands or information about individual commands.')
+
+        plugin_svc.plugin_unloaded_event.add_listener(self._plugin_unloaded_handler,
+                                                      Event.PostObserver)
+
+    def _plugin_unloaded_handler(self, evt, plugin_svc, module_name):
+        """Drops the commands and service nicks of plugins which were unloaded."""
+
+        self.commands.unregister_module(module_name)
+
+        for nick, callback in self._service_nicks.items():
+            if getattr(callback, '__module__', None) == module_name:
+                del self._service_nicks[nick]
         
     def _client_privmsg_handler(self, evt, clientobj, command, nickobj, params):
         """
-        PRIVMSG handler. Checks whether the target is '-sBNC' and passes the command
-        to _handle_command.
+        PRIVMSG handler. Checks whether the target is one of the service nicks
+        (e.g. '-sBNC') and passes the text to the nick's callback.
         """
 
-        if not clientobj.registered or len(params) < 1:
+        if len(params) < 1:
             return Event.Continue
 
-        target = params[0]
-        targetobj = clientobj.get_nick(target)
+        # This runs for every PRIVMSG, so reject other targets before
+        # doing anything expensive like parsing or creating Nick objects.
+        callback = self._service_nicks.get(params[0].upper())
 
-        # TODO: use the nick from _identity
-        if targetobj.nick.upper() != '-SBNC':
+        if callback == None or not clientobj.registered:
             return Event.Continue
 
         if len(params) < 2:
             clientobj.send_message('ERR_NOTEXTTOSEND', prefix=clientobj.server)
             return Event.Handled
 
-        text = params[1]
-        
+        callback(clientobj, params[0], params[1])
+
+        return Event.Handled
+
+    def _sbnc_privmsg_handler(self, clientobj, target, text):
+        """Handles /msg -sBNC <command>."""
+
         tokens = parse_irc_message(text, can_have_prefix=False)
                 
         if not self._handle_command(clientobj, tokens[1], tokens[2], False):
             # TODO: use the nick from _identity
             self.send_sbnc_reply(clientobj, 'Unknown command. Try /msg -sBNC help', notice=False)
     
-        return Event.Handled
-    
     def _client_sbnc_handler(self, evt, clientobj, command, nickobj, params):
         """
         SBNC handler. Checks whether we have enough parameters and passes the command
@@ -124,16 +254,28 @@ class UIPlugin(Plugin):
 
     def register_command(self, name, callback, category, description,
                          help_text, access_check=UIAccessCheck.anyone):
-        self.commands[name] = {
+        self.commands.register(name, {
             'callback': callback,
             'category': category,
             'description': description,
             'help_text': help_text,
             'access_check': access_check
-        }
+        })
     
     def unregister_command(self, name):
-        del self.commands[name]
+        self.commands.unregister(name)
+
+    def register_service_nick(self, nick, callback):
+        """
+        Registers a virtual nick (like '-sBNC') which clients can send messages
+        to. The callback is invoked as callback(clientobj, target, text) and
+        the messages are not forwarded to the IRC server.
+        """
+
+        self._service_nicks[nick.upper()] = callback
+
+    def unregister_service_nick(self, nick):
+        del self._service_nicks[nick.upper()]
     
     def register_setting(self, name):
         pass
@@ -147,13 +289,34 @@ class UIPlugin(Plugin):
     def unregister_usersetting(self, name):
         pass
 
-    def send_sbnc_reply(self, clientobj, message, notice=False):
+    def send_sbnc_reply(self, clientobj, message, notice=False, tags=None):
+        if notice:
+            type = 'NOTICE'
+        else:
+            type = 'PRIVMSG'
+
+        clientobj.send_message(type, clientobj.me.nick, message, prefix=UIPlugin._identity, tags=tags)
+
+    def send_sbnc_replies(self, clientobj, messages, notice=False):
+        """Sends several replies to the client as a single batch."""
+
+        nick = clientobj.me.nick
+
+        clientobj.send_lines([self.format_sbnc_reply(nick, message, notice)
+                              for message in messages])
+
+    def format_sbnc_reply(self, nick, message, notice=False):
+        """
+        Returns the line send_sbnc_reply() sends to a client with the
+        specified nick, so the same line can be sent to many clients.
+        """
+
         if notice:
             type = 'NOTICE'
         else:
             type = 'PRIVMSG'
 
-        clientobj.send_message(type, clientobj.me.nick, message, prefix=UIPlugin._identity)
+        return format_irc_message(type, nick, message, prefix=UIPlugin._identity)
 
     def _cmd_help_handler(self, clientobj, params, notice):
         if len(params) > 0:
@@ -163,32 +326,8 @@ class UIPlugin(Plugin):
                 self.send_sbnc_reply(clientobj, 'There is no such command.', notice)
                 return
             
-            for line in self.commands[command]['help_text'].split('\n'):
-                self.send_sbnc_reply(clientobj, line, notice)
+            self.send_sbnc_replies(clientobj, self.commands[command]['help_text'].split('\n'), notice)
         else:
-            self.send_sbnc_reply(clientobj, '--The following commands are available to you--', notice)
-            self.send_sbnc_reply(clientobj, '--Used as \'/sbnc <command>\', or \'/msg -sbnc <command>\'', notice)
-            
-            cmds = {}
-            
-            for command, cmdobj in self.commands.items():
-                if not cmdobj['access_check'](clientobj):
-                    continue
-                
-                if not cmdobj['category'] in cmds:
-                    cmds[cmdobj['category']] = {}
-                    
-                cmds[cmdobj['category']][command] = cmdobj
-                
-            for category in sorted(cmds):
-                self.send_sbnc_reply(clientobj, '--', notice)
-                self.send_sbnc_reply(clientobj, category + ' commands', notice)
-                
-                for command in sorted(cmds[category]):
-                    cmdobj = cmds[category][command]
-                    
-                    self.send_sbnc_reply(clientobj, command +  ' - ' + cmdobj['description'], notice)
-                    
-            self.send_sbnc_reply(clientobj, 'End of HELP.', notice)
+            self.send_sbnc_replies(clientobj, self.commands.get_help_lines(clientobj), notice)
 
 ServiceRegistry.register(UIPlugin)
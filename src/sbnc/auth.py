@@ -0,0 +1,227 @@
+# sbncng - an object-oriented framework for IRC
+# Copyright (C) 2011 Gunnar Beutner
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+Password hashing and helpers for authenticating clients.
+
+Passwords are stored as salted PBKDF2-SHA256 hashes in the form
+pbkdf2_sha256$<iterations>$<salt>$<hash> (salt and hash are base64-encoded).
+Hashing is deliberately slow, so it's done in the worker thread pool (see
+sbnc.workers); otherwise every other connection would have to wait for it.
+Passwords which were stored before hashing was introduced are still
+accepted, see needs_rehash().
+"""
+
+import os
+import hmac
+import base64
+import hashlib
+from time import time
+from sbnc import workers
+
+ALGORITHM = 'pbkdf2_sha256'
+
+ITERATIONS = 100000
+"""Number of PBKDF2 iterations for new hashes."""
+
+# A hash for verify_dummy(), created when it's first needed.
+_dummy_hash = None
+
+def _to_str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return value
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+
+def hash_password(password, iterations=ITERATIONS):
+    """Returns a salted hash for the specified password."""
+
+    salt = os.urandom(16)
+    digest = workers.run(_pbkdf2, _to_str(password), salt, iterations)
+
+    return '%s$%d$%s$%s' % (ALGORITHM, iterations, base64.b64encode(salt),
+                            base64.b64encode(digest))
+
+def _parse_hash(stored):
+    """Returns (iterations, salt, digest), or None if stored isn't a hash."""
+
+    tokens = _to_str(stored).split('$')
+
+    if len(tokens) != 4 or tokens[0] != ALGORITHM:
+        return None
+
+    try:
+        return int(tokens[1]), base64.b64decode(tokens[2]), base64.b64decode(tokens[3])
+    except (ValueError, TypeError):
+        return None
+
+def verify_password(stored, password):
+    """Checks a password against a hash returned by hash_password()."""
+
+    if stored == None or password == None:
+        return False
+
+    password = _to_str(password)
+    parsed = _parse_hash(stored)
+
+    if parsed == None:
+        # A plain-text password from an older version.
+        return hmac.compare_digest(_to_str(stored), password)
+
+    iterations, salt, digest = parsed
+
+    return hmac.compare_digest(workers.run(_pbkdf2, password, salt, iterations), digest)
+
+def verify_dummy(password):
+    """
+    Takes as long as verify_password() but always fails. This is used for
+    unknown users, so they can't be told apart from existing users by how
+    long the login takes.
+    """
+
+    global _dummy_hash
+
+    if _dummy_hash == None:
+        _dummy_hash = hash_password(os.urandom(16))
+
+    verify_password(_dummy_hash, password)
+
+    return False
+
+def needs_rehash(stored):
+    """
+    Returns whether the stored password should be replaced by a new hash,
+    i.e. because it isn't hashed at all or uses fewer iterations than new
+    hashes do.
+    """
+
+    parsed = _parse_hash(stored)
+
+    return parsed == None or parsed[0] < ITERATIONS
+
+class CredentialCache(object):
+    """
+    Remembers recently verified passwords for a short time, so clients which
+    reconnect quickly don't have to wait for the password to be hashed again.
+    The passwords themselves aren't kept; entries contain a keyed hash of the
+    password and the stored hash it was verified against, so changing a
+    password invalidates the entry.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+
+        self._key = os.urandom(32)
+        self._entries = {}
+
+    def _digest(self, password):
+        return hmac.new(self._key, _to_str(password), hashlib.sha256).digest()
+
+    def add(self, name, stored, password):
+        self._entries[name] = (stored, self._digest(password), time() + self.ttl)
+
+    def check(self, name, stored, password):
+        """Returns True if the password was verified against the stored hash recently."""
+
+        try:
+            entry_stored, digest, expires = self._entries[name]
+        except KeyError:
+            return False
+
+        if expires < time() or entry_stored != stored:
+            del self._entries[name]
+            return False
+
+        return hmac.compare_digest(self._digest(password), digest)
+
+    def remove(self, name):
+        self._entries.pop(name, None)
+
+    def expire(self):
+        """Removes expired entries."""
+
+        now = time()
+
+        for name, (_, _, expires) in self._entries.items():
+            if expires < now:
+                del self._entries[name]
+
+class FailureTracker(object):
+    """
+    Counts failed logins per IP address. Once an address has failed too
+    often, its logins are rejected without checking the password until no
+    failures have happened for a while, so brute-force attempts don't cost
+    any hashing.
+
+    Logins which are still being checked count as failures as well (see
+    start_attempt()), otherwise an address could start any number of
+    attempts at once before the first one has failed.
+    """
+
+    def __init__(self, max_failures=5, interval=600):
+        self.max_failures = max_failures
+        self.interval = interval
+
+        self._failures = {}
+
+        # address -> number of logins which are being checked
+        self._attempts = {}
+
+    def is_blocked(self, address):
+        count = self._attempts.get(address, 0)
+
+        try:
+            failures, last_failure = self._failures[address]
+        except KeyError:
+            failures = 0
+        else:
+            if last_failure < time() - self.interval:
+                del self._failures[address]
+            else:
+                count += failures
+
+        return count >= self.max_failures
+
+    def start_attempt(self, address):
+        """Must be called before a login is checked and followed by end_attempt()."""
+
+        self._attempts[address] = self._attempts.get(address, 0) + 1
+
+    def end_attempt(self, address):
+        count = self._attempts.pop(address, 0) - 1
+
+        if count > 0:
+            self._attempts[address] = count
+
+    def add_failure(self, address):
+        count, _ = self._failures.get(address, (0, 0))
+        self._failures[address] = (count + 1, time())
+
+    def reset(self, address):
+        self._failures.pop(address, None)
+
+    def expire(self):
+        """Removes addresses which haven't failed for a while."""
+
+        limit = time() - self.interval
+
+        for address, (_, last_failure) in self._failures.items():
+            if last_failure < limit:
+                del self._failures[address]
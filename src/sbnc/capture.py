@@ -0,0 +1,369 @@
+# sbncng - an object-oriented framework for IRC
+# Copyright (C) 2011 Gunnar Beutner
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+Traffic capture and replay.
+
+A capture file starts with an 8-byte magic string and a byte that says
+whether it was recorded on an IRC ('I') or a client ('C') connection. Each
+record consists of a timestamp (double), the direction (byte) and the line
+length (unsigned short), all in network byte order, followed by the line
+itself without the line terminator.
+
+Passwords are replaced with '*' before lines are recorded (see
+redact_line()), so captures which contain logins can't be replayed with
+the original credentials.
+"""
+
+import re
+import struct
+import time
+import gevent
+from gevent import queue
+from sbnc import utils, workers
+from sbnc.timer import Timer
+
+MAGIC = 'SBNCCAP1'
+
+TYPE_IRC = 'I'
+TYPE_CLIENT = 'C'
+
+DIRECTION_IN = 0
+DIRECTION_OUT = 1
+
+_record = struct.Struct('!dBH')
+
+FLUSH_SIZE = 65536
+"""Number of bytes a CaptureWriter buffers before writing them to the file."""
+
+REDACTED = '*'
+
+# Commands whose parameters are credentials, and how many leading
+# parameters (e.g. the name for OPER) can be kept.
+_secret_commands = {'PASS': 0, 'AUTHENTICATE': 0, 'OPER': 1}
+
+# Commands which are sent to NickServ, the first word (e.g. IDENTIFY)
+# is kept.
+_nickserv_commands = frozenset(['NS', 'NICKSERV'])
+
+# Bouncer commands (/sbnc <command> or /msg -sBNC <command>) which take a
+# password, and how many leading words (the command and the user name) can
+# be kept.
+_sbnc_commands = {'adduser': 2, 'resetpass': 2}
+
+# Replies from -sBNC which contain a generated password in quotes.
+_password_reply = re.compile(r"(password\b[^']*')[^']*(')", re.IGNORECASE)
+
+def _redact_words(text, keep):
+    words = text.split(' ', keep)
+
+    if len(words) <= keep:
+        return text
+
+    return ' '.join(words[:keep] + [REDACTED])
+
+def _redact_sbnc_command(text):
+    command = text.split(' ', 1)[0].lower()
+
+    if not command in _sbnc_commands:
+        return text
+
+    return _redact_words(text, _sbnc_commands[command])
+
+def redact_line(line):
+    """
+    Replaces the passwords in a line (e.g. PASS or NickServ IDENTIFY) with '*'.
+
+    >>> redact_line('PASS secret')
+    'PASS *'
+    >>> redact_line('PRIVMSG NickServ :IDENTIFY secret')
+    'PRIVMSG NickServ :IDENTIFY *'
+    >>> redact_line('PRIVMSG -sBNC :adduser bob secret')
+    'PRIVMSG -sBNC :adduser bob *'
+    >>> redact_line('SBNC resetpass bob secret')
+    'SBNC resetpass bob *'
+    >>> redact_line(":-sBNC!bouncer@shroudbnc.info NOTICE admin :Done. The new user's password is 'secret'.")
+    ":-sBNC!bouncer@shroudbnc.info NOTICE admin :Done. The new user's password is '*'."
+    """
+
+    head = ''
+    rest = line
+    source = ''
+
+    if rest[:1] == '@':
+        tags, _, rest = rest.partition(' ')
+        head += tags + ' '
+
+    if rest[:1] == ':':
+        prefix, _, rest = rest.partition(' ')
+        head += prefix + ' '
+        source = prefix[1:].partition('!')[0]
+
+    command, _, params = rest.partition(' ')
+    command_upper = command.upper()
+
+    if command_upper in _secret_commands:
+        # AUTHENTICATE + is part of the SASL handshake, not a credential.
+        if params == '' or params == '+':
+            return line
+
+        return head + command + ' ' + _redact_words(params, _secret_commands[command_upper])
+    elif command_upper in _nickserv_commands:
+        return head + command + ' ' + _redact_words(params.lstrip(':'), 1)
+    elif command_upper == 'SBNC':
+        text = params.lstrip(':')
+        redacted = _redact_sbnc_command(text)
+
+        if redacted == text:
+            return line
+
+        return head + command + ' ' + redacted
+    elif command_upper in ('PRIVMSG', 'NOTICE'):
+        target, _, text = params.partition(' ')
+        target_nick = target.partition('@')[0].lower()
+
+        if source.lower() == '-sbnc':
+            return head + command + ' ' + target + ' ' + _password_reply.sub(r'\1' + REDACTED + r'\2', text)
+        elif target_nick == '-sbnc':
+            text = text.lstrip(':')
+            redacted = _redact_sbnc_command(text)
+
+            if redacted == text:
+                return line
+
+            return head + command + ' ' + target + ' :' + redacted
+        elif target_nick != 'nickserv':
+            return line
+
+        return head + command + ' ' + target + ' :' + _redact_words(text.lstrip(':'), 1)
+
+    return line
+
+class _MonotonicClock(object):
+    """Wall-clock time that never goes backwards."""
+
+    def __init__(self):
+        self._last = 0.0
+
+    def __call__(self):
+        now = time.time()
+
+        if now < self._last:
+            now = self._last
+
+        self._last = now
+        return now
+
+_clock = getattr(time, 'monotonic', None) or _MonotonicClock()
+
+class CaptureWriter(object):
+    """
+    Records the lines of a single connection. Records are buffered and
+    written by a separate greenlet (see sbnc.workers), so recording a line
+    never waits for the disk.
+    """
+
+    def __init__(self, path, type):
+        self.path = path
+        self._file = open(path, 'wb')
+
+        self._buffer = [MAGIC + type]
+        self._buffer_size = len(self._buffer[0])
+
+        self._queue = queue.Queue()
+        self._thread = gevent.spawn(self._run, self._queue)
+
+    def _run(self, write_queue):
+        try:
+            while True:
+                data = write_queue.get()
+
+                if data == None:
+                    break
+
+                workers.run(self._file.write, data)
+        finally:
+            self._file.close()
+
+    def _flush(self):
+        if len(self._buffer) == 0:
+            return
+
+        self._queue.put(''.join(self._buffer))
+
+        self._buffer = []
+        self._buffer_size = 0
+
+    def record(self, direction, line):
+        if self._queue == None:
+            return
+
+        line = redact_line(line.rstrip('\r\n'))[:65535]
+        data = _record.pack(_clock(), direction, len(line)) + line
+
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+
+        if self._buffer_size >= FLUSH_SIZE:
+            self._flush()
+
+    def close(self):
+        if self._queue == None:
+            return
+
+        self._flush()
+        self._queue.put(None)
+        self._queue = None
+
+def read_capture(path):
+    """
+    Reads a capture file. Returns a tuple containing the connection type and
+    a generator which yields (timestamp, direction, line) tuples.
+    """
+
+    capture_file = open(path, 'rb')
+    header = capture_file.read(len(MAGIC) + 1)
+
+    if header[:len(MAGIC)] != MAGIC:
+        capture_file.close()
+        raise ValueError('%s is not a capture file.' % (path))
+
+    def read_records():
+        try:
+            while True:
+                data = capture_file.read(_record.size)
+
+                if len(data) < _record.size:
+                    break
+
+                timestamp, direction, length = _record.unpack(data)
+                yield timestamp, direction, capture_file.read(length)
+        finally:
+            capture_file.close()
+
+    return header[len(MAGIC):], read_records()
+
+class NullLineWriter(object):
+    """Line writer which doesn't need a socket. Used for replaying captures."""
+
+    def __init__(self, keep_lines=False):
+        self.lines = []
+        self.lines_sent = 0
+        self.bytes_sent = 0
+
+        self._keep_lines = keep_lines
+
+    def write_line(self, line):
+        self.lines_sent += 1
+        self.bytes_sent += len(line) + 2
+
+        if self._keep_lines:
+            self.lines.append(line)
+
+    def write_lines(self, lines):
+        for line in lines:
+            self.write_line(line)
+
+    def get_queue_length(self):
+        return 0
+
+    def close(self):
+        pass
+
+class _DirectScheduler(object):
+    """Stands in for the flood scheduler and passes lines straight to the writer."""
+
+    def __init__(self, line_writer):
+        self._line_writer = line_writer
+        self.profile = None
+
+    def enqueue(self, command, params, prefix=None, priority=None):
+        self._line_writer.write_line(utils.format_irc_message(command, prefix=prefix, *params))
+
+    def enqueue_line(self, line, priority=None):
+        self._line_writer.write_line(line)
+
+    def get_queue_length(self):
+        return 0
+
+    def stop(self):
+        pass
+
+class Replayer(object):
+    """
+    Feeds the inbound lines of a capture file through a connection's
+    process_line() without any sockets being involved.
+    """
+
+    def __init__(self, connobj, path, speed=None, keep_output=False):
+        """
+        connobj: An IRCConnection or ClientConnection object which hasn't been
+                 started.
+        path: The capture file.
+        speed: None to replay as fast as possible, 1.0 to replay at the
+               original speed, larger values for accelerated replays.
+        keep_output: Whether to keep the lines the connection sends.
+        """
+
+        self.connobj = connobj
+        self.path = path
+        self.speed = speed
+
+        self.lines_replayed = 0
+
+        self.line_writer = NullLineWriter(keep_output)
+
+        connobj._line_writer = self.line_writer
+
+        if hasattr(connobj, '_scheduler'):
+            connobj._scheduler = _DirectScheduler(self.line_writer)
+
+        # register_user() expects a registration timer, but we don't want
+        # a real one to fire during slow replays.
+        connobj._registration_timeout = Timer(0, lambda: False)
+
+    def run(self):
+        """Replays the capture. Returns the number of seconds it took."""
+
+        _, records = read_capture(self.path)
+
+        start = time.time()
+        first_timestamp = None
+
+        for timestamp, direction, line in records:
+            if first_timestamp == None:
+                first_timestamp = timestamp
+
+            if direction == DIRECTION_OUT:
+                # The connection needs to know which nick it
+                # registered with to make sense of 001.
+                if not self.connobj.registered and line[:5].upper() == 'NICK ' and \
+                        hasattr(self.connobj, 'reg_nickname'):
+                    self.connobj.reg_nickname = line[5:].lstrip(':')
+
+                continue
+
+            if self.speed != None:
+                delay = (timestamp - first_timestamp) / self.speed - (time.time() - start)
+
+                if delay > 0:
+                    gevent.sleep(delay)
+
+            self.connobj.process_line(line)
+            self.lines_replayed += 1
+
+        return time.time() - start
@@ -20,17 +20,47 @@ try:
 except ImportError:
     import simplejson as json
 
+from time import time
 from uuid import uuid4
+from contextlib import contextmanager
 from sqlalchemy import create_engine, Column, Integer, \
-    String, ForeignKey, Index, types, orm
+    String, ForeignKey, Index, types, orm, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, backref, sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.schema import UniqueConstraint
 from sbnc.plugin import Service, ServiceRegistry
+from sbnc.metrics import MetricsService
 
 _ModelBase = declarative_base()
 
+metrics_svc = ServiceRegistry.get(MetricsService.package)
+
+_query_time = metrics_svc.histogram('sbnc_directory_query_seconds',
+                                    'Time spent in directory operations.', label='operation')
+
+def _timed(operation):
+    """Records how long the decorated directory operation takes."""
+
+    histogram = _query_time.labels(operation)
+
+    def decorator(func):
+        def timed_helper(*args, **kwargs):
+            start = time()
+
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time() - start)
+
+        timed_helper.__name__ = func.__name__
+        timed_helper.__doc__ = func.__doc__
+
+        return timed_helper
+
+    return decorator
+
 class _JSONString(types.TypeDecorator):
     """Converts arbitrary Python objects to/from JSON."""
 
@@ -97,58 +127,145 @@ class Node(_ModelBase):
         self.name = name
         
         self.init_on_load()
+
+        # A new node doesn't have any children or attributes yet.
+        self._child_cache = {}
+        self._attribute_cache = {}
         
     @orm.reconstructor
     def init_on_load(self):
         dir_svc = ServiceRegistry.get(DirectoryService.package)
         self._session = dir_svc.get_session()
 
+        # Filled in by DirectoryService.preload(), None means that
+        # lookups have to go to the database.
+        self._child_cache = None
+        self._attribute_cache = None
+
+    def _commit(self):
+        dir_svc = ServiceRegistry.get(DirectoryService.package)
+        dir_svc.commit()
+
+    @_timed('getitem')
     def __getitem__(self, name):
         """Retrieves the specified child node."""
         
         if not isinstance(name, basestring):
             return self.children[name]
 
-        try:
-            node = self._session.query(Node).filter_by(name=name, parent=self).one()
-        except NoResultFound:
-            node = Node(name, parent=self)
-            self._session.add(node)
-            self._session.commit()
+        if self._child_cache != None:
+            try:
+                return self._child_cache[name]
+            except KeyError:
+                pass
+        else:
+            try:
+                return self._session.query(Node).filter_by(name=name, parent=self).one()
+            except NoResultFound:
+                pass
+
+        node = Node(name, parent=self)
+        self._session.add(node)
+        self._commit()
+
+        if self._child_cache != None:
+            self._child_cache[name] = node
 
         return node
 
+    @_timed('delitem')
     def __delitem__(self, name):
         """Removes the specified child node."""
 
         self._session.query(Node).filter_by(name=name, parent=self).delete()
-        self._session.commit()
+        self._commit()
+
+        if self._child_cache != None:
+            self._child_cache.pop(name, None)
+
+        self._remove_loaded('children', lambda node: node.name == name)
+
+    def _remove_loaded(self, relation, predicate):
+        """
+        Removes the items matching predicate from a relationship if it has
+        been loaded. The bulk deletes bypass the session, and objects aren't
+        expired on commit, so loaded relationships would still contain them.
+        """
 
+        if not relation in self.__dict__:
+            return
+
+        set_committed_value(self, relation, [item for item in getattr(self, relation)
+                                             if not predicate(item)])
+
+    def _get_attribute(self, key):
+        if self._attribute_cache != None:
+            return self._attribute_cache.get(key)
+
+        try:
+            return self._session.query(Attribute).filter_by(node=self, key=key).one()
+        except NoResultFound:
+            return None
+
+    @_timed('get')
     def get(self, key, default_value):
         """Retrieves the value associated with the specified attribute."""
 
-        try:
-            attrib = self._session.query(Attribute).filter_by(node=self, key=key).one()
+        attrib = self._get_attribute(key)
+
+        if attrib != None:
             return attrib.value
-        except NoResultFound:
-            self.set(key, default_value)
-            return default_value
 
+        # Not self.set(), that would be timed as a separate operation.
+        self._set(key, default_value)
+        return default_value
+
+    @_timed('get')
+    def lookup(self, key, default_value=None):
+        """
+        Retrieves the value associated with the specified attribute. Unlike
+        get() this doesn't store the default value if there's no such
+        attribute.
+        """
+
+        attrib = self._get_attribute(key)
+
+        if attrib != None:
+            return attrib.value
+
+        return default_value
+
+    @_timed('set')
     def set(self, key, value):
         """Sets an attribute."""
 
-        try:
-            attrib = self._session.query(Attribute).filter_by(node=self, key=key).one()
-        except NoResultFound:
+        self._set(key, value)
+
+    def _set(self, key, value):
+        attrib = self._get_attribute(key)
+
+        if attrib == None:
             attrib = Attribute(self, key, value)
             self._session.add(attrib)
-            self._session.commit()
+            self._commit()
 
+            if self._attribute_cache != None:
+                self._attribute_cache[key] = attrib
+        else:
+            attrib.value = value
+            self._commit()
+
+    @_timed('unset')
     def unset(self, key):
         """Removes the specified attribute."""
 
         self._session.query(Attribute).filter_by(node=self, key=key).delete()
 
+        if self._attribute_cache != None:
+            self._attribute_cache.pop(key, None)
+
+        self._remove_loaded('attributes', lambda attrib: attrib.key == key)
+
     def append(self, value):
         """Creates a new attribute using a randomly generated key and the specified value."""
 
@@ -157,11 +274,17 @@ class Node(_ModelBase):
 
         return key
 
+    @_timed('clear')
     def clear(self):
         """Removes all attributes."""
 
         self._session.query(Attribute).filter_by(node=self).delete()
-        self._session.commit()
+        self._commit()
+
+        if self._attribute_cache != None:
+            self._attribute_cache.clear()
+
+        self._remove_loaded('attributes', lambda attrib: True)
 
     def __repr__(self):
         return "<node name %s, parent %s>" % \
@@ -175,6 +298,7 @@ class DirectoryService(Service):
     
     def __init__(self):
         self._session = None
+        self._batch_depth = 0
     
     def start(self, dsn, debug=False):
         """Initializes a database connection for the specified connection string."""
@@ -184,7 +308,10 @@ class DirectoryService(Service):
         metadata = _ModelBase.metadata
         metadata.create_all(engine)
     
-        SessionClass = sessionmaker(bind=engine)
+        # Nothing else writes to the database, so the objects don't have to
+        # be reloaded after a commit. Expiring them would also throw away
+        # everything preload() put into the caches.
+        SessionClass = sessionmaker(bind=engine, expire_on_commit=False)
     
         self._session = SessionClass()
     
@@ -198,6 +325,134 @@ class DirectoryService(Service):
     
     def get_session(self):
         return self._session
+
+    @_timed('preload')
+    def preload(self):
+        """
+        Loads the whole tree with one query for the nodes and one for the
+        attributes. Afterwards child and attribute lookups are answered from
+        memory, which makes a difference when there are thousands of users.
+        """
+
+        nodes = self._session.query(Node).all()
+        attributes = self._session.query(Attribute).all()
+
+        DirectoryService._fill_caches(nodes, attributes)
+
+        return len(nodes)
+
+    @staticmethod
+    def _fill_caches(nodes, attributes):
+        """
+        Fills in the caches of the specified nodes. The nodes' children and
+        attributes have to be part of the nodes and attributes lists.
+        """
+
+        nodes_by_id = {}
+        children = {}
+
+        for node in nodes:
+            node._child_cache = {}
+            node._attribute_cache = {}
+
+            nodes_by_id[node.id] = node
+            children[node.id] = []
+
+        for node in nodes:
+            if node.parent_id in nodes_by_id:
+                nodes_by_id[node.parent_id]._child_cache[node.name] = node
+                children[node.parent_id].append(node)
+
+        for attrib in attributes:
+            nodes_by_id[attrib.node_id]._attribute_cache[attrib.key] = attrib
+
+        # Fill in the relationships as well so iterating over
+        # nodes doesn't trigger lazy loads.
+        for node in nodes:
+            set_committed_value(node, 'children', children[node.id])
+            set_committed_value(node, 'attributes',
+                                sorted(node._attribute_cache.values(), key=lambda attrib: attrib.id))
+
+    @_timed('bulk_create')
+    def bulk_create(self, parent, children):
+        """
+        Creates lots of nodes at once, using one executemany() for the nodes
+        and one for the attributes rather than one INSERT (and commit) for
+        each of them. children is a list of (name, attributes, children)
+        tuples, where attributes is a dictionary and children is a list of
+        tuples of the same form. Returns the new child nodes of the parent.
+        """
+
+        # The IDs are assigned here, so the parent and anything else that's
+        # pending has to be written first.
+        self._session.flush()
+
+        first_id = (self._session.query(func.max(Node.id)).scalar() or 0) + 1
+        next_id = first_id
+
+        node_rows = []
+        attribute_rows = []
+        pending = [(parent.id, children)]
+
+        while len(pending) > 0:
+            parent_id, entries = pending.pop()
+
+            for name, attributes, subentries in entries:
+                node_rows.append({'id': next_id, 'parent_id': parent_id, 'name': name})
+
+                for key, value in attributes.items():
+                    attribute_rows.append({'node_id': next_id, 'key': key, 'value': value})
+
+                pending.append((next_id, subentries))
+                next_id += 1
+
+        if len(node_rows) == 0:
+            return []
+
+        self._session.execute(Node.__table__.insert(), node_rows)
+
+        if len(attribute_rows) > 0:
+            self._session.execute(Attribute.__table__.insert(), attribute_rows)
+
+        nodes = self._session.query(Node).filter(Node.id >= first_id).all()
+        attributes = self._session.query(Attribute).filter(Attribute.node_id >= first_id).all()
+
+        DirectoryService._fill_caches(nodes, attributes)
+
+        new_children = [node for node in nodes if node.parent_id == parent.id]
+
+        if parent._child_cache != None:
+            for node in new_children:
+                parent._child_cache[node.name] = node
+
+        self._session.expire(parent, ['children'])
+
+        self.commit()
+
+        return new_children
+
+    def commit(self):
+        """Commits the session unless a batch is in progress."""
+
+        if self._batch_depth == 0:
+            self._session.commit()
+
+    @contextmanager
+    def batch(self):
+        """
+        Defers commits until the end of the with block, e.g. while creating
+        lots of nodes at once.
+        """
+
+        self._batch_depth += 1
+
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+
+            if self._batch_depth == 0:
+                self._session.commit()
     
     def get_root_node(self):
         return self._root_node
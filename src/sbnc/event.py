@@ -15,6 +15,15 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
+from time import time
+from weakref import WeakSet, WeakKeyDictionary
+from sbnc import log
+
+_log = log.get_logger('event')
+
+_events = WeakSet()
+"""All Event objects, used for removing the handlers of unloaded plugins."""
+
 def match_source(value):
     def match_source_helper(*args, **kwargs):
         return args[1] == value
@@ -33,6 +42,103 @@ def lambda_and(expr1, expr2):
     
     return lambda *args, **kwargs:  lambda_and_helper(*args, **kwargs)
 
+def get_handler_name(receiver):
+    """Returns a human-readable name for an event handler."""
+
+    instance = getattr(receiver, 'im_self', None)
+
+    if instance != None:
+        return '%s.%s' % (instance.__class__.__name__, receiver.__name__)
+
+    name = getattr(receiver, '__name__', None)
+
+    if name == None:
+        return repr(receiver)
+
+    return '%s.%s' % (getattr(receiver, '__module__', '?'), name)
+
+class EventProfiler(object):
+    """
+    Keeps track of how much time each event handler takes. Handlers that
+    take longer than threshold seconds for a single call are logged and
+    counted as slow calls.
+
+    The statistics are keyed by the handlers' functions using weak
+    references, so profiling doesn't keep unloaded plugins alive.
+    """
+
+    phase_names = ['PreObserver', 'Handler', 'PostObserver']
+
+    def __init__(self, threshold=0.05):
+        self.threshold = threshold
+        self.reset()
+
+    def _get_handler_stats(self, receiver):
+        """Returns a tuple containing the handler's name and a dictionary with its stats."""
+
+        # Bound methods are created for every add_listener() call,
+        # the function they belong to is what lives as long as the handler.
+        func = getattr(receiver, 'im_func', receiver)
+
+        try:
+            return self.stats[func]
+        except KeyError:
+            pass
+        except TypeError:
+            # Not every callable can be referenced weakly.
+            return self._builtin_stats.setdefault(func, (get_handler_name(receiver), {}))
+
+        handler_stats = (get_handler_name(receiver), {})
+        self.stats[func] = handler_stats
+
+        return handler_stats
+
+    def record(self, evt, receiver, phase, elapsed):
+        _, handler_stats = self._get_handler_stats(receiver)
+        key = (evt.name, phase)
+
+        try:
+            stats = handler_stats[key]
+        except KeyError:
+            # count, total time, max time, slow calls
+            stats = [0, 0.0, 0.0, 0]
+            handler_stats[key] = stats
+
+        stats[0] += 1
+        stats[1] += elapsed
+
+        if elapsed > stats[2]:
+            stats[2] = elapsed
+
+        if elapsed > self.threshold:
+            stats[3] += 1
+
+            _log.warning('Slow event handler: %s took %.1fms (%s, %s)',
+                         get_handler_name(receiver), elapsed * 1000, evt.name,
+                         EventProfiler.phase_names[phase])
+
+    def reset(self):
+        # handler function -> (handler name, {(event name, phase): stats})
+        self.stats = WeakKeyDictionary()
+        self._builtin_stats = {}
+
+    def get_report(self):
+        """
+        Returns a list of (event name, handler name, phase name, call count,
+        total time, max time, slow call count) tuples, sorted by total time.
+        """
+
+        report = []
+
+        for handler_name, handler_stats in self.stats.values() + self._builtin_stats.values():
+            for (event_name, phase), stats in handler_stats.items():
+                report.append((event_name, handler_name, EventProfiler.phase_names[phase],
+                               stats[0], stats[1], stats[2], stats[3]))
+
+        report.sort(key=lambda item: item[4], reverse=True)
+
+        return report
+
 class Event(object):
     """Multicast delegate used to handle events."""
 
@@ -44,11 +150,17 @@ class Event(object):
     Handled = 2
     RemoveHandler = 4
 
-    def __init__(self):
+    profiler = None
+    """An EventProfiler object if handlers should be profiled, None otherwise."""
+
+    def __init__(self, name=None):
+        self.name = name
         self.handlers = []
 
         self.filter = None
         self.parent = None
+
+        _events.add(self)
     
     def bind(self, other, filter=filter):
         """Binds this to another event using the optionally specified filter."""
@@ -66,11 +178,15 @@ class Event(object):
         
         if self.filter != None:
             if filter == None:
-                filter = self.filter
+                combined_filter = self.filter
             else:
-                filter = lambda_and(self.filter, filter)
+                combined_filter = lambda_and(self.filter, filter)
+        else:
+            combined_filter = filter
 
-        handler = (receiver, type, filter)
+        # The filter that was passed in is kept as well so that
+        # remove_listener() can find exactly this handler.
+        handler = (receiver, type, combined_filter, filter)
         
         if last:
             self.handlers.append(handler)
@@ -78,12 +194,48 @@ class Event(object):
             self.handlers.insert(0, handler)
         
         if self.parent != None:
-            self.parent.add_listener(receiver, type, filter=filter, last=last)
+            self.parent.add_listener(receiver, type, filter=combined_filter, last=last)
 
-# TODO: implement  
-    def remove_listener(self, receiver, type, filter=any):
-        """Removes a handler from this event."""
-        raise NotImplementedError()
+    def remove_listener(self, receiver, type, filter=None):
+        """
+        Removes a handler which was registered with add_listener() using the
+        same receiver, type and filter from this event and the event it is
+        bound to. Other handlers for the same receiver aren't affected.
+        """
+
+        for handler in self.handlers:
+            if handler[0] == receiver and handler[1] == type and handler[3] is filter:
+                break
+        else:
+            return
+
+        # invoke() might currently be iterating over the list, so
+        # replace it rather than modifying it.
+        handlers = list(self.handlers)
+        handlers.remove(handler)
+        self.handlers = handlers
+
+        if self.parent != None:
+            self.parent.remove_listener(receiver, type, handler[2])
+
+    @staticmethod
+    def remove_module_listeners(module_name):
+        """
+        Removes all handlers which were defined in the specified module from
+        all events. Returns the number of handlers which were removed.
+        """
+
+        count = 0
+
+        for evt in list(_events):
+            handlers = [handler for handler in evt.handlers
+                        if getattr(handler[0], '__module__', None) != module_name]
+
+            if len(handlers) != len(evt.handlers):
+                count += len(evt.handlers) - len(handlers)
+                evt.handlers = handlers
+
+        return count
     
     def invoke(self, sender, **kwargs):
         """
@@ -91,6 +243,7 @@ class Event(object):
         """
 
         handled = False
+        profiler = Event.profiler
 
         for type in [Event.PreObserver, Event.Handler, Event.PostObserver]:
             for handler in self.handlers:
@@ -106,7 +259,12 @@ class Event(object):
                         not handler[2](self, sender, **kwargs):
                     continue
 
-                result = handler[0](self, sender, **kwargs)
+                if profiler == None:
+                    result = handler[0](self, sender, **kwargs)
+                else:
+                    start = time()
+                    result = handler[0](self, sender, **kwargs)
+                    profiler.record(self, handler[0], type, time() - start)
                 
                 if type == Event.Handler:
                     if not result in [Event.Continue, Event.Handled, Event.RemoveHandler]:
@@ -114,8 +272,7 @@ class Event(object):
                                          'Event.Handled and Event.RemoveHandler')
                         
                     if result & Event.RemoveHandler:
-                        # TODO: remove the handler
-                        raise NotImplementedError()
+                        self.remove_listener(handler[0], type, handler[3])
                     
                     if result & Event.Handled:
                         handled = True
@@ -0,0 +1,420 @@
+# sbncng - an object-oriented framework for IRC
+# Copyright (C) 2011 Gunnar Beutner
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+from time import time
+from collections import deque
+import gevent
+from gevent import event
+from sbnc import utils
+
+class FloodProfile(object):
+    """
+    Describes how fast a server lets us send. Every line costs one token plus
+    one token for each bytes_per_token bytes; the bucket holds up to burst
+    tokens and refills at rate tokens per second.
+    """
+
+    def __init__(self, name, burst, rate, bytes_per_token=120):
+        self.name = name
+        self.burst = burst
+        self.rate = rate
+        self.bytes_per_token = bytes_per_token
+
+    def cost(self, line):
+        # Lines that cost more than the whole bucket would never get sent.
+        return min(1.0 + float(len(line)) / self.bytes_per_token, float(self.burst))
+
+    def __repr__(self):
+        return "<flood profile %s, burst %s, rate %s>" % (repr(self.name), self.burst, self.rate)
+
+profiles = {
+    'default': FloodProfile('default', burst=5, rate=0.5),
+    'ircu': FloodProfile('ircu', burst=5, rate=0.5),
+    'hybrid': FloodProfile('hybrid', burst=10, rate=1.0),
+    'inspircd': FloodProfile('inspircd', burst=5, rate=1.0),
+    'unreal': FloodProfile('unreal', burst=5, rate=1.0),
+    'unlimited': FloodProfile('unlimited', burst=1000000, rate=1000000.0)
+}
+"""Built-in flood profiles, by name."""
+
+network_profiles = {
+    'quakenet': 'ircu',
+    'undernet': 'ircu',
+    'efnet': 'hybrid',
+    'ircnet': 'hybrid',
+    'oftc': 'hybrid',
+    'libera.chat': 'hybrid',
+    'freenode': 'hybrid'
+}
+"""Maps the lower-case NETWORK value from ISUPPORT to a profile name."""
+
+def get_profile(name):
+    """Returns the profile with the specified name, or the default profile."""
+
+    return profiles.get(name, profiles['default'])
+
+def get_network_profile(network):
+    """Returns the profile for the network name the server announced."""
+
+    if network == None:
+        return profiles['default']
+
+    return get_profile(network_profiles.get(network.lower(), 'default'))
+
+def _format_prefix(prefix):
+    # Prefixes can be Nick objects.
+    if prefix == None:
+        return None
+
+    return str(prefix)
+
+class SendScheduler(object):
+    """
+    Token-bucket scheduler that sits between an IRC connection and its line
+    writer. Lines are queued in priority lanes; a lower-priority line is only
+    sent when there's nothing waiting in a higher-priority lane. Consecutive
+    JOINs and MODE changes in the bulk lane are merged into multi-target
+    commands whenever the server's limits allow it.
+    """
+
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_BULK = 2
+
+    def __init__(self, ircobj, line_writer, profile=None):
+        self._ircobj = ircobj
+        self._line_writer = line_writer
+
+        if profile == None:
+            profile = profiles['default']
+
+        self.profile = profile
+
+        self._lanes = [deque(), deque(), deque()]
+        self._wakeup = event.Event()
+        self._tokens = float(profile.burst)
+        self._last_refill = time()
+        self._greenlet = None
+
+    def start(self):
+        if self._greenlet != None:
+            return
+
+        self._greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        """Stops the scheduler. Lines which haven't been sent yet are discarded."""
+
+        if self._greenlet == None:
+            return
+
+        self._greenlet.kill(block=False)
+        self._greenlet = None
+
+        for lane in self._lanes:
+            lane.clear()
+
+    def detach(self):
+        """
+        Stops the scheduler without discarding the queued messages. Returns
+        the scheduler's state, see restore().
+        """
+
+        if self._greenlet != None:
+            self._greenlet.kill(block=False)
+            self._greenlet = None
+
+        self._refill()
+
+        lanes = []
+
+        for lane in self._lanes:
+            lanes.append([(command, params, _format_prefix(prefix)) for command, params, prefix in lane])
+
+        return {
+            'profile': self.profile.name,
+            'tokens': self._tokens,
+            'lanes': lanes
+        }
+
+    def restore(self, state):
+        """Queues the messages from a detached scheduler's state."""
+
+        self._tokens = min(float(self.profile.burst), state['tokens'])
+
+        for lane, messages in zip(self._lanes, state['lanes']):
+            lane.extend([tuple(message) for message in messages])
+
+        self._wakeup.set()
+
+    def _set_profile(self, profile):
+        self._profile = profile
+        self._tokens = min(getattr(self, '_tokens', profile.burst), float(profile.burst))
+
+    def _get_profile(self):
+        return self._profile
+
+    profile = property(_get_profile, _set_profile)
+
+    def enqueue(self, command, params, prefix=None, priority=PRIORITY_BULK):
+        """Queues a message for sending."""
+
+        self._lanes[priority].append((command, list(params), prefix))
+        self._wakeup.set()
+
+    def enqueue_line(self, line, priority=PRIORITY_BULK):
+        """Queues a pre-formatted line for sending."""
+
+        self._lanes[priority].append((None, line, None))
+        self._wakeup.set()
+
+    def get_queue_length(self):
+        """Returns the number of messages which are still waiting to be sent."""
+
+        return sum([len(lane) for lane in self._lanes])
+
+    def _refill(self):
+        now = time()
+        self._tokens = min(float(self.profile.burst),
+                           self._tokens + (now - self._last_refill) * self.profile.rate)
+        self._last_refill = now
+
+    def _peek_lane(self):
+        for lane in self._lanes:
+            if len(lane) > 0:
+                return lane
+
+        return None
+
+    def _run(self):
+        while True:
+            lane = self._peek_lane()
+
+            if lane == None:
+                self._wakeup.clear()
+                self._wakeup.wait()
+                continue
+
+            line = self._format(lane, commit=False)
+            cost = self.profile.cost(line)
+
+            self._refill()
+
+            if self._tokens < cost:
+                # Something more important might be queued while we're
+                # waiting, so re-check the lanes after sleeping.
+                gevent.sleep((cost - self._tokens) / self.profile.rate)
+                continue
+
+            line = self._format(lane, commit=True)
+
+            self._tokens -= self.profile.cost(line)
+            self._line_writer.write_line(line)
+
+    def _format(self, lane, commit):
+        """
+        Formats the message at the head of the lane, merging it with the
+        following messages if possible. When commit is True the messages
+        are removed from the lane.
+        """
+
+        command, params, prefix = lane[0]
+        count = 1
+
+        if command == None:
+            if commit:
+                lane.popleft()
+
+            return params
+
+        if lane is self._lanes[SendScheduler.PRIORITY_BULK]:
+            if command == 'JOIN':
+                params, count = self._merge_joins(lane)
+            elif command == 'MODE':
+                params, count = self._merge_modes(lane)
+
+        if commit:
+            for _ in range(count):
+                lane.popleft()
+
+        return utils.format_irc_message(command, prefix=prefix, *params)
+
+    def _get_targmax(self, command, default):
+        targmax = self._ircobj.isupport.get('TARGMAX', None)
+
+        if targmax == None:
+            if command == 'JOIN':
+                return default
+
+            return 1
+
+        for token in targmax.split(','):
+            key, _, value = token.partition(':')
+
+            if key.upper() != command:
+                continue
+
+            if value == '':
+                return default
+
+            try:
+                return int(value)
+            except ValueError:
+                return 1
+
+        return 1
+
+    def _merge_joins(self, lane):
+        channels = []
+        count = 0
+
+        limit = self._get_targmax('JOIN', 1000)
+        maxchannels = self._ircobj.isupport.get('MAXCHANNELS', None)
+
+        if maxchannels != None:
+            try:
+                limit = min(limit, int(maxchannels))
+            except ValueError:
+                pass
+
+        for queued_command, queued_params, queued_prefix in lane:
+            if queued_command != 'JOIN' or queued_prefix != None or \
+                    len(queued_params) < 1 or queued_params[0] == '0':
+                break
+
+            names = queued_params[0].split(',')
+
+            if len(queued_params) > 1:
+                keys = queued_params[1].split(',')
+            else:
+                keys = []
+
+            new_channels = []
+
+            for index in range(len(names)):
+                if index < len(keys):
+                    new_channels.append((names[index], keys[index]))
+                else:
+                    new_channels.append((names[index], None))
+
+            if count > 0 and (len(channels) + len(new_channels) > limit or \
+                    len(utils.format_irc_message('JOIN', *_format_join_params(channels + new_channels))) >
+                    self._ircobj.MAX_LINELEN - 2):
+                break
+
+            channels.extend(new_channels)
+            count += 1
+
+        if count == 0:
+            # Not something we can merge (e.g. JOIN 0), send it as it is.
+            return lane[0][1], 1
+
+        return _format_join_params(channels), count
+
+    def _merge_modes(self, lane):
+        first_command, first_params, _ = lane[0]
+
+        if len(first_params) < 2:
+            return first_params, 1
+
+        channel = first_params[0]
+        changes = []
+        count = 0
+
+        try:
+            limit = int(self._ircobj.isupport.get('MODES', 3))
+        except ValueError:
+            limit = 3
+
+        for queued_command, queued_params, queued_prefix in lane:
+            if queued_command != 'MODE' or queued_prefix != None or \
+                    len(queued_params) < 2 or queued_params[0] != channel:
+                break
+
+            new_changes = _split_mode_changes(queued_params[1], queued_params[2:])
+
+            if new_changes == None:
+                break
+
+            if count > 0 and len(changes) + len(new_changes) > limit:
+                break
+
+            params = [channel] + _format_mode_changes(changes + new_changes)
+
+            if count > 0 and len(utils.format_irc_message('MODE', *params)) > \
+                    self._ircobj.MAX_LINELEN - 2:
+                break
+
+            changes.extend(new_changes)
+            count += 1
+
+        if count == 0:
+            return first_params, 1
+
+        return [channel] + _format_mode_changes(changes), count
+
+def _format_join_params(channels):
+    # Channels with keys have to come first so the keys line up.
+    keyed = [channel for channel in channels if channel[1] != None]
+    unkeyed = [channel for channel in channels if channel[1] == None]
+
+    params = [','.join([channel[0] for channel in keyed + unkeyed])]
+
+    if len(keyed) > 0:
+        params.append(','.join([channel[1] for channel in keyed]))
+
+    return params
+
+def _split_mode_changes(modes, params):
+    """
+    Splits a mode string into a list of (sign, mode, parameter) tuples. Every
+    mode takes exactly one parameter here (e.g. +o nick, +b mask); other mode
+    strings return None so they're sent unmodified.
+    """
+
+    changes = []
+    sign = '+'
+
+    for mode in modes:
+        if mode in '+-':
+            sign = mode
+            continue
+
+        if len(params) <= len(changes):
+            return None
+
+        changes.append((sign, mode, params[len(changes)]))
+
+    if len(changes) == 0 or len(changes) != len(params):
+        return None
+
+    return changes
+
+def _format_mode_changes(changes):
+    modes = ''
+    params = []
+    sign = None
+
+    for change_sign, mode, param in changes:
+        if change_sign != sign:
+            modes += change_sign
+            sign = change_sign
+
+        modes += mode
+        params.append(param)
+
+    return [modes] + params
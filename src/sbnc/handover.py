@@ -0,0 +1,314 @@
+# sbncng - an object-oriented framework for IRC
+# Copyright (C) 2011 Gunnar Beutner
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+Zero-downtime restarts. A running sbncng process listens on a Unix socket.
+A new process connects to it, and the old process detaches its connections
+and sends their state, followed by the sockets themselves (using
+SCM_RIGHTS). Once the new process has confirmed that it received
+everything, the old process closes its listeners, confirms that it has
+let go of the connections and exits. If anything goes wrong before that
+(including the new process not confirming in time) the old process
+resumes its connections, and the new process closes its copies. The new process then resumes the connections and
+starts its own listeners.
+
+The state is a marshalled dictionary (see Proxy.detach_connections()), so
+both processes have to use the same Python version.
+
+Only processes running as the same user may take over the connections: the
+Unix socket is only accessible by its owner and, where the platform
+supports it, the peer's uid is checked as well.
+"""
+
+import os
+import sys
+import errno
+import struct
+import marshal
+import gevent
+from gevent import socket
+from sbnc import log
+
+try:
+    from _multiprocessing import sendfd, recvfd
+except ImportError:
+    sendfd = None
+    recvfd = None
+
+MAGIC = 'SBNCHOV2'
+
+# state length, number of sockets
+_header = struct.Struct('!II')
+
+# pid, uid, gid
+_ucred = struct.Struct('3i')
+
+# Python 2's socket module doesn't export SO_PEERCRED.
+if sys.platform.startswith('linux'):
+    SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
+else:
+    SO_PEERCRED = None
+
+LISTEN_RETRIES = 20
+"""How often create_listener() tries to bind to an address which is in use."""
+
+LISTEN_RETRY_INTERVAL = 0.5
+
+ACK_TIMEOUT = 30
+"""Number of seconds the new process has to confirm that it took the connections."""
+
+_log = log.get_logger('handover')
+
+def is_supported():
+    """Returns whether file descriptors can be passed on this platform."""
+
+    return sendfd != None and hasattr(socket, 'AF_UNIX')
+
+def _get_peer_uid(sock):
+    """Returns the uid of the process at the other end of a Unix socket, or None if that's not supported."""
+
+    if SO_PEERCRED == None:
+        return None
+
+    _, uid, _ = _ucred.unpack(sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, _ucred.size))
+
+    return uid
+
+def create_listener(cls, *args, **kwargs):
+    """
+    Creates a listener object (e.g. a ClientListener). If the address is
+    still in use (i.e. because the process we took over the connections
+    from is still shutting down) this is retried for a while. Returns None
+    if the address is still in use after that.
+    """
+
+    for _ in range(LISTEN_RETRIES):
+        try:
+            return cls(*args, **kwargs)
+        except socket.error as exc:
+            if exc.errno != errno.EADDRINUSE:
+                raise
+
+        gevent.sleep(LISTEN_RETRY_INTERVAL)
+
+    _log.error('Could not create %s: the address is already in use.', cls.__name__)
+
+    return None
+
+def _recv_exactly(sock, length):
+    data = ''
+
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+
+        if not chunk:
+            raise EOFError('Handover connection was closed.')
+
+        data += chunk
+
+    return data
+
+def _send_fd(sock, fd):
+    while True:
+        try:
+            sendfd(sock.fileno(), fd)
+            return
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+
+            socket.wait_write(sock.fileno())
+
+def _recv_fd(sock):
+    while True:
+        try:
+            return recvfd(sock.fileno())
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+
+            socket.wait_read(sock.fileno())
+
+class HandoverServer(object):
+    """Hands the connections over to a new process when it connects."""
+
+    def __init__(self, path, proxy, listeners=None):
+        """
+        path: The path of the Unix socket.
+        proxy: The Proxy object whose connections are handed over.
+        listeners: Listener objects (e.g. ClientListener or
+                   MetricsListener) which are closed before the process
+                   exits, so that the new process can bind to the same
+                   addresses.
+        """
+
+        self.path = path
+        self.proxy = proxy
+
+        if listeners == None:
+            listeners = []
+
+        self.listeners = listeners
+
+        # A stale socket from a process which didn't exit cleanly.
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+
+        # The socket hands out every client connection, so nobody
+        # else may connect to it.
+        os.chmod(path, 0600)
+
+        self.socket.listen(1)
+
+    def start(self):
+        return gevent.spawn(self.run)
+
+    def run(self):
+        while True:
+            sock, _ = self.socket.accept()
+
+            uid = _get_peer_uid(sock)
+
+            if uid != None and uid != os.getuid():
+                _log.warning('Rejected handover connection from uid %d.', uid)
+                sock.close()
+                continue
+
+            try:
+                self._hand_over(sock)
+            except Exception:
+                # Keep accepting handover connections even if this one went wrong.
+                _log.exception('Handover failed')
+
+    def _hand_over(self, sock):
+        _log.info('Handing over connections to a new process.')
+
+        state, sockets = self.proxy.detach_connections()
+
+        # Whatever goes wrong from here on, the connections must be restored.
+        timeout = gevent.Timeout(ACK_TIMEOUT)
+
+        try:
+            state['families'] = [connsock.family for connsock in sockets]
+
+            data = marshal.dumps(state)
+
+            sock.sendall(MAGIC + _header.pack(len(data), len(sockets)) + data)
+
+            for connsock in sockets:
+                _send_fd(sock, connsock.fileno())
+
+            timeout.start()
+            ack = _recv_exactly(sock, 1)
+        except gevent.Timeout as exc:
+            if exc is not timeout:
+                sock.close()
+                self.proxy.restore_connections(state, sockets)
+                raise
+
+            _log.error('Handover failed: the new process did not confirm the handover.')
+            ack = None
+        except Exception as exc:
+            _log.error('Handover failed: %s', exc)
+            ack = None
+        finally:
+            timeout.cancel()
+
+        if ack != 'K':
+            # The new process didn't take the connections,
+            # so carry on as if nothing happened.
+            sock.close()
+            self.proxy.restore_connections(state, sockets)
+            return
+
+        for listener in self.listeners:
+            listener.socket.close()
+
+        self.socket.close()
+        os.unlink(self.path)
+
+        # This tells the new process that the listeners are closed
+        # and that the connections are its own now.
+        try:
+            sock.sendall('D')
+        except socket.error:
+            pass
+
+        sock.close()
+
+        _log.info('Handed over %d connections, exiting.', len(sockets))
+
+        # os._exit() skips the atexit handlers which would otherwise write
+        # the queued log records.
+        log.flush()
+        os._exit(0)
+
+def take_over(path, proxy):
+    """
+    Takes over the connections of the process which is listening on the
+    specified Unix socket. Returns the number of connections.
+    """
+
+    if not is_supported():
+        raise RuntimeError('Passing sockets is not supported on this platform.')
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(path)
+
+    header = _recv_exactly(sock, len(MAGIC) + _header.size)
+
+    if header[:len(MAGIC)] != MAGIC:
+        sock.close()
+        raise ValueError('%s is not a handover socket.' % (path))
+
+    length, count = _header.unpack(header[len(MAGIC):])
+
+    state = marshal.loads(_recv_exactly(sock, length))
+    fds = [_recv_fd(sock) for _ in range(count)]
+
+    sock.sendall('K')
+
+    # Wait until the old process has closed its listeners. If it closes
+    # the handover connection without confirming, it has kept the connections.
+    try:
+        done = sock.recv(1)
+    except socket.error:
+        done = ''
+
+    sock.close()
+
+    if done != 'D':
+        for fd in fds:
+            os.close(fd)
+
+        raise RuntimeError('The old process did not hand over its connections.')
+
+    sockets = []
+
+    for fd, family in zip(fds, state['families']):
+        # fromfd() duplicates the file descriptor.
+        sockets.append(socket.fromfd(fd, family, socket.SOCK_STREAM))
+        os.close(fd)
+
+    proxy.restore_connections(state, sockets)
+
+    _log.info('Took over %d connections.', count)
+
+    return count
@@ -17,20 +17,61 @@
 
 import sys
 import time
-from copy import copy
 from datetime import datetime
 from weakref import WeakValueDictionary
+from collections import deque
 import gevent
 from gevent import socket, dns, queue
 from sbnc import utils
 from sbnc.event import Event, match_source, match_param
 from sbnc.timer import Timer
+from sbnc.flood import SendScheduler, get_profile, get_network_profile
+from sbnc.plugin import ServiceRegistry
+from sbnc.metrics import MetricsService
+from sbnc import log
+from sbnc.capture import DIRECTION_IN, DIRECTION_OUT
+
+metrics_svc = ServiceRegistry.get(MetricsService.package)
+
+_log = log.get_logger('irc')
+_line_log = log.get_logger('irc.lines')
+_line_sampler = log.get_sampler('irc.lines')
+
+_lines_received = metrics_svc.counter('sbnc_lines_received_total', 'Lines received from all connections.')
+_bytes_received = metrics_svc.counter('sbnc_bytes_received_total', 'Bytes received from all connections.')
+_lines_sent = metrics_svc.counter('sbnc_lines_sent_total', 'Lines sent to all connections.')
+_bytes_sent = metrics_svc.counter('sbnc_bytes_sent_total', 'Bytes sent to all connections.')
+_dispatch_time = metrics_svc.histogram('sbnc_dispatch_seconds',
+                                       'Time spent dispatching received commands to event handlers.',
+                                       label='command')
+
+_dispatch_commands = frozenset(['PRIVMSG', 'NOTICE', 'TAGMSG', 'JOIN', 'PART', 'KICK', 'QUIT',
+                                'NICK', 'MODE', 'TOPIC', 'INVITE', 'PING', 'PONG', 'ERROR',
+                                'KILL', 'AWAY', 'ACCOUNT', 'CHGHOST', 'CAP', 'AUTHENTICATE',
+                                'PASS', 'USER', 'WHO', 'WHOIS', 'WHOWAS', 'NAMES', 'LIST',
+                                'USERHOST', 'ISON', 'MOTD', 'LUSERS', 'OPER', 'WALLOPS',
+                                '001', '002', '003', '004', '005', '221', '301', '302', '303',
+                                '305', '306', '311', '312', '315', '318', '319', '324', '329',
+                                '331', '332', '333', '352', '353', '366', '372', '375', '376',
+                                '422', '433'])
+"""
+Commands which get their own label in the dispatch time histogram. Every
+other command is counted as 'other' so that the number of labels stays
+bounded no matter what the other side sends.
+"""
 
 class QueuedLineWriter(object):
     def __init__(self, sock):
         self._socket = sock
         self._connection = sock.makefile('w+b', 1)
         self._queue = queue.Queue()
+
+        self.lines_sent = 0
+        self.bytes_sent = 0
+
+        self.capture = None
+
+        self._writing = False
     
     def start(self):
         self._thread = gevent.spawn(self._run)
@@ -41,11 +82,33 @@ class QueuedLineWriter(object):
             
             if line == False:
                 break
-            
+
+            # write_lines() queues lists of lines which are
+            # written using a single call.
+            if isinstance(line, list):
+                lines = line
+            else:
+                lines = [line]
+
+            data = '\r\n'.join(lines) + '\r\n'
+
+            self._writing = True
+
             try:
-                self._connection.write(line + '\r\n')
+                self._connection.write(data)
             except:
-                pass
+                continue
+            finally:
+                self._writing = False
+
+            self.lines_sent += len(lines)
+            self.bytes_sent += len(data)
+            _lines_sent.inc(len(lines))
+            _bytes_sent.inc(len(data))
+
+            if self.capture != None:
+                for line in lines:
+                    self.capture.record(DIRECTION_OUT, line)
     
         self._connection.close()
         self._socket.shutdown(socket.SHUT_RDWR)
@@ -53,6 +116,15 @@ class QueuedLineWriter(object):
     
     def write_line(self, line):
         self._queue.put(line)
+
+    def write_lines(self, lines):
+        if len(lines) > 0:
+            self._queue.put(list(lines))
+
+    def get_queue_length(self):
+        """Returns the number of lines which are waiting to be written."""
+
+        return self._queue.qsize()
     
     def clear(self):
         while self._queue.get(block=False) != None:
@@ -61,17 +133,485 @@ class QueuedLineWriter(object):
     def close(self):
         self._queue.put(False)
 
+    def detach(self):
+        """
+        Stops the writer without closing the socket. Returns the lines which
+        haven't been written yet.
+        """
+
+        # Killing the writer in the middle of a write would leave
+        # a partial line on the socket.
+        while self._writing:
+            gevent.sleep(0.01)
+
+        self._thread.kill(block=True)
+
+        lines = []
+
+        while self._queue.qsize() > 0:
+            item = self._queue.get(block=False)
+
+            if isinstance(item, list):
+                lines.extend(item)
+            elif item != False:
+                lines.append(item)
+
+        return lines
+
 def match_command(value):
     return match_param('command', value)
 
+class ChannelInfo(object):
+    """
+    Channel state which is the same for every user on a network, i.e. the
+    topic. Channel objects for the same channel on a server which is listed
+    in NetworkInfo.shared_channel_servers share one ChannelInfo object (see
+    NetworkInfo.get_channel_info()).
+    """
+
+    def __init__(self, name):
+        self.name = utils.intern_string(name)
+
+        self.topic_text = None
+        self.topic_nick = None
+        # UNIX timestamp
+        self.topic_time = None
+
+    def set_topic_text(self, text):
+        if text != self.topic_text:
+            self.topic_text = text
+
+    def set_topic_nick(self, hostmask):
+        if hostmask != None:
+            hostmask = utils.intern_string(str(hostmask))
+
+        self.topic_nick = hostmask
+
+class NetworkInfo(object):
+    """
+    The ISUPPORT table and the MOTD of an IRC server. All IRC connections to
+    the same server (address and name) share one NetworkInfo object (see
+    get_network_info()), which also keeps the pre-rendered RPL_ISUPPORT and
+    RPL_MOTD replies that are sent to clients when they attach.
+    """
+
+    DEFAULT_ISUPPORT = {
+        'CHANMODES': 'bIe,k,l',
+        'CHANTYPES': '#&+',
+        'PREFIX': '(ov)@+',
+        'NAMESX': ''
+    }
+
+    shared_channel_servers = set()
+    """
+    Addresses ((host, port) tuples) of the servers whose channels share
+    their topics between users. Only servers which are trusted to show every
+    user the same topics should be listed here.
+    """
+
+    # RPL_ISUPPORT may have at most 13 tokens (15 parameters
+    # including the nick and the trailing text).
+    MAX_ISUPPORT_TOKENS = 13
+    MAX_ISUPPORT_LENGTH = 300
+
+    def __init__(self, server=None, address=None):
+        self.server = server
+        self.address = address
+        self.isupport = dict(NetworkInfo.DEFAULT_ISUPPORT)
+        self.motd = []
+
+        self._isupport_replies = None
+        self._motd_replies = None
+        self._chanmodes = None
+        self._prefix_modes = None
+
+        self._channels = WeakValueDictionary()
+
+    def get_channel_info(self, channel):
+        """Returns the ChannelInfo object for the specified channel."""
+
+        if self.address == None or not self.address in NetworkInfo.shared_channel_servers:
+            return ChannelInfo(channel)
+
+        try:
+            return self._channels[channel]
+        except KeyError:
+            pass
+
+        channel_info = ChannelInfo(channel)
+        self._channels[channel_info.name] = channel_info
+
+        return channel_info
+
+    def set_isupport(self, key, value):
+        """Updates an ISUPPORT token. Cached replies are only discarded if the value changed."""
+
+        if key in self.isupport and self.isupport[key] == value:
+            return
+
+        self.isupport[utils.intern_string(key)] = utils.intern_string(value)
+        self._isupport_replies = None
+        self._chanmodes = None
+        self._prefix_modes = None
+
+    def get_chanmodes(self):
+        """Returns the parsed CHANMODES token, see utils.parse_chanmodes()."""
+
+        if self._chanmodes == None:
+            self._chanmodes = utils.parse_chanmodes(self.isupport.get('CHANMODES', ''))
+
+        return self._chanmodes
+
+    def get_prefix_modes(self):
+        """Returns the channel modes which have a nick prefix, e.g. 'ov'."""
+
+        if self._prefix_modes == None:
+            self._prefix_modes = utils.get_prefix_modes(self.isupport.get('PREFIX', ''))
+
+        return self._prefix_modes
+
+    def set_motd(self, lines):
+        """Replaces the MOTD. Cached replies are only discarded if the text changed."""
+
+        if lines == self.motd:
+            return
+
+        self.motd = lines
+        self._motd_replies = None
+
+    def get_isupport_replies(self):
+        """
+        Returns the RPL_ISUPPORT replies without the prefix, numeric and target,
+        e.g. 'CHANTYPES=# NETWORK=QuakeNet :are supported by this server'.
+        """
+
+        if self._isupport_replies == None:
+            replies = []
+            tokens = []
+            length = 0
+
+            for key, value in sorted(self.isupport.items()):
+                if len(value) > 0:
+                    token = '%s=%s' % (key, value)
+                else:
+                    token = key
+
+                if len(tokens) > 0 and (len(tokens) == NetworkInfo.MAX_ISUPPORT_TOKENS or \
+                        length + len(token) > NetworkInfo.MAX_ISUPPORT_LENGTH):
+                    replies.append(' '.join(tokens) + ' :are supported by this server')
+                    tokens = []
+                    length = 0
+
+                tokens.append(token)
+                length += len(token) + 1
+
+            if len(tokens) > 0:
+                replies.append(' '.join(tokens) + ' :are supported by this server')
+
+            self._isupport_replies = replies
+
+        return self._isupport_replies
+
+    def remove_isupport(self, key):
+        """Removes an ISUPPORT token, or resets it to its default value."""
+
+        if key in NetworkInfo.DEFAULT_ISUPPORT:
+            self.set_isupport(key, NetworkInfo.DEFAULT_ISUPPORT[key])
+        elif key in self.isupport:
+            del self.isupport[key]
+            self._isupport_replies = None
+
+    def prune_isupport(self, keys):
+        """Removes the ISUPPORT tokens which aren't in keys."""
+
+        for key in self.isupport.keys():
+            if not key in keys:
+                self.remove_isupport(key)
+
+    def get_motd_replies(self):
+        """Returns the RPL_MOTD replies without the prefix, numeric and target."""
+
+        if self._motd_replies == None:
+            self._motd_replies = [':- ' + line for line in self.motd]
+
+        return self._motd_replies
+
+_network_infos = WeakValueDictionary()
+
+class WhoCache(object):
+    """
+    Settings for answering WHO queries from the tracked state. How fresh a
+    nick's WHO information is is stored in the Nick object itself (who_time).
+    """
+
+    max_age = 60
+    """Number of seconds WHO information is considered to be up to date."""
+
+    tracked_max_age = 600
+    """
+    Number of seconds WHO information for nicks whose away status is kept
+    up to date by away-notify is considered to be up to date. Other details
+    (e.g. whether the nick is an oper) aren't tracked, so this is limited as
+    well.
+    """
+
+    @staticmethod
+    def is_fresh(timestamp):
+        return timestamp != None and time.time() - timestamp < WhoCache.max_age
+
+    @staticmethod
+    def is_nick_fresh(nickobj):
+        """
+        Returns whether WHO replies for the nick can be generated locally. This
+        is the case if the last WHO reply is recent or if away-notify has kept
+        the nick's away status up to date since a recent WHO reply or JOIN.
+        """
+
+        if nickobj.user == None or nickobj.host == None:
+            return False
+
+        if WhoCache.is_fresh(nickobj.who_time):
+            return True
+
+        return nickobj.away_tracked and nickobj.realname != None and \
+               nickobj.track_time != None and time.time() - nickobj.track_time < WhoCache.tracked_max_age
+
+class Request(object):
+    """A query which has been sent to the IRC server on behalf of one or more clients."""
+
+    def __init__(self, command, params):
+        self.command = command
+        self.params = params
+        self.key = (command, tuple([param.lower() for param in params]))
+
+        # Replies name the target the way it was asked for, or (for
+        # comma-separated lists) one of the list's items.
+        if len(params) == 0:
+            self.target = None
+            self.targets = set()
+        else:
+            if command == 'WHOIS':
+                self.target = params[-1].lower()
+            else:
+                self.target = params[0].lower()
+
+            self.targets = set(self.target.split(','))
+            self.targets.add(self.target)
+
+        self.requesters = []
+        self.label = None
+        self.time = time.time()
+
+class RequestTracker(object):
+    """
+    Matches the server's replies to the queries clients sent, so that a reply
+    only goes to the clients which asked for it and identical queries that
+    are sent while the first one is still waiting for its reply are only
+    sent once.
+
+    If the server supports labeled-response each query is sent with a label
+    and replies are matched by that. Otherwise the tracker relies on the
+    server answering queries in order and on each query having a known set
+    of reply numerics and end numerics. Error numerics (400-599) which refer
+    to the query's target are passed to the requesters of the oldest query.
+    """
+
+    # command -> (reply numerics, end numerics, whether errors end the query,
+    #             index of the target in replies, index of the target in end numerics)
+    # An index of None means that the numeric doesn't name the target, e.g.
+    # the 302 reply to USERHOST only contains the results.
+    queries = {
+        'WHO': (('352', '354'), ('315',), False, None, 1),
+        'WHOIS': (('276', '301', '307', '310', '311', '312', '313', '317', '319', '320',
+                   '330', '338', '378', '379', '671'), ('318',), False, 1, 1),
+        'WHOWAS': (('312', '314', '330', '338'), ('369',), False, 1, 1),
+        'NAMES': (('353',), ('366',), False, 2, 1),
+        'LIST': (('321', '322'), ('323',), False, None, None),
+        'USERHOST': ((), ('302',), True, None, None),
+        'ISON': ((), ('303',), True, None, None)
+    }
+
+    timeout = 30
+    """Number of seconds after which a query's replies are assumed to have been lost."""
+
+    def __init__(self):
+        self._requests = deque()
+        self._pending = {}
+        self._labels = {}
+        self._next_label = 0
+
+        # Set when the server has acknowledged the labeled-response capability.
+        self.labels_enabled = False
+
+    @staticmethod
+    def is_query(command, params):
+        if not command in RequestTracker.queries:
+            return False
+
+        # NAMES without a channel lists every channel on the network, WHO
+        # without a mask every visible user, neither have a single end reply.
+        if command in ('NAMES', 'WHO') and len(params) == 0:
+            return False
+
+        return True
+
+    def begin(self, command, params, requester):
+        """
+        Registers a query. Returns the new Request object if the query has to
+        be sent to the server, or None if an identical query is already waiting
+        for its reply (in which case the requester will get that reply).
+        """
+
+        self._expire()
+
+        request = Request(command, params)
+
+        if request.key in self._pending:
+            self._pending[request.key].requesters.append(requester)
+            return None
+
+        request.requesters.append(requester)
+
+        if self.labels_enabled:
+            self._next_label += 1
+            request.label = 'sbnc%d' % (self._next_label)
+            self._labels[request.label] = request
+
+        self._requests.append(request)
+        self._pending[request.key] = request
+
+        return request
+
+    def route(self, command, params, label=None):
+        """
+        Returns the list of requesters a reply should be sent to, or None if
+        the reply wasn't for any of the tracked queries.
+        """
+
+        if label != None:
+            return self._route_label(command, label)
+
+        self._expire()
+
+        if len(self._requests) == 0:
+            return None
+
+        request = self._requests[0]
+
+        if request.label != None:
+            return None
+
+        reply_numerics, end_numerics, ends_on_error, reply_index, end_index = \
+            RequestTracker.queries[request.command]
+
+        if command in end_numerics:
+            if not RequestTracker._matches_target(request, params, end_index):
+                return None
+
+            self._finish(request)
+            return request.requesters
+
+        if command in reply_numerics:
+            if not RequestTracker._matches_target(request, params, reply_index):
+                return None
+
+            return request.requesters
+
+        if len(command) == 3 and '400' <= command < '600' and len(params) > 1 and \
+                (params[1].lower() in request.targets or params[1].lower() == request.command.lower()):
+            if ends_on_error:
+                self._finish(request)
+
+            return request.requesters
+
+        return None
+
+    @staticmethod
+    def _matches_target(request, params, index):
+        """
+        Checks whether a reply is for the request's target. Replies which don't
+        name a target can't be checked and are assumed to match.
+        """
+
+        if index == None or request.target == None:
+            return True
+
+        return len(params) > index and params[index].lower() in request.targets
+
+    def _route_label(self, command, label):
+        if not label in self._labels:
+            return None
+
+        request = self._labels[label]
+
+        end_numerics, ends_on_error = RequestTracker.queries[request.command][1:3]
+
+        if command in end_numerics or command == 'ACK' or \
+                (ends_on_error and len(command) == 3 and '400' <= command < '600'):
+            self._finish(request)
+
+        return request.requesters
+
+    def end_batch(self, label):
+        """Called when a labeled BATCH ends, which means the query is done."""
+
+        if label in self._labels:
+            self._finish(self._labels[label])
+
+    def remove_requester(self, requester):
+        for request in self._requests:
+            if requester in request.requesters:
+                request.requesters.remove(requester)
+
+    def _finish(self, request):
+        self._requests.remove(request)
+
+        if self._pending.get(request.key, None) is request:
+            del self._pending[request.key]
+
+        if request.label != None:
+            self._labels.pop(request.label, None)
+
+    def _expire(self):
+        now = time.time()
+
+        while len(self._requests) > 0 and now - self._requests[0].time > RequestTracker.timeout:
+            self._finish(self._requests[0])
+
+    def __len__(self):
+        return len(self._requests)
+
+def get_network_info(server, address):
+    """
+    Returns the NetworkInfo object for the specified server name and the
+    address the connection was made to. The object is shared for as long as
+    there are connections to the server. The name alone isn't enough because
+    any server can claim to be irc.example.net.
+    """
+
+    key = (tuple(address), server)
+
+    try:
+        return _network_infos[key]
+    except KeyError:
+        pass
+
+    network_info = NetworkInfo(server, tuple(address))
+    _network_infos[key] = network_info
+
+    return network_info
+
 class _BaseConnection(object):
     MAX_LINELEN = 512
 
-    connection_closed_event = Event()
-    registration_event = Event()
-    command_received_event = Event()
+    tls_handshake_timeout = 30
+    """Number of seconds after which a TLS handshake is given up."""
 
-    def __init__(self, address, socket=None, factory=None):
+    connection_closed_event = Event('_BaseConnection.connection_closed_event')
+    registration_event = Event('_BaseConnection.registration_event')
+    command_received_event = Event('_BaseConnection.command_received_event')
+
+    def __init__(self, address, socket=None, factory=None, tls_context=None):
         """
         Base class for IRC connections.
 
@@ -80,11 +620,14 @@ class _BaseConnection(object):
         socket: An existing socket for the connection, or None
                 if a new connection is to be established.
         factory: The factory that was used to create this object.
+        tls_context: A TLSContext object if the connection should
+                     use TLS, or None.
         """
 
         self.socket_address = address
         self.socket = socket
         self.factory = factory
+        self.tls_context = tls_context
 
         evt = Event()
         evt.bind(self.__class__.connection_closed_event, filter=match_source(self))
@@ -109,45 +652,179 @@ class _BaseConnection(object):
         self.nicks = WeakValueDictionary()
         self.channels = {}
 
-        self.isupport = {
-            'CHANMODES': 'bIe,k,l',
-            'CHANTYPES': '#&+',
-            'PREFIX': '(ov)@+',
-            'NAMESX': ''
-        }
-
-        self.motd = []
+        # A private NetworkInfo object until we know which server we're
+        # talking to. IRCConnection switches to the shared one on 001.
+        self.network_info = NetworkInfo()
 
         self.owner = None
 
+        # Enabled IRCv3 capabilities
+        self.caps = set()
+
+        # Tags of the line which is currently being processed
+        self.message_tags = utils.NO_TAGS
+
+        self.lines_received = 0
+        self.bytes_received = 0
+
+        # A CaptureWriter object if traffic should be recorded.
+        self.capture = None
+
+        self._line_writer = None
         self._registration_timeout = None
+        self._greenlet = None
+
+        # Received lines which haven't been processed yet and the
+        # incomplete line at the end of the last read.
+        self._input_lines = deque()
+        self._input_buffer = ''
+
+        # The state which is restored by resume(), and whether the
+        # connection has been detached for a handover.
+        self._resume_state = None
+        self._detached = False
 
     def start(self):
-        return gevent.spawn(self._run)
+        self._greenlet = gevent.spawn(self._run)
+        return self._greenlet
+
+    def resume(self, state):
+        """
+        Starts processing an existing connection whose state was saved by
+        detach() (possibly in another process). The connection's socket must
+        have been passed to the constructor.
+        """
+
+        self.set_state(state)
+        self._resume_state = state
+
+        return self.start()
+
+    def detach(self):
+        """
+        Stops processing this connection without closing the socket, e.g. so
+        that the socket can be passed to another process. Returns the
+        connection's state, including the lines which haven't been processed
+        or sent yet.
+        """
+
+        self._detached = True
+
+        if self._greenlet != None:
+            self._greenlet.kill(block=True)
+
+        state = self.get_state()
+        state['output'] = self._line_writer.detach()
+
+        return state
+
+    def get_state(self):
+        """Returns the connection's state, using only types which can be marshalled."""
+
+        return {
+            'address': tuple(self.socket_address),
+            'registered': self.registered,
+            'away': self.away,
+            'realname': self.realname,
+            'usermodes': self.usermodes,
+            'caps': list(self.caps),
+            'me': self.me.get_state(),
+            'server': self.server.get_state(),
+            'lines_received': self.lines_received,
+            'bytes_received': self.bytes_received,
+            'input': ''.join([line + '\n' for line in self._input_lines]) + self._input_buffer
+        }
+
+    def set_state(self, state):
+        """Restores the state returned by get_state()."""
+
+        self.registered = state['registered']
+        self.away = state['away']
+        self.realname = state['realname']
+        self.usermodes = state['usermodes']
+        self.caps = set(state['caps'])
+        self.me.set_state(state['me'])
+        self.server.set_state(state['server'])
+        self.lines_received = state['lines_received']
+        self.bytes_received = state['bytes_received']
+
+        lines = state['input'].split('\n')
+        self._input_buffer = lines.pop()
+        self._input_lines.extend(lines)
 
     def _run(self):
         try:
             if self.socket == None:
                 self.socket = socket.create_connection(self.socket_address)
 
+            if self.tls_context != None:
+                # Otherwise a peer which never completes the handshake would
+                # keep the connection (and its greenlet) around forever.
+                timeout = gevent.Timeout(_BaseConnection.tls_handshake_timeout)
+                timeout.start()
+
+                # There's no line writer yet which would close the socket,
+                # so it has to be closed here if the handshake fails.
+                try:
+                    self.socket = self.tls_context.wrap(self.socket, self.socket_address)
+                except gevent.Timeout as exc:
+                    self.socket.close()
+
+                    if exc is not timeout:
+                        raise
+
+                    _log.info('TLS handshake with %s timed out.', self.socket_address)
+                    return
+                except Exception as exc:
+                    self.socket.close()
+
+                    _log.warning('TLS handshake with %s failed: %s', self.socket_address, exc)
+                    return
+                finally:
+                    timeout.cancel()
+
             self._line_writer = QueuedLineWriter(self.socket)
+            self._line_writer.capture = self.capture
             self._line_writer.start()
 
-            self.handle_connection_made()
+            if self._resume_state != None:
+                self.handle_connection_resumed(self._resume_state)
+                self._resume_state = None
+            else:
+                self.handle_connection_made()
 
-            connection = self.socket.makefile('w+b', 1)
+            # The lines are buffered here rather than in a file object so
+            # that detach() knows exactly which data hasn't been processed.
+            pending = self._input_lines
 
             while True:
-                line = connection.readline()
+                while len(pending) > 0:
+                    line = pending.popleft()
+
+                    if self.capture != None:
+                        self.capture.record(DIRECTION_IN, line)
+
+                    self.process_line(line)
 
-                if not line:
+                data = self.socket.recv(8192)
+
+                if not data:
                     break
 
-                self.process_line(line)
+                self.bytes_received += len(data)
+                _bytes_received.inc(len(data))
+
+                lines = (self._input_buffer + data).split('\n')
+                self._input_buffer = lines.pop()
+                pending.extend(lines)
         except Exception:
             exc_info = sys.exc_info()
             sys.excepthook(*exc_info)
         finally:
+            # The socket belongs to someone else now.
+            if self._detached:
+                return
+
             try:
                 # Not calling possibly derived methods
                 # as they might not be safe to call from here.
@@ -157,10 +834,16 @@ class _BaseConnection(object):
 
             self.__class__.connection_closed_event.invoke(self)
 
+            if self.capture != None:
+                self.capture.close()
+
     def close(self, message=None):        
         if self._registration_timeout != None:
             self._registration_timeout.cancel()
 
+        if self.tls_context != None and self.socket != None:
+            self.tls_context.remember_session(self.socket, self.socket_address)
+
         self._line_writer.close()
 
     def handle_exception(self, exc):
@@ -190,14 +873,29 @@ class _BaseConnection(object):
         return nickobj
 
     def process_line(self, line):
-        prefix, command, params = utils.parse_irc_message(line.rstrip('\r\n'))
+        self.message_tags, line = utils.split_message_tags(line.rstrip('\r\n'))
+
+        prefix, command, params = utils.parse_irc_message(line)
         nickobj = self.get_nick(prefix)
 
-        print nickobj, command, params
+        if _line_sampler.is_enabled():
+            _line_log.log(log.TRACE, '%s %s %s', nickobj, command, params)
 
         command = command.upper()
 
-        if self.__class__.command_received_event.invoke(self, command=command, nickobj=nickobj, params=params):
+        self.lines_received += 1
+        _lines_received.inc()
+
+        start = time.time()
+        handled = self.__class__.command_received_event.invoke(self, command=command, nickobj=nickobj, params=params)
+        elapsed = time.time() - start
+
+        if command in _dispatch_commands:
+            _dispatch_time.labels(command).observe(elapsed)
+        else:
+            _dispatch_time.labels('other').observe(elapsed)
+
+        if handled:
             return
 
         self.handle_unknown_command(nickobj, command, params)
@@ -205,6 +903,56 @@ class _BaseConnection(object):
     def send_line(self, line):
         self._line_writer.write_line(line)
 
+    def send_lines(self, lines):
+        """Sends several pre-formatted lines as one batch."""
+
+        self._line_writer.write_lines(lines)
+
+    def start_capture(self, capture):
+        """
+        Starts recording this connection's traffic using the specified
+        CaptureWriter object.
+        """
+
+        self.capture = capture
+
+        if self._line_writer != None:
+            self._line_writer.capture = capture
+
+    def get_queue_length(self):
+        """Returns the number of lines which have been queued but not sent yet."""
+
+        if self._line_writer == None:
+            return 0
+
+        return self._line_writer.get_queue_length()
+
+    def _get_isupport(self):
+        return self.network_info.isupport
+
+    isupport = property(_get_isupport)
+
+    def _get_motd(self):
+        return self.network_info.motd
+
+    motd = property(_get_motd)
+
+    def _get_lines_sent(self):
+        if self._line_writer == None:
+            return 0
+
+        return self._line_writer.lines_sent
+
+    lines_sent = property(_get_lines_sent)
+
+    def _get_bytes_sent(self):
+        if self._line_writer == None:
+            return 0
+
+        return self._line_writer.bytes_sent
+
+    bytes_sent = property(_get_bytes_sent)
+
     def send_message(self, command, *parameter_list, **prefix):
         self.send_line(utils.format_irc_message(command, *parameter_list, **prefix))
 
@@ -212,6 +960,11 @@ class _BaseConnection(object):
         self._registration_timeout = Timer(30, self._registration_timeout_timer)
         self._registration_timeout.start()
 
+    def handle_connection_resumed(self, state):
+        """Called instead of handle_connection_made() when a detached connection is resumed."""
+
+        self._line_writer.write_lines(state.get('output', []))
+
     def handle_unknown_command(self, command, nickobj, params):
         pass
 
@@ -230,7 +983,7 @@ class _BaseConnection(object):
         self.close('Registration timeout detected.')
 
 class ConnectionFactory(object):
-    new_connection_event = Event()
+    new_connection_event = Event('ConnectionFactory.new_connection_event')
 
     @staticmethod
     def match_factory(value):
@@ -254,19 +1007,71 @@ class ConnectionFactory(object):
         return ircobj
 
 class IRCConnection(_BaseConnection):
-    connection_closed_event = Event()
-    registration_event = Event()
-    command_received_event = Event()
+    connection_closed_event = Event('IRCConnection.connection_closed_event')
+    registration_event = Event('IRCConnection.registration_event')
+    command_received_event = Event('IRCConnection.command_received_event')
+
+    _command_priorities = {
+        'PONG': SendScheduler.PRIORITY_HIGH,
+        'PING': SendScheduler.PRIORITY_HIGH,
+        'PASS': SendScheduler.PRIORITY_HIGH,
+        'USER': SendScheduler.PRIORITY_HIGH,
+        'NICK': SendScheduler.PRIORITY_HIGH,
+        'QUIT': SendScheduler.PRIORITY_HIGH,
+        'CAP': SendScheduler.PRIORITY_HIGH
+    }
 
-    def __init__(self, address, socket=None, factory=None):
-        _BaseConnection.__init__(self, address=address, socket=socket, factory=factory)
+    wanted_caps = [
+        'multi-prefix',
+        'userhost-in-names',
+        'away-notify',
+        'extended-join',
+        'account-notify',
+        'chghost',
+        'server-time',
+        'batch',
+        'labeled-response',
+        'cap-notify'
+    ]
+    """The capabilities which are requested if the server supports them."""
+
+    def __init__(self, address, socket=None, factory=None, tls_context=None):
+        _BaseConnection.__init__(self, address=address, socket=socket, factory=factory,
+                                 tls_context=tls_context)
         
         self.reg_nickname = None
         self.reg_username = None
         self.reg_realname = None
         self.reg_password = None
+
+        # None means the profile is picked based on the NETWORK
+        # the server announces.
+        self.flood_profile = None
+        self._scheduler = None
+
+        # MOTD lines received since the last RPL_MOTDSTART.
+        self._motd_lines = None
+
+        # ISUPPORT tokens received since 001, see irc_005().
+        self._isupport_keys = None
+
+        self.requests = RequestTracker()
+
+        # Capabilities from a multi-line CAP LS reply
+        self._cap_ls = None
+
+        # batch reference -> label
+        self._batches = {}
         
     def handle_connection_made(self):
+        if self.flood_profile != None:
+            profile = self.flood_profile
+        else:
+            profile = get_network_profile(None)
+
+        self._scheduler = SendScheduler(self, self._line_writer, profile)
+        self._scheduler.start()
+
         _BaseConnection.handle_connection_made(self)
 
         if self.reg_nickname == None:
@@ -278,20 +1083,175 @@ class IRCConnection(_BaseConnection):
         if self.reg_realname == None:
             raise ValueError('reg_realname attribute not set')
 
+        self.send_message('CAP', 'LS', '302')
+
         if self.reg_password != None:
             self.send_message('PASS', self.reg_password)
 
         self.send_message('USER', self.reg_username, '0', '*', self.reg_realname)
         self.send_message('NICK', self.reg_nickname)
 
+    def handle_connection_resumed(self, state):
+        scheduler_state = state['scheduler']
+
+        if self.flood_profile != None:
+            profile = self.flood_profile
+        else:
+            profile = get_profile(scheduler_state['profile'])
+
+        self._scheduler = SendScheduler(self, self._line_writer, profile)
+        self._scheduler.restore(scheduler_state)
+        self._scheduler.start()
+
+        _BaseConnection.handle_connection_resumed(self, state)
+
+    def detach(self):
+        self._detached = True
+
+        # Stop reading before the scheduler is stopped so
+        # that nothing gets queued after that.
+        if self._greenlet != None:
+            self._greenlet.kill(block=True)
+
+        scheduler_state = self._scheduler.detach()
+
+        state = _BaseConnection.detach(self)
+        state['scheduler'] = scheduler_state
+
+        return state
+
+    def get_state(self):
+        state = _BaseConnection.get_state(self)
+
+        state['reg_nickname'] = self.reg_nickname
+        state['reg_username'] = self.reg_username
+        state['reg_realname'] = self.reg_realname
+        state['network'] = {
+            'server': self.network_info.server,
+            'isupport': self.network_info.isupport,
+            'motd': self.network_info.motd
+        }
+        state['channels'] = [channelobj.get_state() for channelobj in self.channels.values()]
+
+        return state
+
+    def set_state(self, state):
+        _BaseConnection.set_state(self, state)
+
+        self.reg_nickname = state['reg_nickname']
+        self.reg_username = state['reg_username']
+        self.reg_realname = state['reg_realname']
+
+        network = state['network']
+
+        if network['server'] != None:
+            self.network_info = get_network_info(network['server'], self.socket_address)
+
+        for key, value in network['isupport'].items():
+            self.network_info.set_isupport(key, value)
+
+        if len(self.network_info.motd) == 0:
+            self.network_info.set_motd(network['motd'])
+
+        self.handle_caps_changed()
+
+        for channel_state in state['channels']:
+            channelobj = Channel(self, channel_state['name'])
+            channelobj.set_state(channel_state)
+            self.channels[channelobj.name] = channelobj
+
+    def get_queue_length(self):
+        length = _BaseConnection.get_queue_length(self)
+
+        if self._scheduler != None:
+            length += self._scheduler.get_queue_length()
+
+        return length
+
+    def _run(self):
+        try:
+            _BaseConnection._run(self)
+        finally:
+            if self._scheduler != None and not self._detached:
+                self._scheduler.stop()
+
+    def send_line(self, line, priority=SendScheduler.PRIORITY_BULK):
+        self._scheduler.enqueue_line(line, priority)
+
+    def send_lines(self, lines, priority=SendScheduler.PRIORITY_BULK):
+        for line in lines:
+            self._scheduler.enqueue_line(line, priority)
+
+    def send_message(self, command, *parameter_list, **kwargs):
+        """
+        Queues a message for the server. The optional 'priority' keyword
+        argument selects the scheduler lane; by default registration and
+        PING/PONG messages are sent first and everything else is bulk traffic.
+        """
+
+        priority = kwargs.get('priority', None)
+
+        if priority == None:
+            priority = IRCConnection._command_priorities.get(command, SendScheduler.PRIORITY_BULK)
+
+        self._scheduler.enqueue(command, parameter_list, kwargs.get('prefix', None), priority)
+
+    def _end_isupport(self):
+        """
+        Called at the end of the MOTD, by which time the server has sent all
+        of its ISUPPORT tokens. Tokens which the server advertised on earlier
+        connections but not on this one are removed.
+        """
+
+        if self._isupport_keys == None:
+            return
+
+        if len(self._isupport_keys) > 0:
+            self.network_info.prune_isupport(self._isupport_keys)
+
+        self._isupport_keys = None
+
     def close(self, message=None):
+        if self._scheduler != None:
+            self._scheduler.stop()
+
+        # Bypass the scheduler so the QUIT makes it out before the socket
+        # is closed.
         if message != None:
-            self.send_message('QUIT', message)
+            self._line_writer.write_line(utils.format_irc_message('QUIT', message))
 
         _BaseConnection.close(self, message)
 
     def handle_unknown_command(self, nickobj, command, params):
-        print "No idea how to handle this: command=", command, " - params=", params
+        _log.debug('No idea how to handle this: command=%s - params=%s', command, params)
+
+    def request_caps(self, caps):
+        """Requests the wanted capabilities from the specified list (e.g. from CAP LS)."""
+
+        available = set([cap.split('=', 1)[0] for cap in caps]) | self.caps
+        wanted = [cap for cap in IRCConnection.wanted_caps if cap in available and not cap in self.caps]
+
+        # labeled-response replies with more than one line use batches.
+        if 'labeled-response' in wanted and not 'batch' in available:
+            wanted.remove('labeled-response')
+
+        if len(wanted) > 0:
+            self.send_message('CAP', 'REQ', ' '.join(wanted))
+        elif not self.registered:
+            self.send_message('CAP', 'END')
+
+    def handle_caps_changed(self):
+        self.requests.labels_enabled = 'labeled-response' in self.caps and 'batch' in self.caps
+
+    def get_request_label(self):
+        """Returns the labeled-response label of the line which is currently being processed."""
+
+        label = self.message_tags.get('label', None)
+
+        if label == None and 'batch' in self.message_tags:
+            label = self._batches.get(self.message_tags['batch'], None)
+
+        return label
 
     class CommandHandlers(object):
         _initialized = False
@@ -307,6 +1267,16 @@ class IRCConnection(_BaseConnection):
                                                               Event.Handler, match_command('PING'))
             IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_ERROR,
                                                               Event.Handler, match_command('ERROR'))
+            IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_CAP,
+                                                              Event.Handler, match_command('CAP'))
+            IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_BATCH,
+                                                              Event.PreObserver, match_command('BATCH'))
+            IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_AWAY,
+                                                              Event.PreObserver, match_command('AWAY'))
+            IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_ACCOUNT,
+                                                              Event.PreObserver, match_command('ACCOUNT'))
+            IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_CHGHOST,
+                                                              Event.PreObserver, match_command('CHGHOST'))
             IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_001,
                                                               Event.PreObserver, match_command('001'))
             IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_005,
@@ -315,6 +1285,10 @@ class IRCConnection(_BaseConnection):
                                                               Event.PreObserver, match_command('375'))
             IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_372,
                                                               Event.PreObserver, match_command('372'))
+            IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_376,
+                                                              Event.PreObserver, match_command('376'))
+            IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_422,
+                                                              Event.PreObserver, match_command('422'))
             IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_NICK,
                                                               Event.PreObserver, match_command('NICK'))
             IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_JOIN,
@@ -341,6 +1315,16 @@ class IRCConnection(_BaseConnection):
                                                               Event.PreObserver, match_command('TOPIC'))
             IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_329,
                                                               Event.PreObserver, match_command('329'))
+            IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_MODE,
+                                                              Event.PreObserver, match_command('MODE'))
+            IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_324,
+                                                              Event.PreObserver, match_command('324'))
+            IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_367,
+                                                              Event.PreObserver, match_command('367'))
+            IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_368,
+                                                              Event.PreObserver, match_command('368'))
+            IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_352,
+                                                              Event.PreObserver, match_command('352'))
             IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_305,
                                                               Event.PreObserver, match_command('305'))
             IRCConnection.command_received_event.add_listener(IRCConnection.CommandHandlers.irc_306,
@@ -363,6 +1347,99 @@ class IRCConnection(_BaseConnection):
 
             return Event.Handled            
             
+        # :irc.example.net CAP * LS * :multi-prefix extended-join sasl=PLAIN
+        # :irc.example.net CAP * ACK :multi-prefix extended-join
+        @staticmethod
+        def irc_CAP(evt, ircobj, command, nickobj, params):
+            if len(params) < 3:
+                return Event.Continue
+
+            subcommand = params[1].upper()
+            caps = params[-1].split()
+
+            if subcommand == 'LS':
+                if ircobj._cap_ls == None:
+                    ircobj._cap_ls = []
+
+                ircobj._cap_ls.extend(caps)
+
+                # More lines are going to follow.
+                if len(params) > 3 and params[2] == '*':
+                    return Event.Handled
+
+                caps = ircobj._cap_ls
+                ircobj._cap_ls = None
+
+                ircobj.request_caps(caps)
+            elif subcommand == 'NEW':
+                ircobj.request_caps(caps)
+            elif subcommand == 'ACK':
+                for cap in caps:
+                    if cap[0] == '-':
+                        ircobj.caps.discard(cap[1:])
+                    else:
+                        ircobj.caps.add(cap)
+
+                ircobj.handle_caps_changed()
+
+                if not ircobj.registered:
+                    ircobj.send_message('CAP', 'END')
+            elif subcommand == 'NAK':
+                if not ircobj.registered:
+                    ircobj.send_message('CAP', 'END')
+            elif subcommand == 'DEL':
+                for cap in caps:
+                    ircobj.caps.discard(cap)
+
+                ircobj.handle_caps_changed()
+
+            return Event.Handled
+
+        # @label=sbnc1 :irc.example.net BATCH +yXNAbvnRHTRBv labeled-response
+        # :irc.example.net BATCH -yXNAbvnRHTRBv
+        @staticmethod
+        def irc_BATCH(evt, ircobj, command, nickobj, params):
+            if len(params) < 1:
+                return
+
+            reference = params[0]
+
+            if reference[:1] == '+':
+                ircobj._batches[reference[1:]] = ircobj.message_tags.get('label', None)
+            elif reference[:1] == '-':
+                label = ircobj._batches.pop(reference[1:], None)
+
+                if label != None:
+                    ircobj.requests.end_batch(label)
+
+        # :shroud!~shroud@help.shroudbnc.info AWAY :Gone fishing
+        @staticmethod
+        def irc_AWAY(evt, ircobj, command, nickobj, params):
+            if nickobj == None:
+                return
+
+            nickobj.away = len(params) > 0 and params[0] != ''
+
+        # :shroud!~shroud@help.shroudbnc.info ACCOUNT shroud
+        @staticmethod
+        def irc_ACCOUNT(evt, ircobj, command, nickobj, params):
+            if len(params) < 1 or nickobj == None:
+                return
+
+            if params[0] == '*':
+                nickobj.account = None
+            else:
+                nickobj.account = params[0]
+
+        # :shroud!~shroud@help.shroudbnc.info CHGHOST ~shroud shroud.users.quakenet.org
+        @staticmethod
+        def irc_CHGHOST(evt, ircobj, command, nickobj, params):
+            if len(params) < 2 or nickobj == None:
+                return
+
+            nickobj.user = utils.intern_string(params[0])
+            nickobj.host = utils.intern_string(params[1])
+
         # :wineasy1.se.quakenet.org 001 shroud_ :Welcome to the QuakeNet IRC Network, shroud_
         @staticmethod
         def irc_001(evt, ircobj, command, nickobj, params):
@@ -370,6 +1447,13 @@ class IRCConnection(_BaseConnection):
 
             ircobj.server = nickobj
 
+            if nickobj != None:
+                ircobj.network_info = get_network_info(nickobj.nick, ircobj.socket_address)
+
+            # The ISUPPORT tokens the server sends during this registration,
+            # so we can get rid of the ones it doesn't advertise anymore.
+            ircobj._isupport_keys = set()
+
             ircobj.register_user()
 
         # :wineasy1.se.quakenet.org 005 shroud_ WHOX WALLCHOPS WALLVOICES USERIP CPRIVMSG CNOTICE \
@@ -385,24 +1469,35 @@ class IRCConnection(_BaseConnection):
                 tokens = attrib.split('=', 2)
                 key = tokens[0]
 
+                # -KEY means that the server doesn't support KEY anymore.
+                if key[:1] == '-':
+                    ircobj.network_info.remove_isupport(key[1:])
+                    continue
+
+                if ircobj._isupport_keys != None:
+                    ircobj._isupport_keys.add(key)
+
                 if len(tokens) > 1:
                     value = tokens[1]
                 else:
                     value = ''
 
-                ircobj.isupport[key] = value
+                ircobj.network_info.set_isupport(key, value)
+
+                if key == 'NETWORK' and ircobj.flood_profile == None:
+                    ircobj._scheduler.profile = get_network_profile(value)
 
-            print attribs
+            _log.debug('ISUPPORT: %s', attribs)
 
         # :wineasy1.se.quakenet.org 375 shroud_ :- wineasy1.se.quakenet.org Message of the Day - 
         @staticmethod
         def irc_375(evt, ircobj, command, nickobj, params):
-            ircobj.motd = []
+            ircobj._motd_lines = []
 
         # :wineasy1.se.quakenet.org 372 shroud_ :- ** [ wineasy.se.quakenet.org ] **************************************** 
         @staticmethod
         def irc_372(evt, ircobj, command, nickobj, params):
-            if len(params) < 2:
+            if len(params) < 2 or ircobj._motd_lines == None:
                 return
 
             motdline = params[1]
@@ -410,7 +1505,26 @@ class IRCConnection(_BaseConnection):
             if motdline[:2] == '- ':
                 motdline = motdline[2:]
             
-            ircobj.motd.append(params[1])
+            ircobj._motd_lines.append(motdline)
+
+        # :wineasy1.se.quakenet.org 376 shroud_ :End of /MOTD command.
+        @staticmethod
+        def irc_376(evt, ircobj, command, nickobj, params):
+            ircobj._end_isupport()
+
+            if ircobj._motd_lines == None:
+                return
+
+            ircobj.network_info.set_motd(ircobj._motd_lines)
+            ircobj._motd_lines = None
+
+        # :wineasy1.se.quakenet.org 422 shroud_ :MOTD File is missing
+        @staticmethod
+        def irc_422(evt, ircobj, command, nickobj, params):
+            ircobj._end_isupport()
+
+            ircobj.network_info.set_motd([])
+            ircobj._motd_lines = None
 
         # :shroud_!~shroud@p579F98A1.dip.t-dialin.net NICK :shroud__
         @staticmethod
@@ -426,10 +1540,13 @@ class IRCConnection(_BaseConnection):
 
             if oldnick in ircobj.nicks:
                 nickobj = ircobj.nicks[oldnick]
-                nickobj.nick = newnick
+                nickobj.nick = utils.intern_string(newnick)
                 
                 del ircobj.nicks[oldnick]
                 ircobj.nicks[newnick] = nickobj
+
+            for channelobj in ircobj.channels.values():
+                channelobj.rename_nick(oldnick, nickobj)
                 
         # :shroud_!~shroud@p579F98A1.dip.t-dialin.net JOIN #sbncng
         @staticmethod
@@ -442,12 +1559,31 @@ class IRCConnection(_BaseConnection):
             if nickobj == ircobj.me:
                 channelobj = Channel(ircobj, channel)
                 ircobj.channels[channel] = channelobj
+
+                # The modes aren't queried here: the replies would go to every
+                # client. The first client which asks gets the server's reply
+                # (which fills in the channel's state), later ones are answered
+                # locally, see ClientConnection.CommandHandlers.irc_MODE.
             else:
                 if not channel in ircobj.channels:
                     return
                 
                 channelobj = ircobj.channels[channel]
 
+            # extended-join: JOIN #channel account :realname
+            if len(params) >= 3:
+                if params[1] == '*':
+                    nickobj.account = None
+                else:
+                    nickobj.account = params[1]
+
+                nickobj.realname = params[2]
+
+            # Servers send an AWAY for new members who are away.
+            if 'away-notify' in ircobj.caps:
+                nickobj.away_tracked = True
+                nickobj.track_time = time.time()
+
             channelobj.add_nick(nickobj)
 
         # :shroud_!~shroud@p579F98A1.dip.t-dialin.net PART #sbncng
@@ -464,12 +1600,7 @@ class IRCConnection(_BaseConnection):
             if nickobj == ircobj.me:
                 del ircobj.channels[channel]
             else:            
-                channelobj = ircobj.channels[channel]
-                
-                if not nickobj in channelobj.nicks:
-                    return
-                
-                channelobj.remove_nick(nickobj)
+                ircobj.channels[channel].remove_nick(nickobj)
 
         # :shroud_!~shroud@p579F98A1.dip.t-dialin.net KICK #sbncng sbncng :test
         @staticmethod
@@ -488,20 +1619,16 @@ class IRCConnection(_BaseConnection):
             if victimobj == ircobj.me:
                 del ircobj.channels[channel]
             else:
-                channelobj = ircobj.channels[channel]
-                
-                if not nickobj in channelobj.nicks:
-                    return
-                
-                channelobj.remove_nick(nickobj)
+                ircobj.channels[channel].remove_nick(victimobj)
             
         # :shroud_!~shroud@p579F98A1.dip.t-dialin.net QUIT :test
         @staticmethod
         def irc_QUIT(evt, ircobj, command, nickobj, params):
-            channels = list(nickobj.channels)
-            
-            for channel in channels:
-                channel.remove_nick(nickobj)
+            if nickobj == None:
+                return
+
+            for channelobj in ircobj.channels.values():
+                channelobj.remove_nick(nickobj)
             
         # :server.shroudbnc.info 353 sbncng = #sbncng :sbncng @shroud
         @staticmethod
@@ -514,33 +1641,7 @@ class IRCConnection(_BaseConnection):
             if not channel in ircobj.channels:
                 return
             
-            channelobj = ircobj.channels[channel]
-            
-            tokens = params[3].split(' ')
-            
-            for token in tokens:
-                nick = token
-                modes = ''
-                
-                while len(nick) > 0:
-                    mode = utils.prefix_to_mode(ircobj.isupport['PREFIX'], nick[0])
-                    
-                    if mode == None:
-                        break
-                    
-                    nick = nick[1:]
-                    modes += mode
-                
-                nickobj = ircobj.get_nick(nick)
-                
-                if nickobj in channelobj.nicks:
-                    membership = channelobj.nicks[nickobj]
-                else:
-                    membership = channelobj.add_nick(nickobj)
-
-                membership.modes = modes
-                
-                print nick, modes
+            ircobj.channels[channel].add_names(params[3])
         
         # :server.shroudbnc.info 366 sbncng #sbncng :End of /NAMES list.
         @staticmethod
@@ -582,9 +1683,9 @@ class IRCConnection(_BaseConnection):
             
             channelobj = ircobj.channels[channel]
 
-            channelobj.topic_text = None
-            channelobj.topic_nick = None
-            channelobj.topic_time = None
+            channelobj.info.set_topic_text(None)
+            channelobj.info.set_topic_nick(None)
+            channelobj.info.topic_time = None
             channelobj.has_topic = True
         
         # :underworld2.no.quakenet.org 332 #channel :Some topic.
@@ -600,7 +1701,7 @@ class IRCConnection(_BaseConnection):
             
             channelobj = ircobj.channels[channel]
 
-            channelobj.topic_text = params[2]
+            channelobj.info.set_topic_text(params[2])
             
             if channelobj.topic_nick != None:
                 channelobj.has_topic = True
@@ -620,8 +1721,8 @@ class IRCConnection(_BaseConnection):
             
             channelobj = ircobj.channels[channel]
 
-            channelobj.topic_nick = Nick(ircobj, topic_nick)
-            channelobj.topic_time = datetime.fromtimestamp(int(ts))
+            channelobj.info.set_topic_nick(topic_nick)
+            channelobj.info.topic_time = int(ts)
             
             if channelobj.topic_text != None:
                 channelobj.has_topic = True
@@ -640,9 +1741,9 @@ class IRCConnection(_BaseConnection):
             
             channelobj = ircobj.channels[channel]
             
-            channelobj.topic_text = topic
-            channelobj.topic_nick = copy(nickobj)
-            channelobj.topic_time = datetime.now()
+            channelobj.info.set_topic_text(topic)
+            channelobj.info.set_topic_nick(nickobj)
+            channelobj.info.topic_time = int(time.time())
             channelobj.has_topic = True
                 
         # :underworld2.no.quakenet.org 329 shroud #sbfl 1233690341
@@ -652,15 +1753,115 @@ class IRCConnection(_BaseConnection):
                 return
             
             channel = params[1]
-            ts = params[2]
-            
+            ts = params[2]
+            
+            if not channel in ircobj.channels:
+                return
+            
+            channelobj = ircobj.channels[channel]
+            
+            channelobj.creation_time = datetime.fromtimestamp(int(ts))
+
+        # :shroud!shroud@help MODE #sbncng +o-b+l sbncng *!*@foo 50
+        @staticmethod
+        def irc_MODE(evt, ircobj, command, nickobj, params):
+            if len(params) < 2:
+                return
+
+            target = params[0]
+
+            if target in ircobj.channels:
+                changes = utils.parse_mode_changes(params[1], params[2:],
+                                                   ircobj.network_info.get_chanmodes(),
+                                                   ircobj.network_info.get_prefix_modes())
+
+                ircobj.channels[target].apply_mode_changes(changes, nickobj)
+            elif target == ircobj.me.nick:
+                usermodes = ircobj.usermodes
+
+                for adding, mode, _ in utils.parse_mode_changes(params[1], [], ('', '', '', ''), ''):
+                    if adding and not mode in usermodes:
+                        usermodes += mode
+                    elif not adding:
+                        usermodes = usermodes.replace(mode, '')
+
+                ircobj.usermodes = usermodes
+
+        # :underworld2.no.quakenet.org 324 shroud #sbncng +tnlk 50 key
+        @staticmethod
+        def irc_324(evt, ircobj, command, nickobj, params):
+            if len(params) < 3:
+                return
+
+            channel = params[1]
+
+            if not channel in ircobj.channels:
+                return
+
+            changes = utils.parse_mode_changes(params[2], params[3:],
+                                               ircobj.network_info.get_chanmodes(),
+                                               ircobj.network_info.get_prefix_modes())
+
+            ircobj.channels[channel].set_modes(changes)
+
+        # :underworld2.no.quakenet.org 367 shroud #sbncng *!*@foo shroud!shroud@help 1297723476
+        @staticmethod
+        def irc_367(evt, ircobj, command, nickobj, params):
+            if len(params) < 3:
+                return
+
+            channel = params[1]
+
+            if not channel in ircobj.channels:
+                return
+
+            if len(params) > 3:
+                setter = params[3]
+            else:
+                setter = None
+
+            if len(params) > 4:
+                ts = params[4]
+            else:
+                ts = None
+
+            ircobj.channels[channel].add_list_entry('b', params[2], setter, ts)
+
+        # :underworld2.no.quakenet.org 368 shroud #sbncng :End of Channel Ban List
+        @staticmethod
+        def irc_368(evt, ircobj, command, nickobj, params):
+            if len(params) < 2:
+                return
+
+            channel = params[1]
+
             if not channel in ircobj.channels:
                 return
-            
-            channelobj = ircobj.channels[channel]
-            
-            channelobj.creation_time = datetime.fromtimestamp(int(ts))
+
+            ircobj.channels[channel].end_list('b')
         
+        # :underworld2.no.quakenet.org 352 shroud #sbncng ~shroud help.shroudbnc.info *.quakenet.org shroud H@ :3 Gunnar Beutner
+        @staticmethod
+        def irc_352(evt, ircobj, command, nickobj, params):
+            if len(params) < 8:
+                return
+
+            whoobj = ircobj.get_nick({'nick': params[5], 'user': params[2], 'host': params[3]})
+
+            flags = params[6]
+            # The hop count isn't tracked.
+            realname = params[7].partition(' ')[2]
+
+            whoobj.server = utils.intern_string(params[4])
+            whoobj.realname = realname
+            whoobj.away = 'G' in flags
+            whoobj.opered = '*' in flags
+            whoobj.who_time = time.time()
+
+            if 'away-notify' in ircobj.caps:
+                whoobj.away_tracked = True
+                whoobj.track_time = whoobj.who_time
+
         # :underworld2.no.quakenet.org 305 shroud :You are no longer marked as being away
         @staticmethod
         def irc_305(evt, ircobj, command, nickobj, params):
@@ -681,16 +1882,24 @@ class ClientConnection(_BaseConnection):
     rpls = {
         'RPL_WELCOME': (1, 'Welcome to the Internet Relay Network %s'),
         'RPL_ISUPPORT': (5, 'are supported by this server'),
+        'RPL_USERHOST': (302, None),
+        'RPL_ISON': (303, None),
         'RPL_UNAWAY': (305, 'You are no longer marked as being away'),
         'RPL_NOWAWAY': (306, 'You have been marked as being away'),
+        'RPL_ENDOFWHO': (315, 'End of /WHO list.'),
+        'RPL_CHANNELMODEIS': (324, None),
+        'RPL_CREATIONTIME': (329, None),
         'RPL_NOTOPIC': (331, 'No topic is set'),
         'RPL_TOPIC': (332, None),
         'RPL_TOPICWHOTIME': (333, None),
         'RPL_NAMREPLY': (353, None),
         'RPL_ENDOFNAMES': (366, 'End of NAMES list'),
+        'RPL_BANLIST': (367, None),
+        'RPL_ENDOFBANLIST': (368, 'End of Channel Ban List'),
         'RPL_MOTDSTART': (375, '- %s Message of the day -'),
         'RPL_MOTD': (372, '- %s'),
         'RPL_ENDMOTD': (376, 'End of MOTD command'),
+        'ERR_INVALIDCAPCMD': (410, 'Invalid CAP subcommand'),
         'ERR_NOTEXTTOSEND': (412, 'No text to send'),
         'ERR_UNKNOWNCOMMAND': (421, 'Unknown command'),
         'ERR_NOMOTD': (422, 'MOTD File is missing'),
@@ -700,13 +1909,28 @@ class ClientConnection(_BaseConnection):
         'ERR_ALREADYREGISTRED': (462, 'Unauthorized command (already registered)')
     }
 
-    connection_closed_event = Event()
-    registration_event = Event()
-    command_received_event = Event()
-    authentication_event = Event()
-
-    def __init__(self, address, socket, factory=None):
-        _BaseConnection.__init__(self, address=address, socket=socket, factory=factory)
+    connection_closed_event = Event('ClientConnection.connection_closed_event')
+    registration_event = Event('ClientConnection.registration_event')
+    command_received_event = Event('ClientConnection.command_received_event')
+    authentication_event = Event('ClientConnection.authentication_event')
+
+    supported_caps = [
+        'multi-prefix',
+        'userhost-in-names',
+        'away-notify',
+        'extended-join',
+        'account-notify',
+        'chghost',
+        'server-time'
+    ]
+    """The capabilities clients can request."""
+
+    def __init__(self, address, socket, factory=None, tls_context=None):
+        _BaseConnection.__init__(self, address=address, socket=socket, factory=factory,
+                                 tls_context=tls_context)
+
+        # Registration is delayed until CAP END.
+        self._cap_negotiating = False
 
         self.me.host = self.socket_address[0]
         self.server.nick = ClientConnection.DEFAULT_SERVERNAME
@@ -743,6 +1967,21 @@ class ClientConnection(_BaseConnection):
         return self.send_message(command, *[nick] + list(params) + text_list, \
                                 **{'prefix': self.server})
 
+    def send_rendered_replies(self, numeric, replies):
+        """
+        Sends several replies which have been rendered without the prefix,
+        numeric and target (e.g. the ones from NetworkInfo) as one batch.
+        """
+
+        nick = self.me.nick
+
+        if nick == None:
+            nick = '*'
+
+        head = ':%s %s %s ' % (self.server, numeric, nick)
+
+        self.send_lines([head + reply for reply in replies])
+
     def handle_connection_made(self):
         _BaseConnection.handle_connection_made(self)
 
@@ -766,7 +2005,7 @@ class ClientConnection(_BaseConnection):
     def register_user(self):
         assert not self.registered
 
-        if self.me.nick == None or self.me.user == None:
+        if self.me.nick == None or self.me.user == None or self._cap_negotiating:
             return
 
         if self._password == None:
@@ -810,6 +2049,8 @@ class ClientConnection(_BaseConnection):
                                                                  Event.Handler, match_command('NICK'))
             ClientConnection.command_received_event.add_listener(ClientConnection.CommandHandlers.irc_PASS,
                                                                  Event.Handler, match_command('PASS'))
+            ClientConnection.command_received_event.add_listener(ClientConnection.CommandHandlers.irc_CAP,
+                                                                 Event.Handler, match_command('CAP'))
             ClientConnection.command_received_event.add_listener(ClientConnection.CommandHandlers.irc_QUIT,
                                                                  Event.Handler, match_command('QUIT'))
             ClientConnection.command_received_event.add_listener(ClientConnection.CommandHandlers.irc_VERSION,
@@ -820,6 +2061,14 @@ class ClientConnection(_BaseConnection):
                                                                  Event.Handler, match_command('NAMES'))
             ClientConnection.command_received_event.add_listener(ClientConnection.CommandHandlers.irc_TOPIC,
                                                                  Event.Handler, match_command('TOPIC'))
+            ClientConnection.command_received_event.add_listener(ClientConnection.CommandHandlers.irc_MODE,
+                                                                 Event.Handler, match_command('MODE'))
+            ClientConnection.command_received_event.add_listener(ClientConnection.CommandHandlers.irc_WHO,
+                                                                 Event.Handler, match_command('WHO'))
+            ClientConnection.command_received_event.add_listener(ClientConnection.CommandHandlers.irc_USERHOST,
+                                                                 Event.Handler, match_command('USERHOST'))
+            ClientConnection.command_received_event.add_listener(ClientConnection.CommandHandlers.irc_ISON,
+                                                                 Event.Handler, match_command('ISON'))
 
         # USER shroud * 0 :Gunnar Beutner
         @staticmethod
@@ -887,6 +2136,62 @@ class ClientConnection(_BaseConnection):
             
             return Event.Handled
 
+        # CAP LS 302
+        # CAP REQ :multi-prefix server-time
+        # CAP END
+        @staticmethod
+        def irc_CAP(evt, ircobj, command, nickobj, params):
+            if len(params) < 1:
+                ircobj.send_reply('ERR_NEEDMOREPARAMS', 'CAP')
+                return Event.Handled
+
+            subcommand = params[0].upper()
+
+            nick = ircobj.me.nick
+
+            if nick == None:
+                nick = '*'
+
+            if subcommand == 'LS':
+                if not ircobj.registered:
+                    ircobj._cap_negotiating = True
+
+                ircobj.send_message('CAP', nick, 'LS', ' '.join(ClientConnection.supported_caps),
+                                    prefix=ircobj.server)
+            elif subcommand == 'LIST':
+                ircobj.send_message('CAP', nick, 'LIST', ' '.join(sorted(ircobj.caps)),
+                                    prefix=ircobj.server)
+            elif subcommand == 'REQ':
+                if not ircobj.registered:
+                    ircobj._cap_negotiating = True
+
+                if len(params) > 1:
+                    caps = params[-1].split()
+                else:
+                    caps = []
+
+                # Either all of the capabilities are changed or none.
+                for cap in caps:
+                    if not cap.lstrip('-') in ClientConnection.supported_caps:
+                        ircobj.send_message('CAP', nick, 'NAK', ' '.join(caps), prefix=ircobj.server)
+                        return Event.Handled
+
+                for cap in caps:
+                    if cap[0] == '-':
+                        ircobj.caps.discard(cap[1:])
+                    else:
+                        ircobj.caps.add(cap)
+
+                ircobj.send_message('CAP', nick, 'ACK', ' '.join(caps), prefix=ircobj.server)
+            elif subcommand == 'END':
+                if not ircobj.registered and ircobj._cap_negotiating:
+                    ircobj._cap_negotiating = False
+                    ircobj.register_user()
+            else:
+                ircobj.send_reply('ERR_INVALIDCAPCMD', params[0])
+
+            return Event.Handled
+
         # VERSION
         @staticmethod
         def irc_VERSION(evt, ircobj, command, nickobj, params):
@@ -895,25 +2200,7 @@ class ClientConnection(_BaseConnection):
             
             # TODO: missing support for RPL_VERSION
             
-            attribs = []
-            length = 0
-
-            for key, value in ircobj.isupport.items():
-                if len(value) > 0:
-                    attrib = '%s=%s' % (key, value)
-                else:
-                    attrib = key
-
-                attribs.append(attrib)
-                length += len(attrib)
-
-                if length > 300:
-                    attribs = []
-                    length = 0
-                    ircobj.send_reply('RPL_ISUPPORT', *attribs)
-
-            if length > 0:
-                ircobj.send_reply('RPL_ISUPPORT', *attribs)
+            ircobj.send_rendered_replies('005', ircobj.network_info.get_isupport_replies())
 
             return Event.Handled
 
@@ -925,10 +2212,7 @@ class ClientConnection(_BaseConnection):
             
             if len(ircobj.motd) > 0:
                 ircobj.send_reply('RPL_MOTDSTART', format_args=(ircobj.server))
-
-                for line in ircobj.motd:
-                    ircobj.send_reply('RPL_MOTD', format_args=(line))
-
+                ircobj.send_rendered_replies('372', ircobj.network_info.get_motd_replies())
                 ircobj.send_reply('RPL_ENDMOTD')
             else:
                 ircobj.send_reply('ERR_NOMOTD')
@@ -960,19 +2244,20 @@ class ClientConnection(_BaseConnection):
             
             nicklist = []
             length = 0
+
+            prefixes = ircobj.isupport['PREFIX']
+            multi_prefix = 'multi-prefix' in ircobj.caps
+            userhost_in_names = 'userhost-in-names' in ircobj.caps
             
             for nickobj, membership in channelobj.nicks.items():
-                length += len(nickobj.nick)
-                
-                prefixes = ''
-                
-                for mode in membership.modes:
-                    prefix = utils.mode_to_prefix(ircobj.isupport['PREFIX'], mode)
-                    
-                    if prefix != None:
-                        prefixes += prefix
+                if userhost_in_names:
+                    name = str(nickobj)
+                else:
+                    name = nickobj.nick
+
+                length += len(name)
                 
-                nicklist.append(prefixes + nickobj.nick)
+                nicklist.append(utils.format_prefixes(prefixes, membership.modes, multi_prefix) + name)
                 
                 if length > 300:
                     ircobj.send_reply('RPL_NAMREPLY', chantype, channel, ' '.join(nicklist))
@@ -1007,21 +2292,190 @@ class ClientConnection(_BaseConnection):
             else:
                 ircobj.send_reply('RPL_TOPIC', channel, channelobj.topic_text)
                 ircobj.send_reply('RPL_TOPICWHOTIME', channel, str(channelobj.topic_nick), \
-                                  str(time.mktime(channelobj.topic_time.timetuple())))
+                                  str(channelobj.info.topic_time))
                 
             return Event.Handled
 
+        # MODE #channel
+        # MODE #channel +b
+        @staticmethod
+        def irc_MODE(evt, ircobj, command, nickobj, params):
+            if len(params) < 1 or len(params) > 2 or not ircobj.registered:
+                return Event.Continue
+
+            channel = params[0]
+
+            if channel not in ircobj.channels:
+                return Event.Continue
+
+            channelobj = ircobj.channels[channel]
+
+            if len(params) == 1:
+                if not channelobj.has_modes:
+                    return Event.Continue
+
+                ircobj.send_reply('RPL_CHANNELMODEIS', channel, *channelobj.get_mode_params())
+
+                if channelobj.creation_time != None:
+                    ircobj.send_reply('RPL_CREATIONTIME', channel,
+                                      str(int(time.mktime(channelobj.creation_time.timetuple()))))
+
+                return Event.Handled
+
+            if params[1] not in ('b', '+b') or not channelobj.has_bans:
+                return Event.Continue
+
+            replies = []
+
+            for mask, (setter, ts) in channelobj.bans.items():
+                if setter != None and ts != None:
+                    replies.append('%s %s %s %s' % (channel, mask, setter, ts))
+                else:
+                    replies.append('%s %s' % (channel, mask))
+
+            replies.append('%s :%s' % (channel, ClientConnection.rpls['RPL_ENDOFBANLIST'][1]))
+
+            ircobj.send_rendered_replies('367', replies[:-1])
+            ircobj.send_rendered_replies('368', replies[-1:])
+
+            return Event.Handled
+
+        # WHO #channel
+        # WHO nick
+        @staticmethod
+        def irc_WHO(evt, ircobj, command, nickobj, params):
+            # Queries with flags (e.g. WHOX) always go to the server.
+            if len(params) != 1 or not ircobj.registered:
+                return Event.Continue
+
+            target = params[0]
+
+            if target in ircobj.channels:
+                channelobj = ircobj.channels[target]
+                members = channelobj.nicks.items()
+            elif target in ircobj.nicks:
+                channelobj = None
+                members = [(ircobj.nicks[target], None)]
+            else:
+                return Event.Continue
+
+            prefixes = ircobj.isupport['PREFIX']
+            multi_prefix = 'multi-prefix' in ircobj.caps
+            replies = []
+
+            for whoobj, membership in members:
+                if not WhoCache.is_nick_fresh(whoobj):
+                    return Event.Continue
+
+                if whoobj.away:
+                    flags = 'G'
+                else:
+                    flags = 'H'
+
+                if whoobj.opered:
+                    flags += '*'
+
+                if membership != None:
+                    flags += utils.format_prefixes(prefixes, membership.modes, multi_prefix)
+
+                if channelobj != None:
+                    channel = channelobj.name
+                else:
+                    channel = '*'
+
+                server = whoobj.server
+
+                if server == None:
+                    server = '*'
+
+                replies.append('%s %s %s %s %s %s :0 %s' % (channel, whoobj.user, whoobj.host, server,
+                                                            whoobj.nick, flags, whoobj.realname))
+
+            replies.append('%s :%s' % (target, ClientConnection.rpls['RPL_ENDOFWHO'][1]))
+
+            ircobj.send_rendered_replies('352', replies[:-1])
+            ircobj.send_rendered_replies('315', replies[-1:])
+
+            return Event.Handled
+
+        # USERHOST nick1 nick2
+        @staticmethod
+        def irc_USERHOST(evt, ircobj, command, nickobj, params):
+            if len(params) < 1 or not ircobj.registered:
+                return Event.Continue
+
+            tokens = []
+
+            for nick in params[:5]:
+                if not nick in ircobj.nicks:
+                    return Event.Continue
+
+                whoobj = ircobj.nicks[nick]
+
+                if not WhoCache.is_nick_fresh(whoobj):
+                    return Event.Continue
+
+                token = whoobj.nick
+
+                if whoobj.opered:
+                    token += '*'
+
+                if whoobj.away:
+                    token += '=-'
+                else:
+                    token += '=+'
+
+                tokens.append(token + whoobj.user + '@' + whoobj.host)
+
+            ircobj.send_reply('RPL_USERHOST', ' '.join(tokens))
+
+            return Event.Handled
+
+        # ISON nick1 nick2
+        @staticmethod
+        def irc_ISON(evt, ircobj, command, nickobj, params):
+            if len(params) < 1 or not ircobj.registered:
+                return Event.Continue
+
+            online = set([ircobj.me.nick.lower()])
+
+            for channelobj in ircobj.channels.values():
+                for memberobj in channelobj.nicks:
+                    online.add(memberobj.nick.lower())
+
+            nicks = ' '.join(params).split(' ')
+
+            # Nicks we don't share a channel with might still be
+            # online, so those have to be asked for.
+            for nick in nicks:
+                if nick != '' and not nick.lower() in online:
+                    return Event.Continue
+
+            ircobj.send_reply('RPL_ISON', ' '.join([nick for nick in nicks if nick != '']))
+
+            return Event.Handled
+
 # Register built-in handlers for the ClientConnection class        
 ClientConnection.CommandHandlers.register_handlers()
 
 class ClientListener(object):
-    def __init__(self, bind_address, factory):
+    def __init__(self, bind_address, factory, tls_context=None):
+        """
+        Listens for client connections.
+
+        bind_address: A tuple containing the local IP and port.
+        factory: The factory that is used to create connection objects.
+        tls_context: A server-side TLSContext object if clients are
+                     expected to use TLS, or None.
+        """
+
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind(bind_address)
         self.socket.listen(1)
 
         self._factory = factory
+        self._tls_context = tls_context
 
     def start(self):
         return gevent.spawn(self.run)
@@ -1029,39 +2483,438 @@ class ClientListener(object):
     def run(self):
         while True:
             sock, addr = self.socket.accept()
-            print("Accepted connection from", addr)
+            _log.info('Accepted connection from %s', addr)
+
+            # The TLS handshake is done by the connection's own greenlet
+            # so that slow clients can't hold up the accept loop.
+            self._factory.create(socket=sock, address=addr, tls_context=self._tls_context).start()
+
+def _parse_names_token(prefixes, token):
+    """
+    Splits a token from a NAMES reply (e.g. '@+shroud' or, with UHNAMES,
+    '@shroud!user@host') into the hostmask and the nick's channel modes.
+    """
+
+    nick = token
+    modes = ''
 
-            self._factory.create(socket=sock, address=addr).start()
+    while len(nick) > 0:
+        mode = utils.prefix_to_mode(prefixes, nick[0])
+
+        if mode == None:
+            break
+
+        nick = nick[1:]
+        modes += mode
+
+    return nick, modes
+
+def _update_modes(modes, adding, mode):
+    if adding:
+        if not mode in modes:
+            modes += mode
+    else:
+        modes = modes.replace(mode, '')
+
+    return modes
 
 class Channel(object):
+    lazy_names = False
+    """
+    Whether NAMES replies are kept as they are and only parsed when someone
+    accesses the nicks attribute (e.g. because a client sent NAMES). Until
+    then JOINs, PARTs, QUITs and nick changes are recorded in a patch log.
+    """
+
+    MAX_PATCHES = 256
+    """The NAMES list is parsed once the patch log grows beyond this size."""
+
     def __init__(self, ircobj, name):
         self._ircobj = ircobj
         
-        self.name = name
+        # The topic might be shared with other users on the same server.
+        self.info = ircobj.network_info.get_channel_info(name)
+
+        # The Nick object for info.topic_nick and the hostmask it was
+        # created from, see _get_topic_nick().
+        self._topic_nick = None
+        self._topic_nick_source = None
+
+        self.name = self.info.name
         self.tags = {}
-        self.nicks = {}
-        self.bans = []
-        self.modes = []
+
+        # mode -> parameter (or None)
+        self.modes = {}
+
+        # list mode -> {mask: (setter, timestamp)}
+        self.list_modes = {}
         self.join_time = datetime.now()
         self.creation_time = None
-
-        self.topic_text = None
-        self.topic_time = None
-        self.topic_nick = None
         
         self.has_names = False
         self.has_topic = False
         self.has_bans = False
         self.has_modes = False
 
+        # Whether the channel was restored from a snapshot and the
+        # server hasn't confirmed the JOIN yet.
+        self.from_snapshot = False
+
+        self._nicks = {}
+
+        self._mode_params = None
+        self._pending_lists = {}
+
+        # Raw NAMES payloads and the patch log if the nick list
+        # hasn't been parsed yet, None otherwise.
+        if Channel.lazy_names:
+            self._names = []
+            self._patches = []
+        else:
+            self._names = None
+            self._patches = None
+
+        # The nicks which can be on the channel while the NAMES list hasn't
+        # been parsed, see _may_have_nick(). None until it's first needed.
+        self._name_set = None
+
+    def _get_nicks(self):
+        if self._names != None:
+            self._materialize_names()
+
+        return self._nicks
+
+    nicks = property(_get_nicks)
+
+    def add_names(self, payload):
+        """Adds the nicks from the last parameter of a NAMES reply."""
+
+        if self._names != None and not self.has_names:
+            self._names.append(payload)
+            self._name_set = None
+            return
+
+        prefixes = self._ircobj.isupport['PREFIX']
+        nicks = self.nicks
+
+        for token in payload.split(' '):
+            if token == '':
+                continue
+
+            nick, modes = _parse_names_token(prefixes, token)
+            nickobj = self._ircobj.get_nick(nick)
+
+            if nickobj in nicks:
+                membership = nicks[nickobj]
+            else:
+                membership = self.add_nick(nickobj)
+
+            membership.modes = modes
+
+    def _add_patch(self, patch):
+        self._patches.append(patch)
+
+        if self._name_set != None:
+            Channel._patch_name_set(self._name_set, patch)
+
+        if len(self._patches) > Channel.MAX_PATCHES:
+            self._materialize_names()
+
+    def _may_have_nick(self, nick):
+        """
+        Returns whether the nick can be on the channel while the NAMES list
+        hasn't been parsed yet, so QUITs and nick changes of nicks on other
+        channels don't end up in the patch log. Only the nicks are extracted
+        from the NAMES payloads, which is much cheaper than parsing them.
+        """
+
+        if self._name_set == None:
+            prefixes = self._ircobj.isupport['PREFIX']
+            name_set = set()
+
+            for payload in self._names:
+                for token in payload.split(' '):
+                    if token != '':
+                        name_set.add(_parse_names_token(prefixes, token)[0].partition('!')[0])
+
+            for patch in self._patches:
+                Channel._patch_name_set(name_set, patch)
+
+            self._name_set = name_set
+
+        return nick in self._name_set
+
+    @staticmethod
+    def _patch_name_set(name_set, patch):
+        if patch[0] == '+':
+            name_set.add(patch[1]['nick'])
+        elif patch[0] == '-':
+            name_set.discard(patch[1])
+        elif patch[0] == '>':
+            name_set.discard(patch[1])
+            name_set.add(patch[2])
+
+    def _materialize_names(self):
+        """Parses the raw NAMES payloads and applies the patch log."""
+
+        names = self._names
+        patches = self._patches
+
+        self._names = None
+        self._patches = None
+        self._name_set = None
+
+        prefixes = self._ircobj.isupport['PREFIX']
+
+        # nick -> [hostmask dict, modes]
+        members = {}
+
+        for payload in names:
+            for token in payload.split(' '):
+                if token == '':
+                    continue
+
+                nick, modes = _parse_names_token(prefixes, token)
+                hostmask_dict = utils.parse_hostmask(nick)
+                members[hostmask_dict['nick']] = [hostmask_dict, modes]
+
+        for patch in patches:
+            if patch[0] == '+':
+                members[patch[1]['nick']] = [patch[1], '']
+            elif patch[0] == '-':
+                members.pop(patch[1], None)
+            elif patch[0] == '>':
+                entry = members.pop(patch[1], None)
+
+                if entry != None:
+                    hostmask_dict = dict(entry[0])
+                    hostmask_dict['nick'] = patch[2]
+                    entry[0] = hostmask_dict
+                    members[patch[2]] = entry
+            elif patch[0] == 'm':
+                entry = members.get(patch[1], None)
+
+                if entry != None:
+                    entry[1] = _update_modes(entry[1], patch[2], patch[3])
+
+        for hostmask_dict, modes in members.values():
+            nickobj = self._ircobj.get_nick(hostmask_dict)
+
+            membership = ChannelMembership(self, nickobj)
+            membership.modes = modes
+            self._nicks[nickobj] = membership
+
     def add_nick(self, nickobj):
+        """
+        Adds a nick to the channel. Returns the ChannelMembership object, or
+        None if the NAMES list hasn't been parsed yet.
+        """
+
+        if self._names != None:
+            self._add_patch(('+', {'nick': nickobj.nick, 'user': nickobj.user, 'host': nickobj.host}))
+            return None
+
         membership = ChannelMembership(self, nickobj)
-        self.nicks[nickobj] = membership
+        self._nicks[nickobj] = membership
 
         return membership
 
     def remove_nick(self, nickobj):
-        del self.nicks[nickobj]
+        """Removes a nick from the channel. Does nothing if the nick isn't on the channel."""
+
+        if self._names != None:
+            if self._may_have_nick(nickobj.nick):
+                self._add_patch(('-', nickobj.nick))
+        elif nickobj in self._nicks:
+            del self._nicks[nickobj]
+
+    def rename_nick(self, oldnick, nickobj):
+        """
+        Updates the channel after a nick change. The Nick object has already
+        been renamed at this point.
+        """
+
+        if self._names != None and self._may_have_nick(oldnick):
+            self._add_patch(('>', oldnick, nickobj.nick))
+
+    def apply_mode_changes(self, changes, nickobj=None):
+        """
+        Applies MODE changes as returned by utils.parse_mode_changes().
+        nickobj is the nick who changed the modes.
+        """
+
+        chanmodes = self._ircobj.network_info.get_chanmodes()
+        prefix_modes = self._ircobj.network_info.get_prefix_modes()
+
+        for adding, mode, param in changes:
+            if mode in prefix_modes:
+                if param != None:
+                    self._set_member_mode(param, adding, mode)
+            elif mode in chanmodes[0]:
+                if param == None:
+                    continue
+
+                entries = self.list_modes.setdefault(mode, {})
+
+                if adding:
+                    if nickobj != None:
+                        setter = str(nickobj)
+                    else:
+                        setter = None
+
+                    entries[param] = (setter, str(int(time.time())))
+                else:
+                    entries.pop(param, None)
+            else:
+                if adding:
+                    self.modes[mode] = param
+                else:
+                    self.modes.pop(mode, None)
+
+                self._mode_params = None
+
+    def set_modes(self, changes):
+        """Replaces the channel's modes, e.g. with the ones from RPL_CHANNELMODEIS."""
+
+        self.modes = {}
+
+        for adding, mode, param in changes:
+            if adding:
+                self.modes[mode] = param
+
+        self._mode_params = None
+        self.has_modes = True
+
+    def get_mode_params(self):
+        """Returns the channel modes as MODE parameters, e.g. ['+tnl', '50']."""
+
+        if self._mode_params == None:
+            modes = sorted(self.modes.items())
+
+            self._mode_params = ['+' + ''.join([mode for mode, _ in modes])] + \
+                                [param for _, param in modes if param != None]
+
+        return self._mode_params
+
+    def _set_member_mode(self, nick, adding, mode):
+        if self._names != None:
+            self._add_patch(('m', nick, adding, mode))
+            return
+
+        nickobj = self._ircobj.nicks.get(nick, None)
+
+        if nick == self._ircobj.me.nick:
+            nickobj = self._ircobj.me
+
+        if nickobj == None or not nickobj in self._nicks:
+            return
+
+        membership = self._nicks[nickobj]
+        membership.modes = _update_modes(membership.modes, adding, mode)
+
+    def add_list_entry(self, mode, mask, setter=None, ts=None):
+        """
+        Adds an entry from a list mode reply (e.g. RPL_BANLIST). The entries
+        replace the current list once end_list() is called.
+        """
+
+        self._pending_lists.setdefault(mode, {})[mask] = (setter, ts)
+
+    def end_list(self, mode):
+        self.list_modes[mode] = self._pending_lists.pop(mode, {})
+
+        if mode == 'b':
+            self.has_bans = True
+
+    def get_state(self):
+        """Returns the channel's state, using only types which can be marshalled."""
+
+        if self.creation_time != None:
+            creation_time = int(time.mktime(self.creation_time.timetuple()))
+        else:
+            creation_time = None
+
+        members = [(membership.nick.get_state(), membership.modes)
+                   for membership in self.nicks.values()]
+
+        return {
+            'name': self.name,
+            'modes': self.modes,
+            'list_modes': self.list_modes,
+            'creation_time': creation_time,
+            'has_names': self.has_names,
+            'has_topic': self.has_topic,
+            'has_bans': self.has_bans,
+            'has_modes': self.has_modes,
+            'topic': (self.info.topic_text, self.info.topic_nick, self.info.topic_time),
+            'members': members
+        }
+
+    def set_state(self, state):
+        """Restores the state returned by get_state()."""
+
+        self.modes = dict(state['modes'])
+        self.list_modes = dict(state['list_modes'])
+        self._mode_params = None
+
+        if state['creation_time'] != None:
+            self.creation_time = datetime.fromtimestamp(state['creation_time'])
+
+        self.has_names = state['has_names']
+        self.has_topic = state['has_topic']
+        self.has_bans = state['has_bans']
+        self.has_modes = state['has_modes']
+
+        topic_text, topic_nick, topic_time = state['topic']
+
+        if self.info.topic_text == None:
+            self.info.set_topic_text(topic_text)
+            self.info.set_topic_nick(topic_nick)
+            self.info.topic_time = topic_time
+
+        # The member list is restored as it is, there's nothing to parse.
+        self._names = None
+        self._patches = None
+        self._name_set = None
+        self._nicks = {}
+
+        for nick_state, modes in state['members']:
+            nickobj = self._ircobj.get_nick(nick_state['nick'])
+            nickobj.set_state(nick_state)
+
+            membership = ChannelMembership(self, nickobj)
+            membership.modes = modes
+            self._nicks[nickobj] = membership
+
+    def _get_bans(self):
+        return self.list_modes.get('b', {})
+
+    bans = property(_get_bans)
+
+    def _get_topic_text(self):
+        return self.info.topic_text
+
+    topic_text = property(_get_topic_text)
+
+    def _get_topic_nick(self):
+        if self.info.topic_nick == None:
+            return None
+
+        if self._topic_nick_source is not self.info.topic_nick:
+            self._topic_nick = Nick(self._ircobj, self.info.topic_nick)
+            self._topic_nick_source = self.info.topic_nick
+
+        return self._topic_nick
+
+    topic_nick = property(_get_topic_nick)
+
+    def _get_topic_time(self):
+        if self.info.topic_time == None:
+            return None
+
+        return datetime.fromtimestamp(self.info.topic_time)
+
+    topic_time = property(_get_topic_time)
 
 class ChannelMembership(object):
     def __init__(self, channel, nick):
@@ -1093,13 +2946,22 @@ class Nick(object):
         self.realname = None
         self.away = False
         self.opered = False
+        self.server = None
+        self.account = None
         self.creation = datetime.now()
+
+        # When we last saw a WHO reply for this nick.
+        self.who_time = None
+
+        # Whether away-notify keeps the away status up to date, and since when.
+        self.away_tracked = False
+        self.track_time = None
         
         hostmask_dict = utils.parse_hostmask(hostmask)
         
-        self.nick = hostmask_dict['nick']
-        self.user = hostmask_dict['user']
-        self.host = hostmask_dict['host']
+        self.nick = utils.intern_string(hostmask_dict['nick'])
+        self.user = utils.intern_string(hostmask_dict['user'])
+        self.host = utils.intern_string(hostmask_dict['host'])
 
     def __str__(self):
         if self.user == None or self.host == None:
@@ -1118,12 +2980,44 @@ class Nick(object):
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def get_state(self):
+        """Returns the nick's state, using only types which can be marshalled."""
+
+        return {
+            'nick': self.nick,
+            'user': self.user,
+            'host': self.host,
+            'realname': self.realname,
+            'away': self.away,
+            'opered': self.opered,
+            'server': self.server,
+            'account': self.account,
+            'who_time': self.who_time,
+            'away_tracked': self.away_tracked,
+            'track_time': self.track_time
+        }
+
+    def set_state(self, state):
+        """Restores the state returned by get_state()."""
+
+        self.nick = utils.intern_string(state['nick'])
+        self.user = utils.intern_string(state['user'])
+        self.host = utils.intern_string(state['host'])
+        self.realname = state['realname']
+        self.away = state['away']
+        self.opered = state['opered']
+        self.server = state['server']
+        self.account = state['account']
+        self.who_time = state['who_time']
+        self.away_tracked = state['away_tracked']
+        self.track_time = state.get('track_time', None)
+
     def update_hostmask(self, hostmask_dict):
         if hostmask_dict['user'] != None and self.user != hostmask_dict['user']:
-            self.user = hostmask_dict['user']
+            self.user = utils.intern_string(hostmask_dict['user'])
             
         if hostmask_dict['host'] != None and self.host != hostmask_dict['host']:
-            self.host = hostmask_dict['host']
+            self.host = utils.intern_string(hostmask_dict['host'])
 
     def _get_channels(self):
         for _, channelobj in self._ircobj.channels.items():
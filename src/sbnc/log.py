@@ -0,0 +1,221 @@
+# sbncng - an object-oriented framework for IRC
+# Copyright (C) 2011 Gunnar Beutner
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+Logging for sbncng. Every subsystem gets a logger below 'sbnc' (e.g.
+'sbnc.irc'), so levels can be set per subsystem. Records are put into a
+bounded in-memory queue and written by a background greenlet, which means
+callers never block on stdout. Hot paths should check isEnabledFor() (or a
+Sampler's is_enabled()) before building their arguments so disabled
+messages cost nothing.
+"""
+
+import sys
+import atexit
+import logging
+from collections import deque
+import gevent
+from gevent import event
+from sbnc.plugin import ServiceRegistry
+from sbnc.metrics import MetricsService
+
+try:
+    from gevent.fileobject import FileObjectPosix
+except ImportError:
+    FileObjectPosix = None
+
+TRACE = 5
+"""Level for per-line traces. These are usually sampled."""
+
+logging.addLevelName(TRACE, 'TRACE')
+
+def get_logger(subsystem):
+    """Returns the logger for the specified subsystem, e.g. 'irc' or 'irc.lines'."""
+
+    return logging.getLogger('sbnc.' + subsystem)
+
+class Sampler(object):
+    """
+    Lets every n-th message of a logger through. Unlike a logging.Filter this
+    is checked before the message's arguments and its LogRecord are built:
+
+        if sampler.is_enabled():
+            logger.log(TRACE, ...)
+    """
+
+    def __init__(self, logger, level, rate=1):
+        self.logger = logger
+        self.level = level
+        self.rate = rate
+
+        self._count = 0
+
+    def is_enabled(self):
+        if not self.logger.isEnabledFor(self.level):
+            return False
+
+        self._count += 1
+
+        if self._count < self.rate:
+            return False
+
+        self._count = 0
+        return True
+
+_samplers = {}
+
+def get_sampler(subsystem, level=TRACE):
+    """Returns the sampler for the specified subsystem's messages, see setup()."""
+
+    try:
+        return _samplers[subsystem]
+    except KeyError:
+        sampler = Sampler(get_logger(subsystem), level)
+        _samplers[subsystem] = sampler
+        return sampler
+
+class AsyncHandler(logging.Handler):
+    """
+    Queues records and passes them to the target handler from a background
+    greenlet. When the queue is full the oldest records are dropped.
+    """
+
+    def __init__(self, target, capacity=10000):
+        logging.Handler.__init__(self)
+
+        self.target = target
+        self.capacity = capacity
+        self.dropped = 0
+
+        self._queue = deque()
+        self._wakeup = event.Event()
+        self._greenlet = None
+
+    def start(self):
+        if self._greenlet != None:
+            return
+
+        self._greenlet = gevent.spawn(self._run)
+
+    def emit(self, record):
+        # The arguments might change before the record is written.
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+        except Exception:
+            self.handleError(record)
+            return
+
+        if len(self._queue) >= self.capacity:
+            self._queue.popleft()
+            self.dropped += 1
+
+        self._queue.append(record)
+        self._wakeup.set()
+
+    def _run(self):
+        count = 0
+
+        while True:
+            if len(self._queue) == 0:
+                self._wakeup.clear()
+                self._wakeup.wait()
+                continue
+
+            self.target.handle(self._queue.popleft())
+
+            # Give other greenlets a chance to run during large bursts.
+            count += 1
+
+            if count % 100 == 0:
+                gevent.sleep(0)
+
+    def flush(self):
+        """Writes all queued records. This blocks and should only be used on shutdown."""
+
+        while len(self._queue) > 0:
+            self.target.handle(self._queue.popleft())
+
+        self.target.flush()
+
+_handler = None
+
+def setup(levels=None, sample_rate=1, capacity=10000, stream=None):
+    """
+    Sets up the logging pipeline.
+
+    levels: A dictionary mapping subsystems (e.g. 'irc.lines') to level
+            names. The 'sbnc' logger itself defaults to INFO, per-line
+            traces are disabled unless configured here.
+    sample_rate: Only every n-th per-line trace is logged.
+    capacity: Maximum number of queued records.
+    stream: Where log messages are written to, defaults to stdout.
+    """
+
+    global _handler
+
+    if _handler != None:
+        return _handler
+
+    if stream == None:
+        if FileObjectPosix != None:
+            stream = FileObjectPosix(sys.stdout.fileno(), 'w', close=False)
+        else:
+            stream = sys.stdout
+
+    target = logging.StreamHandler(stream)
+    target.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname)s %(message)s'))
+
+    _handler = AsyncHandler(target, capacity)
+    _handler.start()
+
+    atexit.register(flush)
+
+    root = logging.getLogger('sbnc')
+    root.addHandler(_handler)
+    root.propagate = False
+    root.setLevel(logging.INFO)
+
+    get_logger('irc.lines').setLevel(logging.WARNING)
+
+    if levels != None:
+        for subsystem, level in levels.items():
+            if subsystem == '':
+                logger = root
+            else:
+                logger = get_logger(subsystem)
+
+            logger.setLevel(logging.getLevelName(level.upper()))
+
+    get_sampler('irc.lines').rate = sample_rate
+
+    metrics_svc = ServiceRegistry.get(MetricsService.package)
+    metrics_svc.gauge('sbnc_log_records_dropped', 'Log records dropped because the queue was full.',
+                      callback=lambda: _handler.dropped)
+    metrics_svc.gauge('sbnc_log_queue_length', 'Log records waiting to be written.',
+                      callback=lambda: len(_handler._queue))
+
+    return _handler
+
+def flush():
+    """
+    Writes the records which are still queued. This has to be called before
+    the process exits without running atexit handlers (i.e. os._exit()).
+    """
+
+    if _handler != None:
+        _handler.flush()
@@ -0,0 +1,253 @@
+# sbncng - an object-oriented framework for IRC
+# Copyright (C) 2011 Gunnar Beutner
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+from bisect import bisect_left
+import gevent
+from gevent import socket
+from sbnc.plugin import Service, ServiceRegistry
+
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+"""Default histogram buckets, in seconds."""
+
+class Counter(object):
+    """A value that only ever goes up."""
+
+    type = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def _samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+class Gauge(object):
+    """
+    A value that can go up and down. If a callback function is specified
+    the value is retrieved from it whenever the gauge is read.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, callback=None):
+        self.value = 0
+        self._callback = callback
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        if self._callback != None:
+            return self._callback()
+
+        return self.value
+
+    def _samples(self, name, labels):
+        return [(name, labels, self.get())]
+
+class Histogram(object):
+    """Counts observations in fixed buckets and keeps their sum."""
+
+    type = 'histogram'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def _samples(self, name, labels):
+        samples = []
+        cumulative = 0
+
+        for index in range(len(self.buckets)):
+            cumulative += self.counts[index]
+            samples.append((name + '_bucket', labels + [('le', repr(self.buckets[index]))],
+                            cumulative))
+
+        samples.append((name + '_bucket', labels + [('le', '+Inf')], self.count))
+        samples.append((name + '_sum', labels, self.sum))
+        samples.append((name + '_count', labels, self.count))
+
+        return samples
+
+class _Metric(object):
+    """
+    A named metric. Metrics without a label name have exactly one value;
+    metrics with a label name have one child value per label value, which
+    is retrieved using labels(). Callers should keep a reference to the
+    child rather than looking it up for every observation.
+    """
+
+    def __init__(self, name, help, cls, label=None, **kwargs):
+        self.name = name
+        self.help = help
+        self.type = cls.type
+        self.label = label
+
+        self._cls = cls
+        self._kwargs = kwargs
+        self._children = {}
+
+        if label == None:
+            self._value = cls(**kwargs)
+
+    def get_children(self):
+        """Returns a dictionary mapping label values to their child values."""
+
+        return self._children
+
+    def labels(self, value):
+        try:
+            return self._children[value]
+        except KeyError:
+            child = self._cls(**self._kwargs)
+            self._children[value] = child
+            return child
+
+    def _samples(self):
+        if self.label == None:
+            return self._value._samples(self.name, [])
+
+        samples = []
+
+        for value in sorted(self._children):
+            samples.extend(self._children[value]._samples(self.name, [(self.label, value)]))
+
+        return samples
+
+class MetricsService(Service):
+    """Registry for counters, gauges and histograms."""
+
+    package = 'info.shroudbnc.services.metrics'
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, name, help, cls, label=None, **kwargs):
+        """
+        Registers a metric. Returns the value object for metrics without
+        a label and the metric itself (so labels() can be used) otherwise.
+        """
+
+        if name in self._metrics:
+            metric = self._metrics[name]
+        else:
+            metric = _Metric(name, help, cls, label, **kwargs)
+            self._metrics[name] = metric
+
+        if label == None:
+            return metric._value
+
+        return metric
+
+    def counter(self, name, help, label=None):
+        return self._register(name, help, Counter, label)
+
+    def gauge(self, name, help, label=None, callback=None):
+        return self._register(name, help, Gauge, label, callback=callback)
+
+    def histogram(self, name, help, label=None, buckets=DEFAULT_BUCKETS):
+        return self._register(name, help, Histogram, label, buckets=buckets)
+
+    def get(self, name):
+        """Retrieves a metric by name, or None if there is no such metric."""
+
+        return self._metrics.get(name, None)
+
+    def get_samples(self):
+        """Returns a list of (name, labels, value) tuples for all metrics."""
+
+        samples = []
+
+        for name in sorted(self._metrics):
+            samples.extend(self._metrics[name]._samples())
+
+        return samples
+
+    def format_prometheus(self):
+        """Renders all metrics in the Prometheus text exposition format."""
+
+        lines = []
+
+        for name in sorted(self._metrics):
+            metric = self._metrics[name]
+
+            lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.type))
+
+            for sample_name, labels, value in metric._samples():
+                if len(labels) > 0:
+                    label_text = '{' + ','.join(['%s="%s"' % (key, _escape_label(label_value))
+                                                 for key, label_value in labels]) + '}'
+                else:
+                    label_text = ''
+
+                lines.append('%s%s %s' % (sample_name, label_text, value))
+
+        return '\n'.join(lines) + '\n'
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class MetricsListener(object):
+    """Serves the metrics in Prometheus' text format over HTTP."""
+
+    def __init__(self, bind_address):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(bind_address)
+        self.socket.listen(5)
+
+    def start(self):
+        return gevent.spawn(self.run)
+
+    def run(self):
+        while True:
+            sock, _ = self.socket.accept()
+            gevent.spawn(self._handle_request, sock)
+
+    def _handle_request(self, sock):
+        try:
+            connection = sock.makefile('w+b', 1)
+
+            # We don't care about the request, but we have to
+            # read it before responding.
+            while True:
+                line = connection.readline()
+
+                if not line or line.strip() == '':
+                    break
+
+            metrics_svc = ServiceRegistry.get(MetricsService.package)
+            body = metrics_svc.format_prometheus()
+
+            connection.write('HTTP/1.0 200 OK\r\n' +
+                             'Content-Type: text/plain; version=0.0.4\r\n' +
+                             'Content-Length: %d\r\n\r\n' % (len(body)) + body)
+            connection.close()
+        finally:
+            sock.close()
+
+ServiceRegistry.register(MetricsService)
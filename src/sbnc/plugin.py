@@ -15,6 +15,13 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
+import sys
+
+try:
+    import pkg_resources
+except ImportError:
+    pkg_resources = None
+
 class Service(object):
     """A service is a singleton object with a well-known name."""
 
@@ -29,12 +36,28 @@ class Plugin(Service):
 
     description = None
     """A short description what this plugin does."""
+
+    unloadable = False
+    """
+    Whether the plugin supports being unloaded. Its event handlers and
+    commands are removed by the plugin manager, anything else has to be
+    cleaned up in unload().
+    """
     
+    def can_unload(self):
+        """
+        Returns whether the plugin can be unloaded right now. Plugins which
+        can't always be unloaded (even though they're unloadable) can
+        override this.
+        """
+
+        return self.unloadable
+
     def unload(self):
         """
         Called when the plugin is to be unloaded, giving the plugin a chance to clean up.
-        Plugins should return False in case they don't support unloading or can't
-        be unloaded right now.
+        This is only called once can_unload() has returned True for all the Plugin
+        objects of the plugin's module, so it can't refuse anymore.
         """
 
         return False
@@ -77,3 +100,128 @@ class ServiceRegistry(object):
             return ServiceRegistry.services[name]
         except KeyError:
             return None
+
+class PluginManager(Service):
+    """
+    Keeps track of the available plugins without importing them. Plugins are
+    modules which register their Plugin classes with the ServiceRegistry when
+    they are imported; they're only imported once they're loaded.
+
+    Besides the built-in plugins, other packages can provide plugins using
+    the 'sbncng.plugins' entry point group.
+
+    Plugins can be unloaded and reloaded at runtime. Connections aren't
+    affected by this because their state is kept by the proxy.
+    """
+
+    package = 'info.shroudbnc.services.plugins'
+
+    builtin_plugins = ['plugin101', 'ui', 'awaycmd', 'admincmd', 'querylog', 'statscmd']
+    """Names of the plugins in the plugins package."""
+
+    entry_point_group = 'sbncng.plugins'
+
+    def __init__(self):
+        self.available = {}
+        """Maps plugin names to module names."""
+
+        self.loaded = []
+
+        self._plugin_unloaded_event = None
+
+        for name in PluginManager.builtin_plugins:
+            self.available[name] = 'plugins.' + name
+
+        if pkg_resources != None:
+            for entry_point in pkg_resources.iter_entry_points(PluginManager.entry_point_group):
+                self.available[entry_point.name] = entry_point.module_name
+
+    def _get_plugin_unloaded_event(self):
+        # sbnc.event imports this module through sbnc.log, so the event
+        # can't be created while the service is registered: whenever sbnc.irc
+        # (and with it sbnc.event) is imported before sbnc.plugin, the Event
+        # class doesn't exist yet at that point.
+        if self._plugin_unloaded_event == None:
+            from sbnc.event import Event
+
+            self._plugin_unloaded_event = Event('PluginManager.plugin_unloaded_event')
+
+        return self._plugin_unloaded_event
+
+    plugin_unloaded_event = property(_get_plugin_unloaded_event)
+    """Invoked with the plugin's module name after a plugin was unloaded."""
+
+    def load(self, name):
+        """Imports the specified plugin. Returns the plugin's module."""
+
+        if not name in self.available:
+            raise ValueError('Unknown plugin: %s' % (name))
+
+        module_name = self.available[name]
+
+        __import__(module_name)
+
+        if not name in self.loaded:
+            self.loaded.append(name)
+
+        return sys.modules[module_name]
+
+    def load_all(self, names=None):
+        """Loads the specified plugins, or all the built-in plugins if names is None."""
+
+        if names == None:
+            names = PluginManager.builtin_plugins
+
+        for name in names:
+            self.load(name)
+
+    def unload(self, name):
+        """
+        Unloads the specified plugin: its Plugin objects are asked to clean up,
+        all of its event handlers are removed and the module is forgotten so
+        that the next load() imports it again. Returns False (without changing
+        anything) if one of the plugin's Plugin objects can't be unloaded.
+        """
+
+        from sbnc.event import Event
+
+        if not name in self.loaded:
+            raise ValueError('Plugin is not loaded: %s' % (name))
+
+        module_name = self.available[name]
+
+        services = [(package, serviceobj) for package, serviceobj in ServiceRegistry.services.items()
+                    if serviceobj.__class__.__module__ == module_name]
+
+        # Check all of them first, otherwise some of them might
+        # already have cleaned up when another one refuses.
+        for _, serviceobj in services:
+            if not isinstance(serviceobj, Plugin) or not serviceobj.can_unload():
+                return False
+
+        for _, serviceobj in services:
+            serviceobj.unload()
+
+        for package, _ in services:
+            del ServiceRegistry.services[package]
+
+        Event.remove_module_listeners(module_name)
+
+        self.plugin_unloaded_event.invoke(self, module_name=module_name)
+
+        sys.modules.pop(module_name, None)
+        self.loaded.remove(name)
+
+        return True
+
+    def reload(self, name):
+        """Unloads (if necessary) and loads the specified plugin. Returns False if it couldn't be unloaded."""
+
+        if name in self.loaded and not self.unload(name):
+            return False
+
+        self.load(name)
+
+        return True
+
+ServiceRegistry.register(PluginManager)
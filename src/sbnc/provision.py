@@ -0,0 +1,175 @@
+# sbncng - an object-oriented framework for IRC
+# Copyright (C) 2011 Gunnar Beutner
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+Bulk user import, e.g. when migrating from another bouncer.
+
+Users are read from CSV files (with a header row) or JSON files (either a
+list of objects or one object per line). Each record needs a 'name' and may
+contain any of the attributes in user_attributes. In CSV files the server
+address is written as host:port.
+
+Passwords are hashed before they're stored (see sbnc.auth). Hashing is
+deliberately slow - roughly 0.1 seconds per user with the default number of
+iterations - so importing thousands of users takes minutes rather than
+seconds; most of that time is spent in the worker threads.
+"""
+
+import csv
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from sbnc.plugin import ServiceRegistry
+from sbnc.directory import DirectoryService
+from sbnc.auth import hash_password
+
+def _to_string(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+
+    return str(value)
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+
+    return str(value).strip().lower() in ['1', 'true', 'yes', 'on']
+
+def _to_address(value):
+    if isinstance(value, (list, tuple)):
+        if len(value) != 2:
+            raise ValueError('Invalid server address: %s' % (value,))
+
+        host, port = value
+    else:
+        host, _, port = _to_string(value).rpartition(':')
+
+        if host == '':
+            host = port
+            port = 6667
+
+    try:
+        return [_to_string(host), int(port)]
+    except ValueError:
+        raise ValueError('Invalid server port: %s' % (port,))
+
+user_attributes = {
+    'password': _to_string,
+    'nick': _to_string,
+    'username': _to_string,
+    'realname': _to_string,
+    'server_address': _to_address,
+    'server_ssl': _to_bool,
+    'server_verify': _to_bool,
+    'server_ca_certs': _to_string,
+    'flood_profile': _to_string,
+    'admin': _to_bool
+}
+"""The attributes which can be imported and how they're converted."""
+
+def read_users(stream, format):
+    """Returns an iterator over the records in a CSV ('csv') or JSON ('json') stream."""
+
+    if format == 'csv':
+        return csv.DictReader(stream)
+    elif format == 'json':
+        return _read_json(stream)
+    else:
+        raise ValueError('Unknown format: %s' % (format))
+
+def _read_json(stream):
+    first_line = stream.readline()
+
+    if first_line.lstrip().startswith('['):
+        for record in json.loads(first_line + stream.read()):
+            yield record
+    else:
+        for line in [first_line] + list(stream):
+            if line.strip() != '':
+                yield json.loads(line)
+
+def parse_record(record):
+    """
+    Converts a record into the user's name and a dictionary of attributes.
+    Raises a ValueError if the record is invalid.
+    """
+
+    name = _to_string(record.get('name', None) or '').strip()
+
+    if name == '' or ' ' in name:
+        raise ValueError('Invalid user name: %s' % (name))
+
+    attributes = {}
+
+    for key, value in record.items():
+        if key == 'name' or value == None or value == '':
+            continue
+
+        try:
+            converter = user_attributes[key]
+        except KeyError:
+            raise ValueError('Unknown attribute for user %s: %s' % (name, key))
+
+        attributes[key] = converter(value)
+
+    if not 'password' in attributes:
+        raise ValueError('User %s doesn\'t have a password.' % (name))
+
+    return name, attributes
+
+def create_users(users_node, package, records, batch_size=500):
+    """
+    Creates users from records in batches of batch_size users. Each user gets
+    a config node named package with the attributes from the record. Yields a
+    tuple containing the new user nodes and the errors (as strings) for each
+    batch; every batch is committed in a single transaction. Users which
+    already exist are skipped. The passwords of each batch are hashed before
+    the batch is created.
+    """
+
+    dir_svc = ServiceRegistry.get(DirectoryService.package)
+
+    names = set([node.name for node in users_node.children])
+    entries = []
+    errors = []
+
+    for record in records:
+        try:
+            name, attributes = parse_record(record)
+        except ValueError as exc:
+            errors.append(str(exc))
+            continue
+
+        if name in names:
+            errors.append('User %s already exists.' % (name))
+            continue
+
+        names.add(name)
+        attributes['password'] = hash_password(attributes['password'])
+        entries.append((name, {}, [(package, attributes, [])]))
+
+        if len(entries) >= batch_size:
+            yield dir_svc.bulk_create(users_node, entries), errors
+
+            entries = []
+            errors = []
+
+    if len(entries) > 0 or len(errors) > 0:
+        yield dir_svc.bulk_create(users_node, entries), errors
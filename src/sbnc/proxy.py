@@ -15,12 +15,97 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 
+import os
+import marshal
+import tempfile
+import gevent
 from time import time
-from sbnc import irc
-from sbnc.event import Event
+from sbnc import irc, utils
+from sbnc.event import Event, lambda_and
 from sbnc.plugin import Service, ServiceRegistry
-from sbnc.irc import IRCConnection, ClientConnection, ConnectionFactory
+from sbnc.directory import DirectoryService
+from sbnc.irc import IRCConnection, ClientConnection, ConnectionFactory, RequestTracker, Channel
 from sbnc.timer import Timer
+from sbnc.tls import TLSContext
+from sbnc.flood import SendScheduler, get_profile
+from sbnc.metrics import MetricsService
+from sbnc.capture import CaptureWriter, TYPE_IRC, TYPE_CLIENT
+from sbnc import log
+from sbnc import provision
+from sbnc import workers
+from sbnc.auth import CredentialCache, FailureTracker, hash_password, verify_password, \
+     verify_dummy, needs_rehash
+
+metrics_svc = ServiceRegistry.get(MetricsService.package)
+
+_reconnects = metrics_svc.counter('sbnc_reconnects_total', 'Connection attempts to IRC servers.')
+_auth_failures = metrics_svc.counter('sbnc_auth_failures_total', 'Logins with an invalid password.')
+_auth_blocked = metrics_svc.counter('sbnc_auth_blocked_total',
+                                    'Logins which were rejected because of too many failures.')
+
+_log = log.get_logger('proxy')
+
+SNAPSHOT_VERSION = 1
+
+# Replies which mean that we couldn't (re-)join a channel
+_join_errors = set(['403', '405', '437', '471', '473', '474', '475', '477'])
+
+def _match_join_error(*args, **kwargs):
+    return kwargs['command'] in _join_errors
+
+# Messages which change the list of channels we're in (or their keys)
+_channel_commands = set(['JOIN', 'PART', 'KICK', 'MODE', '324'])
+
+def _match_channel_command(*args, **kwargs):
+    return kwargs['command'] in _channel_commands
+
+def _match_end_of_motd(*args, **kwargs):
+    return kwargs['command'] in ['376', '422']
+
+def _get_channel_key(channelobj):
+    """
+    Returns the channel's key, or None. Servers show the key as '*' to users
+    who aren't allowed to see it, which isn't worth remembering.
+    """
+
+    key = channelobj.modes.get('k', None)
+
+    if key == '*':
+        return None
+
+    return key
+
+def _write_file(path, data):
+    """Replaces a file's contents atomically. Runs in a worker thread."""
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                     prefix=os.path.basename(path) + '.')
+
+    try:
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+        os.rename(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+
+def _to_str(value):
+    """The directory returns unicode strings, the IRC code expects byte strings."""
+
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    else:
+        return value
+
+def _is_utf8(value):
+    try:
+        value.decode('utf-8')
+        return True
+    except UnicodeError:
+        return False
 
 class Proxy(Service):
     package = 'info.shroudbnc.services.proxy'
@@ -31,8 +116,20 @@ class Proxy(Service):
         self.irc_factory = ConnectionFactory(IRCConnection)
 
         self.client_factory = ConnectionFactory(irc.ClientConnection)
+
+        # (verify, ca_certs) -> TLSContext
+        self._irc_tls_contexts = {}
+        self._capture_count = 0
+
+        # Set while the connections are being handed over to another process.
+        self._handing_over = False
+
+        # Number of imports which are in progress, see import_users().
+        self._importing = 0
     
     def start(self, config_root_node):
+        self.start_time = time()
+
         self._config_root = config_root_node
         self._config = self.get_plugin_config(Proxy)
         
@@ -66,50 +163,99 @@ class Proxy(Service):
         IRCConnection.registration_event.add_listener(ProxyUser._irc_registration_handler,
                                                             Event.PreObserver,
                                                             ConnectionFactory.match_factory(self.irc_factory))
+        IRCConnection.command_received_event.add_listener(ProxyUser._irc_join_error_handler,
+                                                          Event.PreObserver,
+                                                          lambda_and(ConnectionFactory.match_factory(self.irc_factory),
+                                                                     _match_join_error))
+        IRCConnection.command_received_event.add_listener(ProxyUser._irc_channels_handler,
+                                                          Event.PostObserver,
+                                                          lambda_and(ConnectionFactory.match_factory(self.irc_factory),
+                                                                     _match_channel_command))
+        IRCConnection.command_received_event.add_listener(ProxyUser._irc_end_of_motd_handler,
+                                                          Event.PostObserver,
+                                                          lambda_and(ConnectionFactory.match_factory(self.irc_factory),
+                                                                     _match_end_of_motd))
         
         self.users = {}
+
+        metrics_svc.gauge('sbnc_users', 'Number of users.',
+                          callback=lambda: len(self.users))
+        metrics_svc.gauge('sbnc_irc_connections', 'Number of IRC connections.',
+                          callback=lambda: len([userobj for userobj in self.users.values()
+                                                if userobj.irc_connection != None]))
+        metrics_svc.gauge('sbnc_client_connections', 'Number of client connections.',
+                          callback=lambda: sum([len(userobj.client_connections)
+                                                for userobj in self.users.values()]))
+        metrics_svc.gauge('sbnc_queue_length', 'Lines queued for sending on all connections.',
+                          callback=self._get_queue_length)
         
         for user_config in self._config['users']:
             self.users[user_config.name] = ProxyUser(self, user_config)
         
         self._last_reconnect = None
         Timer(10, self._reconnect_timer).start()
+
+        self.credential_cache = CredentialCache(self._config.get('credential_cache_ttl', 300))
+        self.auth_failures = FailureTracker(self._config.get('max_auth_failures', 5))
+        Timer(60, self._auth_cleanup_timer).start()
+
+        if self._config.get('snapshot_dir', None) != None:
+            Timer(self._config.get('snapshot_interval', 300), self._snapshot_timer).start()
         
         # high-level helper events, to make things easier for plugins
-        self.new_client_event = Event()
+        self.new_client_event = Event('Proxy.new_client_event')
         
-        self.client_registration_event = Event()
+        self.client_registration_event = Event('Proxy.client_registration_event')
         self.client_registration_event.bind(irc.ClientConnection.registration_event,
                                             filter=ConnectionFactory.match_factory(self.client_factory))
 
-        self.irc_registration_event = Event()
+        self.irc_registration_event = Event('Proxy.irc_registration_event')
         self.irc_registration_event.bind(IRCConnection.registration_event,
                                          filter=ConnectionFactory.match_factory(self.irc_factory))
 
-        self.client_command_received_event = Event()
+        self.client_command_received_event = Event('Proxy.client_command_received_event')
         self.client_command_received_event.bind(irc.ClientConnection.command_received_event,
                                             filter=ConnectionFactory.match_factory(self.client_factory))
 
-        self.irc_command_received_event = Event()
+        self.irc_command_received_event = Event('Proxy.irc_command_received_event')
         self.irc_command_received_event.bind(IRCConnection.command_received_event,
                                          filter=ConnectionFactory.match_factory(self.irc_factory))
 
-        self.client_connection_closed_event = Event()
+        self.client_connection_closed_event = Event('Proxy.client_connection_closed_event')
         self.client_connection_closed_event.bind(ClientConnection.connection_closed_event,
                                          filter=ConnectionFactory.match_factory(self.irc_factory))
 
-        self.irc_connection_closed_event = Event()
+        self.irc_connection_closed_event = Event('Proxy.irc_connection_closed_event')
         self.irc_connection_closed_event.bind(IRCConnection.connection_closed_event,
                                          filter=ConnectionFactory.match_factory(self.irc_factory))
 
     def _client_authentication_handler(self, evt, clientobj, username, password):
-        if not username in self.users:
+        address = clientobj.socket_address[0]
+
+        # Don't spend any time on hashing passwords for brute-force attempts.
+        if self.auth_failures.is_blocked(address):
+            _auth_blocked.inc()
             return Event.Continue
-        
-        userobj = self.users[clientobj.me.user]
-        
-        if not userobj.check_password(password):
+
+        userobj = self.users.get(username, None)
+
+        self.auth_failures.start_attempt(address)
+
+        try:
+            if userobj != None:
+                authenticated = userobj.check_password(password)
+            else:
+                # Unknown users take as long and count as much as wrong passwords.
+                authenticated = verify_dummy(password)
+        finally:
+            self.auth_failures.end_attempt(address)
+
+        if not authenticated:
+            self.auth_failures.add_failure(address)
+            _auth_failures.inc()
             return Event.Continue
+
+        self.auth_failures.reset(address)
         
         clientobj.owner = userobj
 
@@ -127,6 +273,40 @@ class Proxy(Service):
         
         return user
 
+    def import_users(self, records, batch_size=500, progress=None):
+        """
+        Creates users in bulk, see sbnc.provision. progress is called with the
+        number of users which have been imported so far and the errors for
+        each batch. None of the new users are connected to IRC until the
+        import is complete. Returns the number of new users.
+
+        Writing a batch to the database blocks every other connection (about
+        20ms for 100 users), so imports in a running bouncer should use small
+        batches; other greenlets run between batches.
+        """
+
+        count = 0
+
+        self._importing += 1
+
+        try:
+            for user_nodes, errors in provision.create_users(self._config['users'], Proxy.package,
+                                                            records, batch_size):
+                for user_config in user_nodes:
+                    self.users[user_config.name] = ProxyUser(self, user_config)
+
+                count += len(user_nodes)
+
+                if progress != None:
+                    progress(count, errors)
+
+                # Let the other connections have their turn.
+                gevent.sleep(0)
+        finally:
+            self._importing -= 1
+
+        return count
+
     def remove_user(self, name):
         # TODO: event
 
@@ -134,6 +314,9 @@ class Proxy(Service):
         del self.config['users'][name]
         
     def _reconnect_timer(self):
+        if self._handing_over or self._importing > 0:
+            return True
+
         if self._last_reconnect != None and \
                 self._last_reconnect > time() - 60:
             return True
@@ -150,10 +333,131 @@ class Proxy(Service):
         
         return True
     
+    def _auth_cleanup_timer(self):
+        self.credential_cache.expire()
+        self.auth_failures.expire()
+
+        return True
+
+    def _snapshot_timer(self):
+        for userobj in self.users.values():
+            if userobj.irc_connection == None or not userobj.irc_connection.registered:
+                continue
+
+            userobj.write_snapshot()
+
+            # Don't hold up the connections while going through all users.
+            gevent.sleep(0)
+
+        return True
+
+    def get_snapshot_path(self, userobj):
+        """
+        Returns the path of the specified user's channel state snapshot, or
+        None if snapshots are disabled.
+        """
+
+        snapshot_dir = self._config.get('snapshot_dir', None)
+
+        if snapshot_dir == None:
+            return None
+
+        return os.path.join(snapshot_dir, '%s.snapshot' % (userobj.name))
+
     def get_plugin_config(self, plugin_cls):
         return self._config_root[plugin_cls.package]
 
+    def detach_connections(self):
+        """
+        Detaches all connections which can be handed over to another process,
+        see sbnc.handover. Returns a tuple containing the state (which can be
+        marshalled) and the list of sockets the state refers to.
+        """
+
+        self._handing_over = True
+
+        users = {}
+        sockets = []
+
+        for userobj in self.users.values():
+            user_state = userobj.detach_connections(sockets)
+
+            if user_state != None:
+                users[userobj.name] = user_state
+
+        return {'users': users}, sockets
+
+    def restore_connections(self, state, sockets):
+        """Resumes the connections which were detached by detach_connections()."""
+
+        for name, user_state in state['users'].items():
+            if not name in self.users:
+                for connection_state in [user_state['irc']] + user_state['clients']:
+                    if connection_state != None:
+                        sockets[connection_state['socket']].close()
+
+                continue
+
+            self.users[name].restore_connections(user_state, sockets)
+
+        self._handing_over = False
+
+    def _get_queue_length(self):
+        length = 0
+
+        for userobj in self.users.values():
+            for connobj in [userobj.irc_connection] + userobj.client_connections:
+                if connobj != None:
+                    length += connobj.get_queue_length()
+
+        return length
+
+    def create_capture(self, userobj, type):
+        """
+        Returns a CaptureWriter object for a new connection of the specified
+        user, or None if traffic capturing is disabled.
+        """
+
+        capture_dir = self._config.get('capture_dir', None)
+
+        if capture_dir == None:
+            return None
+
+        self._capture_count += 1
+
+        path = os.path.join(capture_dir, '%s-%s-%d-%d.cap' %
+                            (userobj.name, type, int(time()), self._capture_count))
+
+        return CaptureWriter(path, type)
+
+    def get_irc_tls_context(self, verify=True, ca_certs=None):
+        """
+        Returns the client-side TLS context that is used for IRC connections. All
+        users with the same verification settings share a context so that sessions
+        can be resumed on reconnect. Unless verify is False the server's
+        certificate is checked against ca_certs (or the system's CAs if that's
+        None) and its host name.
+        """
+
+        key = (verify, ca_certs)
+
+        try:
+            return self._irc_tls_contexts[key]
+        except KeyError:
+            pass
+
+        tls_context = TLSContext(ca_certs=ca_certs, verify=verify)
+        self._irc_tls_contexts[key] = tls_context
+
+        return tls_context
+
 class ProxyUser(object):
+    SNAPSHOT_MAX_AGE = 86400
+    """Snapshots which are older than this (in seconds) are ignored."""
+
+    REJOIN_TIMEOUT = 60
+    """How long channels from a snapshot are kept if the server doesn't confirm the JOIN."""
+
     def __init__(self, proxy, user_config):
         self.proxy = proxy
         self.name = user_config.name
@@ -163,10 +467,289 @@ class ProxyUser(object):
         
         self.irc_connection = None
         self.client_connections = []
+
+        self.reconnect_count = 0
+
+        # When the last client disconnected, None if no client
+        # has been connected since the bouncer was started.
+        self.last_seen = None
+
+        # Kept in memory so listing thousands of users doesn't need
+        # any directory lookups. lookup() doesn't write the defaults
+        # back, which would be one commit per user on startup.
+        self._admin = self._config.lookup('admin', None)
+        self._suspended = self._config.lookup('suspended', False)
+
+        # Set between 001 and the end of the MOTD, when ISUPPORT is complete.
+        self._rejoin_pending = False
         
     def get_plugin_config(self, plugin_cls):
         return self._config_root[plugin_cls.package]
 
+    def detach_connections(self, sockets):
+        """
+        Detaches the user's connections and appends their sockets to the
+        sockets list. Connections using TLS can't be handed over because
+        their session state can't be transferred; they are left alone and
+        are closed when the process exits. Returns None if there are no
+        connections which can be handed over.
+        """
+
+        irc_state = None
+        client_states = []
+
+        ircobj = self.irc_connection
+
+        if ircobj != None and ircobj.registered and ircobj.tls_context == None:
+            irc_state = ircobj.detach()
+            irc_state['socket'] = len(sockets)
+            sockets.append(ircobj.socket)
+
+            self.irc_connection = None
+
+        for clientobj in list(self.client_connections):
+            if not clientobj.registered or clientobj.tls_context != None:
+                continue
+
+            client_state = clientobj.detach()
+            client_state['socket'] = len(sockets)
+            sockets.append(clientobj.socket)
+
+            self.client_connections.remove(clientobj)
+            client_states.append(client_state)
+
+        if irc_state == None and len(client_states) == 0:
+            return None
+
+        return {'irc': irc_state, 'clients': client_states}
+
+    def restore_connections(self, user_state, sockets):
+        """Resumes the connections which were detached by detach_connections()."""
+
+        irc_state = user_state['irc']
+
+        if irc_state != None and self.irc_connection == None:
+            ircobj = self.proxy.irc_factory.create(address=tuple(irc_state['address']),
+                                                   socket=sockets[irc_state['socket']])
+            ircobj.owner = self
+            ircobj.start_capture(self.proxy.create_capture(self, TYPE_IRC))
+
+            flood_profile = self._config.get('flood_profile', None)
+
+            if flood_profile != None:
+                ircobj.flood_profile = get_profile(flood_profile)
+
+            self.irc_connection = ircobj
+            ircobj.resume(irc_state)
+        elif irc_state != None:
+            sockets[irc_state['socket']].close()
+
+        for client_state in user_state['clients']:
+            clientobj = self.proxy.client_factory.create(address=tuple(client_state['address']),
+                                                         socket=sockets[client_state['socket']])
+            clientobj.owner = self
+            clientobj.start_capture(self.proxy.create_capture(self, TYPE_CLIENT))
+
+            if self.irc_connection != None:
+                clientobj.network_info = self.irc_connection.network_info
+                clientobj.channels = self.irc_connection.channels
+                clientobj.nicks = self.irc_connection.nicks
+
+            self.client_connections.append(clientobj)
+            clientobj.resume(client_state)
+
+    def write_snapshot(self):
+        """
+        Saves the channels of the user's IRC connection (modes, topics and
+        members) so they can be restored after a reconnect, see
+        restore_snapshot().
+        """
+
+        path = self.proxy.get_snapshot_path(self)
+        ircobj = self.irc_connection
+
+        if path == None or ircobj == None or not ircobj.registered:
+            return
+
+        channels = []
+
+        for channelobj in ircobj.channels.values():
+            channel_state = channelobj.get_state()
+
+            if channelobj.modes.get('k', None) == '*':
+                channel_state['modes'] = dict(channel_state['modes'])
+                del channel_state['modes']['k']
+
+            channels.append(channel_state)
+
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'time': time(),
+            'address': tuple(ircobj.socket_address),
+            'nick': ircobj.me.nick,
+            'channels': channels
+        }
+
+        # The state has to be serialized here because the channels keep
+        # changing, but the disk is only waited for in a worker thread.
+        data = marshal.dumps(snapshot)
+
+        try:
+            workers.run(_write_file, path, data)
+        except (IOError, OSError):
+            _log.exception('Could not write snapshot for user %s', self.name)
+
+    def restore_snapshot(self, ircobj):
+        """
+        Restores the channels from the user's snapshot. The channels are used
+        to answer clients' queries until the server's replies for the JOINs
+        (see rejoin_channels()) have arrived.
+        """
+
+        path = self.proxy.get_snapshot_path(self)
+
+        if path == None or not os.path.exists(path):
+            return
+
+        try:
+            snapshot_file = open(path, 'rb')
+
+            try:
+                snapshot = marshal.load(snapshot_file)
+            finally:
+                snapshot_file.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            _log.warning('Ignoring invalid snapshot for user %s', self.name)
+            return
+
+        if snapshot.get('version', None) != SNAPSHOT_VERSION or \
+                snapshot['time'] < time() - ProxyUser.SNAPSHOT_MAX_AGE or \
+                tuple(snapshot['address']) != tuple(ircobj.socket_address):
+            return
+
+        for channel_state in snapshot['channels']:
+            if channel_state['name'] in ircobj.channels:
+                continue
+
+            # We might have a different nick this time.
+            for nick_state, _ in channel_state['members']:
+                if nick_state['nick'] == snapshot['nick']:
+                    nick_state['nick'] = ircobj.me.nick
+
+            channelobj = Channel(ircobj, channel_state['name'])
+            channelobj.set_state(channel_state)
+            channelobj.from_snapshot = True
+
+            ircobj.channels[channelobj.name] = channelobj
+
+    def get_channels(self):
+        """
+        Returns the channels which are rejoined after reconnecting, as a
+        dictionary which maps channel names to their keys (or None).
+        """
+
+        channels = {}
+
+        for attrib in self._config['channels'].attributes:
+            channel, key = attrib.value
+            channels[_to_str(channel)] = _to_str(key)
+
+        return channels
+
+    def get_channel(self, channel):
+        """
+        Returns a tuple containing the channel's name and key if the channel
+        is rejoined after reconnecting, or None.
+        """
+
+        entry = self._config['channels'].lookup(utils.irc_lower(channel), None)
+
+        if entry == None:
+            return None
+
+        return _to_str(entry[0]), _to_str(entry[1])
+
+    def remember_channel(self, channel, key=None):
+        """Adds a channel to the list of channels which are rejoined after reconnecting."""
+
+        # The directory stores JSON, which can't represent arbitrary bytes.
+        if not _is_utf8(channel) or (key != None and not _is_utf8(key)):
+            return
+
+        if self.get_channel(channel) == (channel, key):
+            return
+
+        # Each channel has its own attribute (keyed by the channel's
+        # lowercase name), so only that one row has to be written.
+        dir_svc = ServiceRegistry.get(DirectoryService.package)
+
+        with dir_svc.batch():
+            self._config['channels'].set(utils.irc_lower(channel), [channel, key])
+
+    def forget_channel(self, channel):
+        """Removes a channel from the list of channels which are rejoined after reconnecting."""
+
+        if self.get_channel(channel) == None:
+            return
+
+        dir_svc = ServiceRegistry.get(DirectoryService.package)
+
+        with dir_svc.batch():
+            self._config['channels'].unset(utils.irc_lower(channel))
+
+    def rejoin_channels(self, ircobj):
+        """
+        Joins the user's channels and the ones from the snapshot. The JOINs
+        are bulk traffic, so the scheduler packs them into as few lines as
+        the server's line length and its TARGMAX/MAXCHANNELS limits allow.
+        """
+
+        channels = self.get_channels()
+        from_snapshot = False
+
+        for channelobj in ircobj.channels.values():
+            if channelobj.from_snapshot:
+                from_snapshot = True
+
+                if not channelobj.name in channels:
+                    channels[channelobj.name] = _get_channel_key(channelobj)
+            else:
+                channels.pop(channelobj.name, None)
+
+        for channel in sorted(channels.keys()):
+            key = channels[channel]
+
+            if key != None:
+                ircobj.send_message('JOIN', channel, key)
+            else:
+                ircobj.send_message('JOIN', channel)
+
+        if from_snapshot:
+            Timer(ProxyUser.REJOIN_TIMEOUT, self._rejoin_timeout_timer, ircobj).start()
+
+    def _remove_snapshot_channel(self, ircobj, channel, reason):
+        """Removes a channel from a snapshot which couldn't be rejoined."""
+
+        channelobj = ircobj.channels.get(channel, None)
+
+        if channelobj == None or not channelobj.from_snapshot:
+            return
+
+        del ircobj.channels[channel]
+
+        for clientobj in self.client_connections:
+            if clientobj.registered:
+                clientobj.send_message('KICK', channel, clientobj.me.nick, reason,
+                                       prefix=clientobj.server)
+
+    def _rejoin_timeout_timer(self, ircobj):
+        for channelobj in ircobj.channels.values():
+            if channelobj.from_snapshot:
+                self._remove_snapshot_channel(ircobj, channelobj.name,
+                                              'Could not rejoin the channel.')
+
+        return False
+
     def reconnect_to_irc(self):
         if self.irc_connection != None:
             self.irc_connection.close('Reconnecting.')
@@ -177,20 +760,38 @@ class ProxyUser(object):
             # TODO: trigger event, so scripts know we won't reconnect
             return
 
-        self.irc_connection = self.proxy.irc_factory.create(address=tuple(server_address))
+        if self._config.get('server_ssl', False):
+            tls_context = self.proxy.get_irc_tls_context(self._config.lookup('server_verify', True),
+                                                         self._config.lookup('server_ca_certs', None))
+        else:
+            tls_context = None
+
+        self.irc_connection = self.proxy.irc_factory.create(address=tuple(server_address),
+                                                            tls_context=tls_context)
         self.irc_connection.owner = self
+        self.irc_connection.start_capture(self.proxy.create_capture(self, TYPE_IRC))
         self.irc_connection.reg_nickname = self._config.get('nick', self.name)
         self.irc_connection.reg_username = self._config.get('username', self.name)
         self.irc_connection.reg_realname = self._config.get('realname', 'sbncng User')
+
+        flood_profile = self._config.get('flood_profile', None)
+
+        if flood_profile != None:
+            self.irc_connection.flood_profile = get_profile(flood_profile)
         
         self.irc_connection.start()
         
         self.last_reconnect = time()
 
+        self.reconnect_count += 1
+        _reconnects.inc()
+
     @staticmethod
     def _irc_closed_handler(evt, ircobj):
         self = ircobj.owner
 
+        self.write_snapshot()
+
         for clientobj in self.client_connections:
             for channel in clientobj.channels:
                 clientobj.send_message('KICK', channel, clientobj.me.nick,
@@ -209,6 +810,11 @@ class ProxyUser(object):
             return
         
         self.client_connections.remove(clientobj)
+
+        if self.irc_connection != None:
+            self.irc_connection.requests.remove_requester(clientobj)
+
+        self.last_seen = time()
         
     @staticmethod
     def _client_registration_handler(evt, clientobj):
@@ -216,6 +822,9 @@ class ProxyUser(object):
         
         self.client_connections.append(clientobj)
 
+        # Capturing only starts now so the client's password isn't recorded.
+        clientobj.start_capture(self.proxy.create_capture(self, TYPE_CLIENT))
+
         if self.irc_connection != None and self.irc_connection.registered and \
                 clientobj.me.nick != self.irc_connection.me.nick:
             clientobj.send_message('NICK', self.irc_connection.me.nick, prefix=clientobj.me)
@@ -224,8 +833,7 @@ class ProxyUser(object):
             self.irc_connection.send_message('NICK', clientobj.me.nick)
 
         if self.irc_connection != None:
-            clientobj.motd = self.irc_connection.motd
-            clientobj.isupport = self.irc_connection.isupport
+            clientobj.network_info = self.irc_connection.network_info
             clientobj.channels = self.irc_connection.channels
             clientobj.nicks = self.irc_connection.nicks
 
@@ -249,10 +857,83 @@ class ProxyUser(object):
         self = ircobj.owner
 
         for clientobj in self.client_connections:
+            clientobj.network_info = ircobj.network_info
+            clientobj.channels = ircobj.channels
+            clientobj.nicks = ircobj.nicks
+
             if clientobj.me.nick != ircobj.me.nick:
                 clientobj.send_message('NICK', self.irc_connection.me.nick, prefix=clientobj.me)
                 clientobj.me.nick = self.irc_connection.me.nick
 
+        self.restore_snapshot(ircobj)
+
+        # We don't know the server's limits for JOINs until we've seen
+        # its ISUPPORT replies, so the channels are rejoined after the MOTD.
+        self._rejoin_pending = True
+
+    # :server 376 nick :End of /MOTD command.
+    @staticmethod
+    def _irc_end_of_motd_handler(evt, ircobj, command, nickobj, params):
+        self = ircobj.owner
+
+        if not self._rejoin_pending:
+            return
+
+        self._rejoin_pending = False
+        self.rejoin_channels(ircobj)
+
+    # :nick!user@host JOIN #channel
+    # :server 324 nick #channel +tnk key
+    @staticmethod
+    def _irc_channels_handler(evt, ircobj, command, nickobj, params):
+        self = ircobj.owner
+
+        if command == 'JOIN':
+            if len(params) < 1 or nickobj != ircobj.me:
+                return
+
+            # The key is only known once we've seen the channel's modes.
+            entry = self.get_channel(params[0])
+
+            if entry != None:
+                self.remember_channel(params[0], entry[1])
+            else:
+                self.remember_channel(params[0])
+        elif command == 'PART':
+            if len(params) < 1 or nickobj != ircobj.me:
+                return
+
+            self.forget_channel(params[0])
+        elif command == 'KICK':
+            # Not get_nick(), that would create a Nick object for whoever
+            # was kicked.
+            if len(params) < 2 or utils.irc_lower(params[1]) != utils.irc_lower(ircobj.me.nick):
+                return
+
+            self.forget_channel(params[0])
+        else:
+            if command == '324' and len(params) > 2:
+                channel = params[1]
+            elif command == 'MODE' and len(params) > 1 and 'k' in params[1]:
+                channel = params[0]
+            else:
+                return
+
+            channelobj = ircobj.channels.get(channel, None)
+
+            if channelobj == None or self.get_channel(channel) == None:
+                return
+
+            self.remember_channel(channel, _get_channel_key(channelobj))
+
+    # :server 474 nick #channel :Cannot join channel (+b)
+    @staticmethod
+    def _irc_join_error_handler(evt, ircobj, command, nickobj, params):
+        if len(params) < 3:
+            return
+
+        ircobj.owner._remove_snapshot_channel(ircobj, params[1], params[-1])
+
     @staticmethod
     def _client_command_handler(evt, clientobj, command, nickobj, params):
         self = clientobj.owner
@@ -268,7 +949,23 @@ class ProxyUser(object):
         if self.irc_connection == None or (not self.irc_connection.registered and command != 'NICK'):
             return Event.Continue
 
-        self.irc_connection.send_message(command, prefix=nickobj, *params)
+        # Replies to queries only go to the clients which asked, and identical
+        # queries are only sent once while the first one is waiting for its reply.
+        if RequestTracker.is_query(command, params):
+            request = self.irc_connection.requests.begin(command, params, clientobj)
+
+            if request == None:
+                return Event.Handled
+
+            if request.label != None:
+                self.irc_connection.send_line(utils.format_irc_message(command, tags={'label': request.label},
+                                                                       *params),
+                                              SendScheduler.PRIORITY_NORMAL)
+                return Event.Handled
+
+        # Anything the user typed goes ahead of bulk traffic like rejoins.
+        self.irc_connection.send_message(command, prefix=nickobj,
+                                         priority=SendScheduler.PRIORITY_NORMAL, *params)
         
         return Event.Handled
 
@@ -281,10 +978,20 @@ class ProxyUser(object):
         
         command = command.upper();
 
-        if command in ['ERROR']:
+        # Clients can't negotiate message-tags, so they don't get TAGMSG.
+        if command in ['ERROR', 'CAP', 'BATCH', 'ACK', 'TAGMSG']:
             return Event.Continue
+
+        requesters = ircobj.requests.route(command, params, ircobj.get_request_label())
+
+        if requesters != None:
+            clients = requesters
+        else:
+            clients = self.client_connections
+
+        server_time = None
     
-        for clientobj in self.client_connections:
+        for clientobj in clients:
             if not clientobj.registered:
                 continue
             
@@ -293,12 +1000,115 @@ class ProxyUser(object):
             else:
                 mapped_prefix = nickobj
 
-            clientobj.send_message(command, prefix=mapped_prefix, *params)
+            if command in ProxyUser._cap_dependent_commands:
+                client_params = ProxyUser._adapt_params(clientobj, command, nickobj, params)
+
+                if client_params == None:
+                    continue
+            else:
+                client_params = params
+
+            if 'server-time' in clientobj.caps:
+                if server_time == None:
+                    server_time = ircobj.message_tags.get('time', None)
+
+                    if server_time == None:
+                        server_time = utils.format_server_time(time())
+
+                clientobj.send_message(command, prefix=mapped_prefix, tags={'time': server_time},
+                                       *client_params)
+            else:
+                clientobj.send_message(command, prefix=mapped_prefix, *client_params)
 
         return Event.Handled
 
+    _cap_dependent_commands = set(['AWAY', 'ACCOUNT', 'CHGHOST', 'JOIN', '352', '353'])
+
+    @staticmethod
+    def _adapt_params(clientobj, command, nickobj, params):
+        """
+        Adapts a message from the IRC server to the capabilities the client
+        has enabled, which might be different from the ones we negotiated
+        with the server. Returns None if the client shouldn't see the message
+        at all.
+        """
+
+        caps = clientobj.caps
+
+        if command == 'AWAY':
+            if not 'away-notify' in caps:
+                return None
+        elif command == 'ACCOUNT':
+            if not 'account-notify' in caps:
+                return None
+        elif command == 'CHGHOST':
+            if not 'chghost' in caps:
+                return None
+        elif command == 'JOIN':
+            if 'extended-join' in caps:
+                if len(params) == 1 and nickobj != None:
+                    return [params[0], nickobj.account or '*', nickobj.realname or '']
+            elif len(params) > 1:
+                return params[:1]
+        elif command == '352':
+            # :server 352 nick #channel user host server nick H*@+ :hops realname
+            if len(params) > 7 and not 'multi-prefix' in caps:
+                flags = params[6]
+                prefixes = flags.lstrip('HG*')
+                status = flags[:len(flags) - len(prefixes)]
+
+                return params[:6] + [status + prefixes[:1]] + params[7:]
+        elif command == '353':
+            multi_prefix = 'multi-prefix' in caps
+            userhost_in_names = 'userhost-in-names' in caps
+
+            if len(params) > 3 and (not multi_prefix or not userhost_in_names):
+                prefixes = utils.get_prefix_chars(clientobj.isupport['PREFIX'])
+                tokens = []
+
+                for token in params[3].split(' '):
+                    nick = token.lstrip(prefixes)
+                    prefix = token[:len(token) - len(nick)]
+
+                    if not userhost_in_names:
+                        nick = nick.split('!', 1)[0]
+
+                    if not multi_prefix:
+                        prefix = prefix[:1]
+
+                    tokens.append(prefix + nick)
+
+                return params[:3] + [' '.join(tokens)]
+
+        return params
+
     def check_password(self, password):
-        return password != None and self._config.get('password', None) == password
+        """
+        Checks the user's password. Passwords which aren't hashed yet (or use
+        an outdated number of iterations) are re-hashed once they've been
+        verified.
+        """
+
+        stored = self._config.lookup('password', None)
+
+        if stored == None or password == None:
+            return False
+
+        credential_cache = self.proxy.credential_cache
+
+        if credential_cache.check(self.name, stored, password):
+            return True
+
+        if not verify_password(stored, password):
+            return False
+
+        if needs_rehash(stored):
+            stored = hash_password(password)
+            self._config.set('password', stored)
+
+        credential_cache.add(self.name, stored, password)
+
+        return True
 
     def _get_last_reconnect(self):
         return self._config.get('last_reconnect', None)
@@ -309,19 +1119,52 @@ class ProxyUser(object):
     last_reconnect = property(_get_last_reconnect, _set_last_reconnect)
     
     def _get_password(self):
-        return self._config.get('password', None)
+        return self._config.lookup('password', None)
     
     def _set_password(self, value):
-        self._config.set('password', value)
+        self._config.set('password', hash_password(value))
+        self.proxy.credential_cache.remove(self.name)
 
     password = property(_get_password, _set_password)
+    """The hash of the user's password. Setting it hashes the new password."""
 
     def _get_admin(self):
-        return self._config.get('admin', None)
+        return self._admin
     
     def _set_admin(self, value):
         self._config.set('admin', value)
+        self._admin = value
 
     admin = property(_get_admin, _set_admin)
 
+    def _get_suspended(self):
+        return self._suspended
+
+    def _set_suspended(self, value):
+        self._config.set('suspended', value)
+        self._suspended = value
+
+    suspended = property(_get_suspended, _set_suspended)
+
+    def get_network(self):
+        """Returns the name of the IRC network the user is connected to, or None."""
+
+        ircobj = self.irc_connection
+
+        if ircobj == None or not ircobj.registered:
+            return None
+
+        return ircobj.isupport.get('NETWORK', None)
+
+    def get_idle_time(self):
+        """Returns the number of seconds since the user's last client disconnected."""
+
+        if len(self.client_connections) > 0:
+            return 0
+
+        if self.last_seen != None:
+            return time() - self.last_seen
+
+        return time() - self.proxy.start_time
+
 ServiceRegistry.register(Proxy)
\ No newline at end of file
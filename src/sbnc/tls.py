@@ -0,0 +1,158 @@
+# sbncng - an object-oriented framework for IRC
+# Copyright (C) 2011 Gunnar Beutner
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+try:
+    from gevent import ssl
+except ImportError:
+    ssl = None
+
+class TLSContext(object):
+    """
+    Wraps sockets in TLS.
+
+    Client-side contexts which verify certificates also check that the
+    certificate matches the server's host name.
+
+    Client-side contexts remember the session that was negotiated for each
+    remote address so that reconnects can resume it instead of doing a full
+    handshake. Server-side contexts issue session tickets; one context should
+    be shared by all connections of a listener so the ticket keys stay valid.
+    """
+
+    def __init__(self, server_side=False, certfile=None, keyfile=None,
+                 ca_certs=None, verify=False):
+        if ssl == None:
+            raise RuntimeError('TLS support requires the ssl module.')
+
+        if server_side and certfile == None:
+            raise ValueError('Server-side TLS contexts need a certificate.')
+
+        self.server_side = server_side
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.ca_certs = ca_certs
+        self.verify = verify
+
+        self.handshakes = 0
+        self.resumed_handshakes = 0
+
+        self._sessions = {}
+        self._context = None
+
+        if hasattr(ssl, 'SSLContext'):
+            self._context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+
+            if certfile != None:
+                self._context.load_cert_chain(certfile, keyfile)
+
+            if verify:
+                self._context.verify_mode = ssl.CERT_REQUIRED
+
+                if ca_certs != None:
+                    self._context.load_verify_locations(ca_certs)
+                else:
+                    self._context.load_default_certs()
+
+                # The server's name is only sent (and can only be checked)
+                # with SNI.
+                if not server_side and getattr(ssl, 'HAS_SNI', False) and \
+                        hasattr(self._context, 'check_hostname'):
+                    self._context.check_hostname = True
+
+            # Session tickets are what lets clients resume without us keeping
+            # per-session state around, so make sure they weren't disabled.
+            self._context.options &= ~getattr(ssl, 'OP_NO_TICKET', 0)
+
+    def wrap(self, sock, address=None):
+        """
+        Wraps the specified socket and performs the TLS handshake. For
+        client-side contexts the address is used to look up a previous
+        session for the same server.
+        """
+
+        if self._context != None:
+            kwargs = {
+                'server_side': self.server_side,
+                'do_handshake_on_connect': False
+            }
+
+            if not self.server_side and address != None and getattr(ssl, 'HAS_SNI', False):
+                kwargs['server_hostname'] = address[0]
+
+            sslsock = self._context.wrap_socket(sock, **kwargs)
+        else:
+            if self.verify:
+                cert_reqs = ssl.CERT_REQUIRED
+            else:
+                cert_reqs = ssl.CERT_NONE
+
+            sslsock = ssl.wrap_socket(sock, keyfile=self.keyfile, certfile=self.certfile,
+                                      server_side=self.server_side, cert_reqs=cert_reqs,
+                                      ca_certs=self.ca_certs, do_handshake_on_connect=False)
+
+        if not self.server_side:
+            session = self._sessions.get(address, None)
+
+            # Older ssl modules don't expose sessions, in which case we
+            # silently fall back to full handshakes.
+            if session != None and hasattr(sslsock, 'session'):
+                sslsock.session = session
+
+        sslsock.do_handshake()
+
+        # Without an SSLContext the certificate's host name has to be checked
+        # after the handshake.
+        if self._context == None and self.verify and not self.server_side and \
+                address != None and hasattr(ssl, 'match_hostname'):
+            ssl.match_hostname(sslsock.getpeercert(), address[0])
+
+        self.handshakes += 1
+
+        if getattr(sslsock, 'session_reused', False):
+            self.resumed_handshakes += 1
+
+        self.remember_session(sslsock, address)
+
+        return sslsock
+
+    def remember_session(self, sslsock, address):
+        """
+        Stores the socket's session for the specified address. With TLS 1.3 the
+        session ticket only arrives after the handshake, so this should be called
+        again before the connection is closed.
+        """
+
+        if self.server_side or address == None:
+            return
+
+        session = getattr(sslsock, 'session', None)
+
+        if session != None:
+            self._sessions[address] = session
+
+    def forget_session(self, address):
+        """Removes the cached session for the specified address."""
+
+        try:
+            del self._sessions[address]
+        except KeyError:
+            pass
+
+    def clear_sessions(self):
+        """Removes all cached sessions."""
+
+        self._sessions = {}
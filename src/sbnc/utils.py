@@ -17,10 +17,152 @@
 
 import re
 import string
+import calendar
+from time import gmtime, strftime, strptime
+
+_tag_escapes = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+def _unescape_tag_value(value):
+    if not '\\' in value:
+        return value
+
+    result = []
+    index = 0
+
+    while index < len(value):
+        char = value[index]
+
+        if char == '\\' and index + 1 < len(value):
+            index += 1
+            result.append(_tag_escapes.get(value[index], value[index]))
+        elif char != '\\':
+            result.append(char)
+
+        index += 1
+
+    return ''.join(result)
+
+def _escape_tag_value(value):
+    return value.replace('\\', '\\\\').replace(';', '\\:').replace(' ', '\\s') \
+                .replace('\r', '\\r').replace('\n', '\\n')
+
+class MessageTags(object):
+    """
+    The IRCv3 message tags of a line. The tags are only parsed when they're
+    accessed, so lines whose tags nobody looks at don't cost anything.
+    """
+
+    def __init__(self, raw=None):
+        self.raw = raw
+        self._tags = None
+
+    def _parse(self):
+        tags = {}
+
+        if self.raw:
+            for tag in self.raw.split(';'):
+                if tag == '':
+                    continue
+
+                key, _, value = tag.partition('=')
+                tags[key] = _unescape_tag_value(value)
+
+        self._tags = tags
+
+    def get(self, key, default=None):
+        if not self.raw:
+            return default
+
+        if self._tags == None:
+            self._parse()
+
+        return self._tags.get(key, default)
+
+    def __getitem__(self, key):
+        if self._tags == None:
+            self._parse()
+
+        return self._tags[key]
+
+    def __contains__(self, key):
+        if not self.raw:
+            return False
+
+        if self._tags == None:
+            self._parse()
+
+        return key in self._tags
+
+    def items(self):
+        if self._tags == None:
+            self._parse()
+
+        return self._tags.items()
+
+    def __len__(self):
+        if not self.raw:
+            return 0
+
+        if self._tags == None:
+            self._parse()
+
+        return len(self._tags)
+
+NO_TAGS = MessageTags()
+"""Shared MessageTags object for lines without tags."""
+
+def split_message_tags(line):
+    """
+    Splits the tags (if any) off an IRC message. Returns a tuple containing
+    a MessageTags object and the rest of the line.
+    """
+
+    if line[:1] != '@':
+        return NO_TAGS, line
+
+    tags, _, line = line.partition(' ')
+
+    return MessageTags(tags[1:]), line.lstrip(' ')
+
+def format_message_tags(tags):
+    """Formats a dictionary of message tags, e.g. 'time=2011-02-14T22:44:36.000Z;label=1'."""
+
+    tokens = []
+
+    for key, value in tags.items():
+        if value == None or value == '':
+            tokens.append(key)
+        else:
+            tokens.append('%s=%s' % (key, _escape_tag_value(value)))
+
+    return ';'.join(tokens)
+
+def format_server_time(timestamp):
+    """Formats a UNIX timestamp for the server-time 'time' tag."""
+
+    return strftime('%Y-%m-%dT%H:%M:%S', gmtime(timestamp)) + '.%03dZ' % (int(timestamp * 1000) % 1000)
+
+def parse_server_time(value):
+    """Parses the value of a server-time 'time' tag. Returns a UNIX timestamp or None."""
+
+    try:
+        seconds, _, fraction = value.rstrip('Z').partition('.')
+        timestamp = calendar.timegm(strptime(seconds, '%Y-%m-%dT%H:%M:%S'))
+
+        if fraction != '':
+            timestamp += float('0.' + fraction)
+
+        return timestamp
+    except ValueError:
+        return None
 
 def parse_irc_message(line, can_have_prefix=True):
     """Parses an IRC message, returns a tuple containing the prefix (if
-    any, None otherwise), the command and a list containing the arguments"""
+    any, None otherwise), the command and a list containing the arguments.
+    Message tags are ignored, use split_message_tags() to get them."""
+
+    if can_have_prefix and line[:1] == '@':
+        _, line = split_message_tags(line)
 
     tokens = line.split(' ')
 
@@ -79,6 +221,9 @@ def format_irc_message(command, *parameter_list, **prefix):
 
     message = message + command
 
+    if 'tags' in prefix and prefix['tags']:
+        message = '@' + format_message_tags(prefix['tags']) + ' ' + message
+
     if len(params) > 0:
         if len(params[-1]) > 0:
             params[-1] = ':' + params[-1]
@@ -87,6 +232,31 @@ def format_irc_message(command, *parameter_list, **prefix):
 
     return message
 
+_rfc1459_lower = string.maketrans(string.ascii_uppercase + '[]\\~',
+                                  string.ascii_lowercase + '{}|^')
+
+def irc_lower(value):
+    """
+    Lowercases a nick or channel name using the rfc1459 casemapping, i.e.
+    the way most IRC servers compare names.
+    """
+
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+
+    return value.translate(_rfc1459_lower)
+
+def intern_string(value):
+    """
+    Interns a byte string so that equal values which are kept around for a
+    long time share their memory. Other values are returned unchanged.
+    """
+
+    if type(value) is str:
+        return intern(value)
+
+    return value
+
 def parse_hostmask(hostmask):
     """Parses a hostmask. Returns a tuple containing the nickname,
     username and hostname."""
@@ -131,6 +301,39 @@ def prefix_to_mode(prefixes, prefix):
     
     return match.group(1)[index]
 
+def format_prefixes(prefixes, modes, multi_prefix=True):
+    """
+    Returns the nick prefixes for the specified channel modes, highest
+    first (e.g. '@+' for 'vo'). Unless multi_prefix is True only the highest
+    prefix is returned.
+    """
+
+    match = _nickmodes_regex.match(prefixes)
+
+    if not match or modes == '':
+        return ''
+
+    result = ''
+
+    for index, mode in enumerate(match.group(1)):
+        if mode in modes:
+            if not multi_prefix:
+                return match.group(2)[index]
+
+            result += match.group(2)[index]
+
+    return result
+
+def get_prefix_chars(prefixes):
+    """Returns the nick prefixes from the PREFIX ISUPPORT token, e.g. '@+' for '(ov)@+'."""
+
+    match = _nickmodes_regex.match(prefixes)
+
+    if not match:
+        return ''
+
+    return match.group(2)
+
 def mode_to_prefix(prefixes, mode):
     if mode == '':
         return None
@@ -146,3 +349,63 @@ def mode_to_prefix(prefixes, mode):
         return None
     
     return match.group(2)[index]
+
+def parse_chanmodes(chanmodes):
+    """
+    Parses the value of the CHANMODES ISUPPORT token. Returns a tuple
+    containing the list modes (type A), the modes which always have a
+    parameter (type B), the modes which have a parameter only when they are
+    set (type C) and the modes without a parameter (type D).
+    """
+
+    types = chanmodes.split(',')
+
+    while len(types) < 4:
+        types.append('')
+
+    return tuple(types[:4])
+
+def get_prefix_modes(prefixes):
+    """Returns the channel modes from the PREFIX ISUPPORT token, e.g. 'ov' for '(ov)@+'."""
+
+    match = _nickmodes_regex.match(prefixes)
+
+    if not match:
+        return ''
+
+    return match.group(1)
+
+def parse_mode_changes(modes, params, chanmodes, prefix_modes):
+    """
+    Parses a MODE change like '+ol-k' with the parameters ['shroud', '10', '*'].
+    chanmodes is a tuple as returned by parse_chanmodes(). Returns a list of
+    (adding, mode, param) tuples, param is None for modes without parameters.
+    """
+
+    list_modes, param_modes, set_param_modes, _ = chanmodes
+
+    changes = []
+    adding = True
+    index = 0
+
+    for mode in modes:
+        if mode == '+':
+            adding = True
+            continue
+        elif mode == '-':
+            adding = False
+            continue
+
+        if mode in prefix_modes or mode in list_modes or mode in param_modes or \
+                (adding and mode in set_param_modes):
+            if index < len(params):
+                param = params[index]
+                index += 1
+            else:
+                param = None
+        else:
+            param = None
+
+        changes.append((adding, mode, param))
+
+    return changes
@@ -0,0 +1,47 @@
+# sbncng - an object-oriented framework for IRC
+# Copyright (C) 2011 Gunnar Beutner
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+Runs blocking work in a thread pool, so that writing captures or snapshots
+and hashing passwords don't hold up every other connection.
+"""
+
+try:
+    from gevent.threadpool import ThreadPool
+except ImportError:
+    ThreadPool = None
+
+POOL_SIZE = 2
+
+_pool = None
+
+def run(func, *args):
+    """
+    Runs the specified function in the thread pool and waits for the result.
+    Only the calling greenlet waits; if gevent doesn't have a thread pool
+    the function is simply called.
+    """
+
+    global _pool
+
+    if ThreadPool == None:
+        return func(*args)
+
+    if _pool == None:
+        _pool = ThreadPool(POOL_SIZE)
+
+    return _pool.apply(func, args)
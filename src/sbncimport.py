@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# sbncng - an object-oriented framework for IRC
+# Copyright (C) 2011 Gunnar Beutner
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
+
+"""
+Creates users from a CSV or JSON file (or stdin). The bouncer shouldn't be
+running while this is used; use the 'importusers' admin command instead.
+Passwords are hashed during the import, which takes about 0.1 seconds per
+user.
+
+Usage:
+    python sbncimport.py [-f csv|json] [-b batch size] [-d database] [file]
+"""
+
+import os
+import sys
+from time import time
+from optparse import OptionParser
+from sbnc.proxy import Proxy
+from sbnc.directory import DirectoryService
+from sbnc.plugin import ServiceRegistry
+from sbnc import provision
+
+def main():
+    parser = OptionParser(usage='%prog [options] [file]')
+    parser.add_option('-f', '--format', dest='format', default=None,
+                      help='csv or json (default: guessed from the file name, csv for stdin)')
+    parser.add_option('-b', '--batch-size', dest='batch_size', type='int', default=500,
+                      help='number of users per transaction')
+    parser.add_option('-d', '--database', dest='database', default='sbncng.db',
+                      help='the bouncer\'s database')
+
+    options, args = parser.parse_args()
+
+    if len(args) > 0:
+        stream = open(args[0], 'rb')
+    else:
+        stream = sys.stdin
+
+    format = options.format
+
+    if format == None:
+        if len(args) > 0 and os.path.splitext(args[0])[1].lower() == '.json':
+            format = 'json'
+        else:
+            format = 'csv'
+
+    dir_svc = ServiceRegistry.get(DirectoryService.package)
+    dir_svc.start('sqlite:///' + options.database)
+
+    users_node = dir_svc.get_root_node()[Proxy.package]['users']
+
+    start = time()
+    count = 0
+    skipped = 0
+
+    for user_nodes, errors in provision.create_users(users_node, Proxy.package,
+                                                    provision.read_users(stream, format),
+                                                    options.batch_size):
+        for error in errors:
+            sys.stderr.write('Skipped: %s\n' % (error))
+
+        count += len(user_nodes)
+        skipped += len(errors)
+
+        print('%d users imported, %d skipped (%.1fs)' % (count, skipped, time() - start))
+
+    if stream != sys.stdin:
+        stream.close()
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -24,31 +24,102 @@ try:
 except ImportError:
     pass
 
-from sbnc.irc import ClientListener
+import os
+import gevent
+from sbnc.irc import ClientListener, NetworkInfo, Channel
 from sbnc.proxy import Proxy
 from sbnc.directory import DirectoryService
-from sbnc.plugin import ServiceRegistry
+from sbnc.plugin import ServiceRegistry, PluginManager
+from sbnc.tls import TLSContext
+from sbnc.metrics import MetricsListener
+from sbnc import log
+from sbnc.handover import HandoverServer, take_over, create_listener
 
 dir_svc = ServiceRegistry.get(DirectoryService.package)
 dir_svc.start('sqlite:///sbncng.db')
+
+# Read the whole configuration in one go rather than one query per user.
+dir_svc.preload()
+
 config_root = dir_svc.get_root_node()
 
+# Optional settings are read with lookup(): get() would store (and
+# commit) the default value for each of them.
+
+log.setup(levels=config_root.lookup('log_levels', None),
+          sample_rate=config_root.lookup('log_sample_rate', 1))
+
+# Servers whose channels share their topics between users, as [host, port] lists.
+NetworkInfo.shared_channel_servers = set([tuple(address) for address in
+                                          config_root.lookup('shared_channel_servers', [])])
+Channel.lazy_names = config_root.lookup('lazy_names', False)
+
 proxy_svc = ServiceRegistry.get(Proxy.package)
 
-print('sbncng (' + proxy_svc.version + ') - an object-oriented IRC bouncer')
+log.get_logger('main').info('sbncng (' + proxy_svc.version + ') - an object-oriented IRC bouncer')
 
-proxy_svc.start(config_root)
+with dir_svc.batch():
+    proxy_svc.start(config_root)
 
-execfile('plugins/plugin101.py')
-execfile('plugins/ui.py')
-execfile('plugins/awaycmd.py')
-execfile('plugins/admincmd.py')
-execfile('plugins/querylog.py')
+plugin_svc = ServiceRegistry.get(PluginManager.package)
+
+with dir_svc.batch():
+    plugin_svc.load_all(config_root.get('plugins', None))
+
+# Take over the connections from an older process if there's one running.
+handover_path = config_root.lookup('handover_socket', None)
+
+if handover_path != None and os.path.exists(handover_path):
+    try:
+        take_over(handover_path, proxy_svc)
+    except Exception:
+        log.get_logger('main').exception('Could not take over the connections from %s', handover_path)
 
 # TODO: move this into the Proxy plugin
 listener_address = config_root.get('listener_address', ['0.0.0.0', 9000])
 
-listener = ClientListener( tuple(listener_address), proxy_svc.client_factory )
-task = listener.start()
+# The listeners are created with create_listener() because the process we've
+# just taken over from might not have released their addresses yet.
+listener = create_listener(ClientListener, tuple(listener_address), proxy_svc.client_factory)
+
+if listener != None:
+    task = listener.start()
+else:
+    task = None
+
+listener_ssl_address = config_root.lookup('listener_ssl_address', None)
+
+if listener_ssl_address != None:
+    tls_context = TLSContext(server_side=True,
+                             certfile=config_root.lookup('listener_ssl_certificate', 'sbncng.pem'),
+                             keyfile=config_root.lookup('listener_ssl_key', None))
+
+    ssl_listener = create_listener(ClientListener, tuple(listener_ssl_address),
+                                   proxy_svc.client_factory, tls_context)
+
+    if ssl_listener != None:
+        ssl_listener.start()
+else:
+    ssl_listener = None
+
+metrics_address = config_root.lookup('metrics_address', None)
+
+if metrics_address != None:
+    metrics_listener = create_listener(MetricsListener, tuple(metrics_address))
+
+    if metrics_listener != None:
+        metrics_listener.start()
+else:
+    metrics_listener = None
+
+if handover_path != None:
+    handover_server = HandoverServer(handover_path, proxy_svc,
+                                     [item for item in [listener, ssl_listener, metrics_listener]
+                                      if item != None])
+    handover_server.start()
 
-task.join()
\ No newline at end of file
+if task != None:
+    task.join()
+else:
+    # Keep the connections we've taken over even if we can't accept new ones.
+    gevent.wait()
\ No newline at end of file